@@ -17,7 +17,7 @@ class TractographyBatchScheduler(BatchScheduler):
 
     def __init__(self, dataset, batch_size, noisy_streamlines_sigma=None, seed=1234, use_data_augment=True, normalize_target=False,
                  shuffle_streamlines=True, resample_streamlines=True, feed_previous_direction=False, sort_streamlines_by_length=False,
-                 learn_to_stop=False):
+                 learn_to_stop=False, features=None):
         """
         Parameters
         ----------
@@ -42,6 +42,10 @@ class TractographyBatchScheduler(BatchScheduler):
             Streamlines will be approximatively regrouped according to their length.
         learn_to_stop : bool
             Predict whether the streamline being generated should stop or not
+        features : 2D array, optional
+            Diffusion data at every point of the streamlines of `dataset` (see `learn2track.feature_cache`).
+            If provided, inputs are made of these features (+ previous direction) instead of streamlines
+            coordinates and dwi ID. Requires streamlines to be neither noisy nor resampled.
         """
         self.dataset = dataset
         self.batch_size = batch_size
@@ -60,6 +64,10 @@ class TractographyBatchScheduler(BatchScheduler):
         self.feed_previous_direction = feed_previous_direction
         self.learn_to_stop = learn_to_stop
 
+        self.features = features
+        if self.features is not None and (self.use_noisy_streamlines or self.resample_streamlines):
+            raise ValueError("Cached features can only be used with streamlines that are neither noisy nor resampled.")
+
         # Sort streamlines according to their length by default.
         # This should speed up validation.
         self.indices = np.argsort(self.dataset.streamlines._lengths)
@@ -141,15 +149,25 @@ class TractographyBatchScheduler(BatchScheduler):
         if self.learn_to_stop:
             batch_stopping = np.zeros((batch_size, max_streamline_length-1))
 
+        if self.features is not None:
+            # Streamlines are not resampled, their points are those of the dataset.
+            features_offsets = self.dataset.streamlines._offsets[np.asarray(indices)]
+            batch_features = np.zeros((batch_size, max_streamline_length-1, self.features.shape[1]), dtype=floatX)
+
         for i, (offset, length, volume_id) in enumerate(zip(streamlines._offsets, streamlines._lengths, volume_ids)):
             batch_masks[i, :length-1] = 1
             batch_inputs[i, :length-1] = inputs[offset:offset+length-1]  # [0, 1, 2, 3, 4] => [0, 1, 2, 3]
             batch_targets[i, :length-1] = targets[offset:offset+length-1]  # [1-0, 2-1, 3-2, 4-3] => [1-0, 2-1, 3-2, 4-3]
+            if self.features is not None:
+                features = self.features[features_offsets[i]:features_offsets[i]+length]
+                batch_features[i, :length-1] = features[:-1]
 
             if self.use_augment_by_flipping:
                 batch_masks[i+len(streamlines), :length-1] = 1
                 batch_inputs[i+len(streamlines), :length-1] = inputs[offset+1:offset+length][::-1]  # [0, 1, 2, 3, 4] => [4, 3, 2, 1]
                 batch_targets[i+len(streamlines), :length-1] = -targets[offset:offset+length-1][::-1]  # [1-0, 2-1, 3-2, 4-3] => [4-3, 3-2, 2-1, 1-0]
+                if self.features is not None:
+                    batch_features[i+len(streamlines), :length-1] = features[1:][::-1]
 
             if self.learn_to_stop:
                 # Model predicts the likelihood that a streamline should keep growing. Targets start at 1.0 and decrease linearly to 0.5
@@ -157,8 +175,11 @@ class TractographyBatchScheduler(BatchScheduler):
                 batch_stopping[i, :length-1] = np.linspace(1., 0.5, num=length-1)
                 batch_stopping[i+len(streamlines), :length - 1] = np.linspace(1., 0.5, num=length - 1)
 
-        batch_volume_ids = np.tile(volume_ids[:, None, None], (1 + self.use_augment_by_flipping, max_streamline_length-1, 1))
-        batch_inputs = np.concatenate([batch_inputs, batch_volume_ids], axis=2)  # Streamlines coords + dwi ID
+        if self.features is not None:
+            batch_inputs = batch_features  # Diffusion data instead of streamlines coords + dwi ID
+        else:
+            batch_volume_ids = np.tile(volume_ids[:, None, None], (1 + self.use_augment_by_flipping, max_streamline_length-1, 1))
+            batch_inputs = np.concatenate([batch_inputs, batch_volume_ids], axis=2)  # Streamlines coords + dwi ID
 
         if self.feed_previous_direction:
             previous_directions = np.concatenate([np.zeros((batch_size, 1, 3), dtype=floatX), batch_targets[:, :-1]], axis=1)
@@ -674,7 +695,7 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
     """
 
     def __init__(self, dataset, batch_size, noisy_streamlines_sigma=None, seed=1234, use_data_augment=True, normalize_target=False, shuffle_streamlines=True,
-                 resample_streamlines=True, feed_previous_direction=False):
+                 resample_streamlines=True, feed_previous_direction=False, features=None):
         """
         Parameters
         ----------
@@ -695,6 +716,10 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
             Should be always set to True for now (until the method _process_batch supports it).
         feed_previous_direction : bool
             Should the previous direction be appended to the input when making a prediction?
+        features : 2D array, optional
+            Diffusion data at every point of the streamlines of `dataset` (see `learn2track.feature_cache`).
+            If provided, inputs are made of these features (+ previous direction) instead of streamlines
+            coordinates and dwi ID. Requires streamlines to be neither noisy nor resampled.
         """
         self.dataset = dataset
         self.batch_size = batch_size
@@ -715,6 +740,10 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
 
         self.feed_previous_direction = feed_previous_direction
 
+        self.features = features
+        if self.features is not None and (self.use_noisy_streamlines or self.resample_streamlines):
+            raise ValueError("Cached features can only be used with streamlines that are neither noisy nor resampled.")
+
         # Shared variables
         self._shared_batch_inputs = sharedX(np.ndarray((0, 0)))
         self._shared_batch_targets = sharedX(np.ndarray((0, 0)))
@@ -796,6 +825,11 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
         batch_targets = np.zeros((actual_batch_size, 3), dtype=floatX)
         batch_array_index = 0
 
+        if self.features is not None:
+            # Streamlines are not resampled, their points are those of the dataset.
+            features_offsets = self.dataset.streamlines._offsets[np.asarray(indices)]
+            batch_features = np.zeros((actual_batch_size, self.features.shape[1]), dtype=floatX)
+
         for i, (offset, length, volume_id) in enumerate(zip(streamlines._offsets, streamlines._lengths, volume_ids)):
 
             start = batch_array_index
@@ -804,6 +838,9 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
 
             batch_inputs[start:end, :3] = inputs[offset:offset + length - 1]  # [0, 1, 2, 3, 4] => [0, 1, 2, 3]
             batch_targets[start:end] = targets[offset:offset + length - 1]  # [1-0, 2-1, 3-2, 4-3] => [1-0, 2-1, 3-2, 4-3]
+            if self.features is not None:
+                features = self.features[features_offsets[i]:features_offsets[i] + length]
+                batch_features[start:end] = features[:-1]
 
             if self.feed_previous_direction:
                 batch_inputs[start, 3:] = np.zeros((1, 3))
@@ -815,6 +852,8 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
                 flipped_end = end + half_batch_size
                 batch_inputs[flipped_start:flipped_end, :3] = inputs[offset + 1:offset + length][::-1]  # [0, 1, 2, 3, 4] => [4, 3, 2, 1]
                 batch_targets[flipped_start:flipped_end] = -targets[offset:offset + length - 1][::-1]  # [1-0, 2-1, 3-2, 4-3] => [4-3, 3-2, 2-1, 1-0]
+                if self.features is not None:
+                    batch_features[flipped_start:flipped_end] = features[1:][::-1]
 
                 if self.feed_previous_direction:
                     batch_inputs[flipped_start, 3:] = np.zeros((1, 3))
@@ -825,6 +864,10 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
         if self.use_augment_by_flipping:
             batch_volume_ids = np.tile(batch_volume_ids, [2])
 
+        if self.features is not None:
+            # Diffusion data (+ previous direction) instead of streamlines coords + dwi ID (+ previous direction)
+            return np.concatenate([batch_features, batch_inputs[:, 3:]], axis=1), batch_targets
+
         # Add dwi ID.
         if self.feed_previous_direction:
             batch_inputs = np.concatenate([batch_inputs[:, :3], batch_volume_ids[:, None], batch_inputs[:, 3:]], axis=1)  # Streamlines coords + dwi ID + previous direction
@@ -107,6 +107,7 @@ def model_factory(hyperparams, input_size, output_size, volume_manager):
                               use_zoneout=hyperparams['use_zoneout'],
                               use_skip_connections=hyperparams['skip_connections'],
                               neighborhood_radius=hyperparams['neighborhood_radius'],
+                              stack_neighborhood=hyperparams.get('stack_neighborhood', False),
                               learn_to_stop=hyperparams['learn_to_stop'],
                               seed=hyperparams['seed'])
 
@@ -138,6 +139,7 @@ def model_factory(hyperparams, input_size, output_size, volume_manager):
                            use_zoneout=hyperparams['use_zoneout'],
                            use_skip_connections=hyperparams['skip_connections'],
                            neighborhood_radius=hyperparams['neighborhood_radius'],
+                           stack_neighborhood=hyperparams.get('stack_neighborhood', False),
                            learn_to_stop=hyperparams['learn_to_stop'],
                            seed=hyperparams['seed'])
 
@@ -153,6 +155,7 @@ def model_factory(hyperparams, input_size, output_size, volume_manager):
                             use_zoneout=hyperparams['use_zoneout'],
                             use_skip_connections=hyperparams['skip_connections'],
                             neighborhood_radius=hyperparams['neighborhood_radius'],
+                            stack_neighborhood=hyperparams.get('stack_neighborhood', False),
                             learn_to_stop=hyperparams['learn_to_stop'],
                             seed=hyperparams['seed'])
 
@@ -169,6 +172,7 @@ def model_factory(hyperparams, input_size, output_size, volume_manager):
                                dropout_prob=hyperparams['dropout_prob'],
                                use_skip_connections=hyperparams['skip_connections'],
                                neighborhood_radius=hyperparams['neighborhood_radius'],
+                               stack_neighborhood=hyperparams.get('stack_neighborhood', False),
                                seed=hyperparams['seed'])
 
     else:
@@ -254,7 +258,7 @@ def loss_factory(hyperparams, model, dataset, loss_type=None):
         raise ValueError("Unknown model!")
 
 
-def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_override=None, use_data_augment=True):
+def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_override=None, use_data_augment=True, features=None):
     """
     Build the right batch scheduler for the model and chosen mode
 
@@ -270,6 +274,9 @@ def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_ov
         override batch_size hyperparam
     use_data_augment : bool
         Feed streamlines in both directions (doubles the batch size)
+    features : 2D array, optional
+        Diffusion data at every point of the streamlines of `dataset`, to feed instead of coordinates
+        (see `learn2track.feature_cache`).
     """
     batch_size = hyperparams['batch_size'] if batch_size_override is None else batch_size_override
 
@@ -285,9 +292,13 @@ def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_ov
                                           resample_streamlines=(not hyperparams['keep_step_size']) and train_mode,
                                           feed_previous_direction=hyperparams['feed_previous_direction'],
                                           sort_streamlines_by_length=hyperparams['sort_streamlines'] and train_mode,
-                                          learn_to_stop=hyperparams['learn_to_stop'])
+                                          learn_to_stop=hyperparams['learn_to_stop'],
+                                          features=features)
 
     elif hyperparams['model'] == 'gru_multistep':
+        if features is not None:
+            raise ValueError("Cached features are not supported by the gru_multistep model.")
+
         from learn2track.batch_schedulers import MultistepSequenceBatchScheduler
         return MultistepSequenceBatchScheduler(dataset,
                                                batch_size=batch_size,
@@ -309,6 +320,7 @@ def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_ov
                                                      noisy_streamlines_sigma=hyperparams['noisy_streamlines_sigma'],
                                                      shuffle_streamlines=train_mode,
                                                      resample_streamlines=(not hyperparams['keep_step_size']) and train_mode,
-                                                     feed_previous_direction=hyperparams['feed_previous_direction'])
+                                                     feed_previous_direction=hyperparams['feed_previous_direction'],
+                                                     features=features)
     else:
         raise ValueError("Unknown model!")
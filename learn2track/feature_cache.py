@@ -0,0 +1,106 @@
+"""
+Offline cache of the diffusion features seen by the models during training.
+
+When streamlines are neither resampled nor perturbed by noise between batches, every epoch
+evaluates the diffusion volumes at exactly the same points. The features at every point of
+every streamline of a dataset (including its neighborhood, if any) can thus be interpolated
+once, stored in a memory-mapped `.npy` file whose rows are aligned with `streamlines._data`
+(i.e. the features of streamline `i` are at rows `_offsets[i]:_offsets[i]+_lengths[i]`).
+
+Batch schedulers given such features (see `TractographyBatchScheduler`) feed them to the models
+instead of coordinates; models must then be told so (see `use_cached_features`).
+"""
+import os
+from os.path import join as pjoin
+
+import numpy as np
+
+from learn2track.neurotools import get_neighborhood_directions
+from learn2track.numpy_inference import eval_atlas_at_3d_coordinates_in_numpy
+
+FEATURES_DIRNAME = "features"
+DTYPES = ["float16", "float32"]
+
+
+def compute_features(dataset, volume_manager, neighborhood_radius=None, stack_neighborhood=False, out=None, chunk_size=100000):
+    """ Interpolates the diffusion data at every point of the streamlines of `dataset`.
+
+    Parameters
+    ----------
+    dataset : :class:`TractographyDataset` object
+        Dataset whose streamlines are expressed in voxel space.
+    volume_manager : :class:`VolumeManager` object
+        Volumes the subjects of `dataset` were registered to.
+    neighborhood_radius : float, optional
+        If provided, also evaluate the data around every point, the same way the models do.
+    stack_neighborhood : bool, optional
+        If True, evaluate the neighborhood using the precomputed neighborhood atlas (see `VolumeManager.get_neighborhood_atlas`).
+    out : 2D array, optional
+        Where to write the features, e.g. a memory-mapped array. Default: allocate a float32 array.
+    chunk_size : int, optional
+        Number of points interpolated at once. Default: 100,000.
+
+    Returns
+    -------
+    features : 2D array of shape (nb_points, nb_features)
+        Features of every point, in the same order as `dataset.streamlines._data`.
+    """
+    atlas = volume_manager.atlas.get_value(borrow=True)
+    offsets = np.array(volume_manager.volumes_offsets, dtype=np.intp)
+    shapes = np.array(volume_manager.volumes_shapes, dtype=atlas.dtype)
+    strides = np.array(volume_manager.volumes_strides, dtype=atlas.dtype)
+
+    directions = np.zeros((1, 3), dtype=atlas.dtype)
+    if neighborhood_radius and stack_neighborhood:
+        atlas = volume_manager.get_neighborhood_atlas(neighborhood_radius).get_value(borrow=True)
+    elif neighborhood_radius:
+        directions = get_neighborhood_directions(neighborhood_radius).astype(atlas.dtype)
+
+    points = dataset.streamlines._data
+    volume_ids = np.repeat(dataset.streamline_id_to_volume_id, dataset.streamlines._lengths).astype(np.intp)
+
+    nb_features = len(directions) * atlas.shape[-1]
+    if out is None:
+        out = np.empty((len(points), nb_features), dtype=np.float32)
+
+    for start in range(0, len(points), chunk_size):
+        end = min(start + chunk_size, len(points))
+
+        # Same layout as the models: the data of every neighbor of a point are concatenated.
+        coords = (points[start:end, None, :] + directions).reshape((-1, 3)).astype(atlas.dtype)
+        data = eval_atlas_at_3d_coordinates_in_numpy(atlas, offsets, shapes, strides, coords,
+                                                     np.repeat(volume_ids[start:end], len(directions)))
+        out[start:end] = data.reshape((end - start, nb_features))
+
+    return out
+
+
+def load_or_compute_features(experiment_path, dataset, volume_manager, neighborhood_radius=None, stack_neighborhood=False, dtype="float32"):
+    """ Loads the features of `dataset` cached in the folder of an experiment, computing them if needed.
+
+    Returns
+    -------
+    features : `np.memmap` object of shape (nb_points, nb_features)
+        Features of every point, in the same order as `dataset.streamlines._data`.
+    """
+    nb_directions = len(get_neighborhood_directions(neighborhood_radius)) if neighborhood_radius else 1
+    shape = (len(dataset.streamlines._data), nb_directions * volume_manager.data_dimension)
+    filename = pjoin(experiment_path, FEATURES_DIRNAME, "{}_{}.npy".format(dataset.name, dtype))
+
+    if os.path.isfile(filename):
+        features = np.load(filename, mmap_mode='r')
+        if features.shape == shape and features.dtype == np.dtype(dtype):
+            print("Using cached features: {}".format(filename))
+            return features
+
+        print("Cached features {} do not match the dataset, computing them again.".format(filename))
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = "{}.{}.tmp.npy".format(filename[:-len(".npy")], os.getpid())
+    features = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=dtype, shape=shape)
+    compute_features(dataset, volume_manager, neighborhood_radius=neighborhood_radius, stack_neighborhood=stack_neighborhood, out=features)
+    features.flush()
+    del features
+    os.replace(tmp_filename, filename)  # Other processes never see a partially written file.
+
+    return np.load(filename, mmap_mode='r')
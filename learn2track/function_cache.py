@@ -0,0 +1,140 @@
+"""
+Persistent cache of compiled Theano functions.
+
+Compiling a Theano function spends most of its time optimizing the graph, which is
+redone by every script evaluating or tracking with a model. Compiled functions are
+pickled in the folder of the experiment instead, so the next runs only have to unpickle
+them (Theano does not optimize unpickled functions again, see `reoptimize_unpickled_function`).
+
+Functions are looked up by a key made of what describes the model (e.g. its class, its
+hyperparameters and the shape of the diffusion volumes), the version and configuration
+of Theano, and a fingerprint of the graph to compile. Shared variables (weights, volumes,
+dataset, ...) are not stored: those of the graph being compiled are swapped in when
+unpickling, so a function always uses the current values.
+"""
+import os
+import pickle
+from os.path import join as pjoin
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+from theano.gof import graph
+
+from learn2track.utils import generate_uid_from_string
+
+CACHE_DIRNAME = "compiled_functions"
+
+
+def _get_graph_variables(outputs, givens=None, updates=None):
+    """ Returns the variables the outputs, the givens and the updates of a function are computed from. """
+    variables = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+    for mapping in (givens, updates):
+        if mapping is not None:
+            variables += list(mapping.values() if hasattr(mapping, 'values') else [v for _, v in mapping])
+
+    return variables
+
+
+def _get_shared_variables(variables):
+    """ Returns the shared variables `variables` depend on, in a deterministic order. """
+    return [v for v in graph.inputs(variables) if isinstance(v, SharedVariable)]
+
+
+class FunctionCache(object):
+    """ Folder of compiled Theano functions (see `compile_function`).
+
+    Parameters
+    ----------
+    path : str
+        Folder where compiled functions are saved, created if needed.
+    **key
+        JSON-serializable values describing the functions to cache, e.g. the class and
+        hyperparameters of the model they are compiled for.
+    """
+    def __init__(self, path, **key):
+        self.path = path
+        self.key = dict(key, theano=theano.__version__, floatX=theano.config.floatX, device=theano.config.device)
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def _get_filename(self, name, variables):
+        # The printed graph tells apart functions built with different options (e.g. sampling or not).
+        fingerprint = theano.printing.debugprint(variables, file='str')
+        uid = generate_uid_from_string(repr(sorted(self.key.items())) + name + fingerprint)
+        return pjoin(self.path, "{}-{}.pkl".format(name, uid[:16]))
+
+    def _load(self, filename, shared_variables):
+        with open(filename, 'rb') as f:
+            function, positions, unpack_single = pickle.load(f)
+
+        swap = {old: shared_variables[i] for old, i in zip(function.get_shared(), positions) if i is not None}
+        function = function.copy(swap=swap, name=function.name)
+        function.unpack_single = unpack_single  # Not kept by `copy`: single outputs would be returned in a list.
+        return function
+
+    def _save(self, filename, function, shared_variables, unpack_single):
+        # Remember which shared variable of the graph each one of the function is.
+        ids = {id(v): i for i, v in enumerate(shared_variables)}
+        function_shared = function.get_shared()
+        positions = [ids.get(id(v)) for v in function_shared]
+
+        # Their values are swapped when loading the function, no need to save them.
+        values = [v.get_value(borrow=True, return_internal_type=True) for v in function_shared]
+        try:
+            for v, i in zip(function_shared, positions):
+                if i is not None:
+                    v.set_value(np.zeros([1 if b else 0 for b in v.broadcastable], dtype=v.dtype), borrow=True)
+
+            os.makedirs(self.path, exist_ok=True)
+            tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump((function, positions, unpack_single), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp_filename, filename)  # Other processes never see a partially written file.
+        finally:
+            for v, value in zip(function_shared, values):
+                v.set_value(value, borrow=True)
+
+    def function(self, inputs, outputs, name, **kwargs):
+        """ Same as `theano.function`, but reuses the function compiled by a previous run if any. """
+        variables = _get_graph_variables(outputs, kwargs.get('givens'), kwargs.get('updates'))
+        shared_variables = _get_shared_variables(variables)
+        filename = self._get_filename(name, variables)
+
+        if os.path.isfile(filename):
+            try:
+                function = self._load(filename, shared_variables)
+                self.nb_hits += 1
+                print("Compiled function cache hit: {}".format(filename))
+                return function
+            except Exception as e:  # E.g. a file written by another version of Theano.
+                print("Cannot load compiled function {} ({}), compiling it again.".format(filename, e))
+
+        self.nb_misses += 1
+        print("Compiled function cache miss: {}".format(filename))
+        function = theano.function(inputs, outputs, name=name, **kwargs)
+        try:
+            self._save(filename, function, shared_variables, unpack_single=not isinstance(outputs, (list, tuple)))
+        except Exception as e:  # Caching is only an optimization.
+            print("Cannot save compiled function {} ({}).".format(filename, e))
+
+        return function
+
+
+def make_function_cache(experiment_path, model, hyperparams):
+    """ Makes the cache of the functions compiled for `model`, kept in the folder of its experiment. """
+    volume_manager = model.volume_manager
+    volume_shapes = [tuple(int(s) for s in shape) + (volume_manager.data_dimension,) for shape in volume_manager.volumes_shapes]
+    return FunctionCache(pjoin(experiment_path, CACHE_DIRNAME),
+                         model=type(model).__name__,
+                         hyperparams=sorted((k, repr(v)) for k, v in hyperparams.items()),
+                         volume_shapes=volume_shapes)
+
+
+def compile_function(inputs, outputs, cache=None, name=None, **kwargs):
+    """ Compiles a Theano function, going through `cache` (see `FunctionCache`) if provided. """
+    if cache is None:
+        return theano.function(inputs, outputs, name=name, **kwargs)
+
+    return cache.function(inputs, outputs, name=name or "function", **kwargs)
@@ -3,6 +3,9 @@ import numpy as np
 import theano
 import theano.tensor as T
 
+# Packing volumes by corners needs no Theano, so it can be done before tracking with NumPy.
+from learn2track.numpy_inference import pack_volume_corners
+
 
 B1 = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
                [-1, 0, 0, 0, 1, 0, 0, 0],
@@ -90,3 +93,79 @@ def eval_volume_at_3d_coordinates_in_theano(volume, coords, strides=None):
         Q1 = T.stack([T.ones_like(dx), d[:, 0], d[:, 1], d[:, 2], dx*dy, dy*dz, dx*dz, dx*dy*dz], axis=0)
         values = T.sum(P * T.dot(B1.T, Q1), axis=1).T
         return values
+
+
+def eval_atlas_at_3d_coordinates_in_theano(atlas, coords, offsets, shapes, strides):
+    """ Evaluates the data volumes packed in an atlas at given coordinates using trilinear interpolation.
+
+    Contrary to `eval_volume_at_3d_coordinates_in_theano`, every coordinate can fall in a
+    different volume: the eight corners surrounding all coordinates are fetched with a single gather.
+
+    Parameters
+    ----------
+    atlas : 2D array of shape (nb_voxels, C)
+        Data volumes, each one flattened over its three spatial dimensions, stacked one after the other.
+    coords : ndarray of shape (N, 4)
+        3D coordinates where to evaluate the data, followed by the ID of the volume to use.
+    offsets : 1D int array of shape (nb_volumes,)
+        First row of each volume in the atlas.
+    shapes : 2D int array of shape (nb_volumes, 3)
+        Spatial shape of each volume.
+    strides : 2D int array of shape (nb_volumes, 3)
+        Strides of each flattened volume for each spatial dimension.
+    """
+    volume_ids = T.cast(coords[:, 3], dtype="int32")
+    shapes = shapes[volume_ids][:, None, :]
+    strides = strides[volume_ids][:, None, :]
+
+    # Flat indices of the 8 corners surrounding each coordinate, clipped to the border of their volume.
+    corners = T.cast(T.floor(coords[:, None, :3] + idx), dtype=strides.dtype)
+    corners = T.maximum(0, T.minimum(corners, shapes - 1))
+    indices = offsets[volume_ids][:, None] + T.sum(corners * strides, axis=2)
+
+    # P.shape : (C, 8, N)
+    P = atlas[indices.flatten()].reshape((coords.shape[0], 8, atlas.shape[-1])).T
+
+    d = coords[:, :3] - T.floor(coords[:, :3])
+    dx, dy, dz = d[:, 0], d[:, 1], d[:, 2]
+    Q1 = T.stack([T.ones_like(dx), d[:, 0], d[:, 1], d[:, 2], dx*dy, dy*dz, dx*dz, dx*dy*dz], axis=0)
+    values = T.sum(P * T.dot(B1.T, Q1), axis=1).T
+    return values
+
+
+def eval_corners_atlas_at_3d_coordinates_in_theano(corners_atlas, coords, offsets, shapes, strides):
+    """ Evaluates the data volumes packed by `pack_volume_corners` in an atlas at given coordinates using trilinear interpolation.
+
+    Contrary to `eval_atlas_at_3d_coordinates_in_theano`, the eight corners surrounding a coordinate are
+    read from a single row of the atlas, and the interpolation weights are computed in closed form.
+    Both give the same values.
+
+    Parameters
+    ----------
+    corners_atlas : 2D array of shape (nb_blocks, 8*C)
+        Packed data volumes (see `pack_volume_corners`), stacked one after the other.
+    coords : ndarray of shape (N, 4)
+        3D coordinates where to evaluate the data, followed by the ID of the volume to use.
+    offsets : 1D int array of shape (nb_volumes,)
+        First row of each packed volume in the atlas.
+    shapes : 2D int array of shape (nb_volumes, 3)
+        Spatial shape of each volume (before packing).
+    strides : 2D int array of shape (nb_volumes, 3)
+        Strides of each flattened packed volume for each spatial dimension.
+    """
+    volume_ids = T.cast(coords[:, 3], dtype="int32")
+    floor = T.floor(coords[:, :3])
+
+    # Block whose corners are the (clipped) corners surrounding each coordinate.
+    blocks = T.cast(floor, dtype=strides.dtype)
+    blocks = T.maximum(-1, T.minimum(blocks, shapes[volume_ids] - 1)) + 1
+    indices = offsets[volume_ids] + T.sum(blocks * strides[volume_ids], axis=1)
+
+    # P.shape : (N, 8, C)
+    P = corners_atlas[indices].reshape((coords.shape[0], 8, corners_atlas.shape[-1] // 8))
+
+    d = coords[:, :3] - floor
+    weights = [(d[:, 0] if x else 1 - d[:, 0]) * (d[:, 1] if y else 1 - d[:, 1]) * (d[:, 2] if z else 1 - d[:, 2])
+               for x, y, z in idx.astype(int)]
+    values = T.sum(P * T.stack(weights, axis=1)[:, :, None], axis=1)
+    return values
@@ -41,6 +41,7 @@ class FFNN(Model):
         """
         self.graph_updates = OrderedDict()
         self._gen = None
+        self.function_cache = None  # Where to look for compiled functions (see `learn2track.function_cache`).
 
         self.input_size = input_size
         self.hidden_sizes = [hidden_sizes] if type(hidden_sizes) is int else hidden_sizes
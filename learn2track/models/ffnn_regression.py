@@ -7,6 +7,7 @@ from smartlearner.interfaces.loss import Loss
 from learn2track.models import FFNN
 from learn2track.models.layers import LayerDense
 from learn2track.neurotools import get_neighborhood_directions
+from learn2track.function_cache import compile_function
 from learn2track.utils import l2distance
 
 floatX = theano.config.floatX
@@ -17,7 +18,8 @@ class FFNN_Regression(FFNN):
     """
 
     def __init__(self, volume_manager, input_size, hidden_sizes, output_size, activation, use_previous_direction=False, predict_offset=False,
-                 use_layer_normalization=False, dropout_prob=0., neighborhood_radius=False, seed=1234, **_):
+                 use_layer_normalization=False, dropout_prob=0., neighborhood_radius=False, stack_neighborhood=False,
+                 seed=1234, **_):
         """
         Parameters
         ----------
@@ -41,10 +43,13 @@ class FFNN_Regression(FFNN):
             Dropout probability for recurrent networks. See: https://arxiv.org/pdf/1512.05287.pdf
         neighborhood_radius : float
             Add signal in positions around the current streamline coordinate to the input (with given length in voxel space); None = no neighborhood
+        stack_neighborhood : bool
+            Gather the neighborhood from an atlas precomputed with the data of all neighbors (see `VolumeManager.get_neighborhood_atlas`)
         seed : int
             Random seed used for dropout normalization
         """
         self.neighborhood_radius = neighborhood_radius
+        self.stack_neighborhood = stack_neighborhood
         self.model_input_size = input_size
         if self.neighborhood_radius:
             self.neighborhood_directions = get_neighborhood_directions(self.neighborhood_radius)
@@ -57,6 +62,8 @@ class FFNN_Regression(FFNN):
         self.input_size = input_size
 
         self.volume_manager = volume_manager
+        # If True, inputs given to `get_output` already hold the diffusion data (see `learn2track.feature_cache`).
+        self.use_cached_features = False
         self.output_size = output_size
         self.use_previous_direction = use_previous_direction
         self.predict_offset = predict_offset
@@ -82,44 +89,54 @@ class FFNN_Regression(FFNN):
         hyperparameters['use_previous_direction'] = self.use_previous_direction
         hyperparameters['predict_offset'] = self.predict_offset
         hyperparameters['neighborhood_radius'] = self.neighborhood_radius
+        hyperparameters['stack_neighborhood'] = self.stack_neighborhood
         return hyperparameters
 
     @property
     def parameters(self):
         return super().parameters + self.layer_regression.parameters
 
-    def _fprop(self, Xi, *args):
+    def _get_fprop_input(self, Xi):
         # Xi.shape : (batch_size, 4)    *if self.use_previous_direction, Xi.shape : (batch_size,7)
         # coords + dwi ID (+ previous_direction)
 
         # coords : streamlines 3D coordinates.
         # coords.shape : (batch_size, 4) where the last column is a dwi ID.
-        # args.shape : n_layers * (batch_size, layer_size)
         batch_size = Xi.shape[0]
         coords = Xi[:, :4]
 
-        # Repeat coords and apply the neighborhood transformations
-        if self.neighborhood_radius:
-            # coords.shape : (batch_size*len(neighbors_positions), 4)
-            coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
-            coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
+        if self.neighborhood_radius and self.stack_neighborhood:
+            # The data of all neighbors are gathered at once from the precomputed neighborhood atlas.
+            # data_at_coords.shape : (batch_size, input_size*len(neighbors_positions))
+            data_at_coords = self.volume_manager.eval_at_coords(coords, neighborhood_radius=self.neighborhood_radius)
+        else:
+            # Repeat coords and apply the neighborhood transformations
+            if self.neighborhood_radius:
+                # coords.shape : (batch_size*len(neighbors_positions), 4)
+                coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
+                coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
 
-        # Get diffusion data.
-        # data_at_coords.shape : (batch_size, input_size)
-        data_at_coords = self.volume_manager.eval_at_coords(coords)
+            # Get diffusion data.
+            # data_at_coords.shape : (batch_size, input_size)
+            data_at_coords = self.volume_manager.eval_at_coords(coords)
 
-        # Concatenate back the neighborhood data into a single input vector
-        if self.neighborhood_radius:
-            data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
+            # Concatenate back the neighborhood data into a single input vector
+            if self.neighborhood_radius:
+                data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
 
         if self.use_previous_direction:
             # previous_direction.shape : (batch_size, 3)
             print("Using previous direction")
             previous_direction = Xi[:, 4:]
-            fprop_input = T.concatenate([data_at_coords, previous_direction], axis=1)
-        else:
-            fprop_input = data_at_coords
+            return T.concatenate([data_at_coords, previous_direction], axis=1)
+
+        return data_at_coords
 
+    def _fprop(self, Xi, *args):
+        return self._fprop_features(self._get_fprop_input(Xi))
+
+    def _fprop_features(self, fprop_input):
+        """ Same as `_fprop`, given the diffusion data (+ previous direction) instead of the coordinates. """
         # Hidden state to be passed to the next GRU iteration (next _fprop call)
         # next_hidden_state.shape : n_layers * (batch_size, layer_size)
         layer_outputs = super()._fprop(fprop_input)
@@ -129,10 +146,16 @@ class FFNN_Regression(FFNN):
         regression_out = self.layer_regression.fprop(layer_outputs[-1], dropout_W)
         if self.predict_offset:
             print("Predicting offset")
-            regression_out += previous_direction  # Skip-connection from the previous direction.
+            regression_out += fprop_input[:, -3:]  # Skip-connection from the previous direction.
 
         return layer_outputs + (regression_out,)
 
+    def get_output(self, X):
+        if self.use_cached_features:
+            return self._fprop_features(X)[-1]
+
+        return super().get_output(X)
+
     def make_sequence_generator(self, subject_id=0, **_):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t}.
@@ -151,9 +174,10 @@ class FFNN_Regression(FFNN):
         # predictions.shape : (batch_size, target_size)
         predictions = layer_outputs[-1]
 
-        f = theano.function(inputs=[symb_x_t], outputs=[predictions])
+        f = compile_function(inputs=[symb_x_t], outputs=[predictions],
+                             cache=self.function_cache, name="sequence_generator")
 
-        def _gen(x_t, states, previous_direction=None):
+        def _gen(x_t, states, previous_direction=None, subject_ids=None):
             """ Returns the prediction for x_{t+1} for every
                 sequence in the batch given x_{t}.
 
@@ -165,6 +189,8 @@ class FFNN_Regression(FFNN):
                 Currrent states of the network.
             previous_direction : ndarray with shape (batch_size, 3)
                 If using previous direction, these should be added to the input
+            subject_ids : 1D array of shape (batch_size,), optional
+                ID of the subject of each sequence. Default: use `subject_id` for all of them.
 
             Returns
             -------
@@ -174,7 +200,10 @@ class FFNN_Regression(FFNN):
                 Updated states of the network after seeing x_t.
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
-            subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
+            if subject_ids is None:
+                subject_ids = [subject_id] * len(x_t)
+
+            subject_ids = np.asarray(subject_ids, dtype=floatX)[:, None]
 
             if not self.use_previous_direction:
                 x_t = np.c_[x_t, subject_ids]
@@ -44,6 +44,7 @@ class GRU(Model):
         """
         self.graph_updates = OrderedDict()
         self._gen = None
+        self.function_cache = None  # Where to look for compiled functions (see `learn2track.function_cache`).
 
         self.input_size = input_size
         self.hidden_sizes = [hidden_sizes] if type(hidden_sizes) is int else hidden_sizes
@@ -110,6 +111,10 @@ class GRU(Model):
         return states_h
 
     def _fprop(self, Xi, *args):
+        return self._fprop_projected(Xi, self.layers[0].project_inputs(Xi), *args)
+
+    def _fprop_projected(self, Xi, Xi_proj, *args):
+        """ Same as `_fprop`, given the inputs of the first layer already projected (see `LayerGRU.project_inputs`). """
         layers_h = []
 
         input = Xi
@@ -125,7 +130,10 @@ class GRU(Model):
                     drop_states = self.dropout_vectors[layer.name]
 
             last_h = args[i]
-            h = layer.fprop(input, last_h, drop_states, drop_value)
+            if i == 0:
+                h = layer.fprop_projected(Xi_proj, last_h, drop_states, drop_value)
+            else:
+                h = layer.fprop(input, last_h, drop_states, drop_value)
             layers_h.append(h)
             if self.use_skip_connections:
                 input = T.concatenate([h, Xi], axis=-1)
@@ -7,6 +7,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams
 from learn2track.models.gru_regression import GRU_Regression
 from learn2track.models.layers import LayerRegression, LayerDense
 from learn2track.neurotools import get_neighborhood_directions
+from learn2track.function_cache import compile_function
 from learn2track.utils import logsumexp, softmax, l2distance
 
 floatX = theano.config.floatX
@@ -17,8 +18,8 @@ class GRU_Mixture(GRU_Regression):
     """
 
     def __init__(self, volume_manager, input_size, hidden_sizes, output_size, n_gaussians, activation='tanh', use_previous_direction=False,
-                 use_layer_normalization=False, drop_prob=0., use_zoneout=False, use_skip_connections=False, neighborhood_radius=None, learn_to_stop=False,
-                 seed=1234, **_):
+                 use_layer_normalization=False, drop_prob=0., use_zoneout=False, use_skip_connections=False, neighborhood_radius=None,
+                 stack_neighborhood=False, learn_to_stop=False, seed=1234, **_):
         """
         Parameters
         ----------
@@ -46,12 +47,15 @@ class GRU_Mixture(GRU_Regression):
             Use skip connections from the input to all hidden layers in the network, and from all hidden layers to the output layer
         neighborhood_radius : float
             Add signal in positions around the current streamline coordinate to the input (with given length in voxel space); None = no neighborhood
+        stack_neighborhood : bool
+            Gather the neighborhood from an atlas precomputed with the data of all neighbors (see `VolumeManager.get_neighborhood_atlas`)
         learn_to_stop : bool
             Predict whether the streamline being generated should stop or not
         seed : int
             Random seed used for dropout normalization
         """
         self.neighborhood_radius = neighborhood_radius
+        self.stack_neighborhood = stack_neighborhood
         self.model_input_size = input_size
         if self.neighborhood_radius:
             self.neighborhood_directions = get_neighborhood_directions(self.neighborhood_radius)
@@ -127,7 +131,7 @@ class GRU_Mixture(GRU_Regression):
 
         return samples
 
-    def make_sequence_generator(self, subject_id=0, use_max_component=False):
+    def make_sequence_generator(self, subject_id=0, use_max_component=False, rng_seed=1234, return_regression_output=False):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -135,6 +139,13 @@ class GRU_Mixture(GRU_Regression):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        use_max_component : bool, optional
+            Use the maximum of the probability distribution instead of sampling values
+        rng_seed : int, optional
+            Seed of the random generator used when sampling values. Default: 1234.
+        return_regression_output : bool, optional
+            If True, the generated function also returns the output of the regression layer
+            (i.e. the parameters of the mixture the directions are sampled from). Default: False.
         """
 
         # Build the sequence generator as a theano function.
@@ -155,7 +166,7 @@ class GRU_Mixture(GRU_Regression):
         if use_max_component:
             samples = self._get_max_component_samples(*mixture_params)
         else:
-            srng = MRG_RandomStreams(1234)
+            srng = MRG_RandomStreams(rng_seed)
             samples = self._get_stochastic_samples(srng, *mixture_params)
 
         if self.learn_to_stop:
@@ -164,10 +175,14 @@ class GRU_Mixture(GRU_Regression):
         else:
             predictions = [samples]
 
-        f = theano.function(inputs=[symb_x_t] + states_h,
-                            outputs=list(predictions) + list(new_states_h))
+        if return_regression_output:
+            predictions.append(regression_output)
 
-        def _gen(x_t, states, previous_direction=None):
+        f = compile_function(inputs=[symb_x_t] + states_h,
+                             outputs=list(predictions) + list(new_states_h),
+                             cache=self.function_cache, name="sequence_generator")
+
+        def _gen(x_t, states, previous_direction=None, subject_ids=None):
             """ Returns the prediction for x_{t+1} for every
                 sequence in the batch given x_{t} and the current states
                 of the model h^{l}_{t}.
@@ -180,6 +195,8 @@ class GRU_Mixture(GRU_Regression):
                 Currrent states of the network.
             previous_direction : ndarray with shape (batch_size, 3)
                 If using previous direction, these should be added to the input
+            subject_ids : 1D array of shape (batch_size,), optional
+                ID of the subject of each sequence. Default: use `subject_id` for all of them.
 
             Returns
             -------
@@ -187,9 +204,14 @@ class GRU_Mixture(GRU_Regression):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, regression_layer_size)
+                Output of the regression layer, only if `return_regression_output` is True.
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
-            subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
+            if subject_ids is None:
+                subject_ids = [subject_id] * len(x_t)
+
+            subject_ids = np.asarray(subject_ids, dtype=floatX)[:, None]
 
             if not self.use_previous_direction:
                 x_t = np.c_[x_t, subject_ids]
@@ -200,13 +222,15 @@ class GRU_Mixture(GRU_Regression):
             if self.learn_to_stop:
                 stopping = results[0]
                 next_x_t = results[1]
-                new_states = results[2:]
                 output = (next_x_t, stopping)
             else:
                 next_x_t = results[0]
-                new_states = results[1:]
                 output = next_x_t
 
+            new_states = results[len(predictions):]
+            if return_regression_output:
+                return output, new_states, results[len(predictions) - 1]
+
             return output, new_states
 
         return _gen
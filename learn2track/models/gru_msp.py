@@ -9,6 +9,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams
 
 from learn2track.models import GRU
 from learn2track.models.layers import LayerRegression
+from learn2track.function_cache import compile_function
 from learn2track.utils import logsumexp, l2distance
 
 floatX = theano.config.floatX
@@ -48,7 +49,8 @@ class GRU_Multistep_Gaussian(GRU):
         use_zoneout : bool
             Use zoneout implementation instead of dropout
         """
-        super().__init__(input_size, hidden_sizes, use_layer_normalization, drop_prob, use_zoneout, seed)
+        super().__init__(input_size, hidden_sizes, use_layer_normalization=use_layer_normalization, drop_prob=drop_prob, use_zoneout=use_zoneout,
+                         seed=seed)
         self.target_dims = target_dims
         self.target_size = 2 * self.target_dims  # Output distribution parameters mu and sigma for each dimension
 
@@ -197,7 +199,7 @@ class GRU_Multistep_Gaussian(GRU):
         # results.shape : n_layers * (seq_len, batch_size*M, layer_size), (seq_len, batch_size*M, K, target_size)
         results, updates = theano.scan(fn=self._fprop_step, # We want to scan over sequence elements, not the examples.
                                        sequences=[T.transpose(inputs, axes=(1, 0, 2))], outputs_info=outputs_info_h + [None],
-                                       non_sequences=self.parameters + self.volume_manager.volumes, strict=True)
+                                       non_sequences=self.parameters + self.volume_manager.shared_variables, strict=True)
 
         self.graph_updates = updates
 
@@ -215,7 +217,7 @@ class GRU_Multistep_Gaussian(GRU):
 
         return regression_out
 
-    def make_sequence_generator(self, subject_id=0, use_max_component=False):
+    def make_sequence_generator(self, subject_id=0, use_max_component=False, rng_seed=1234, return_regression_output=False):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -223,6 +225,13 @@ class GRU_Multistep_Gaussian(GRU):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        use_max_component : bool, optional
+            Use the maximum of the probability distribution instead of sampling values
+        rng_seed : int, optional
+            Seed of the random generator used when sampling values. Default: 1234.
+        return_regression_output : bool, optional
+            If True, the generated function also returns the output of the regression layer
+            (i.e. the means and the log of the standard deviations). Default: False.
         """
 
         # Build the sequence generator as a theano function.
@@ -249,7 +258,7 @@ class GRU_Multistep_Gaussian(GRU):
             predictions = self.get_max_component_samples(distribution_params)
         else:
             # Sample value from distribution
-            srng = MRG_RandomStreams(seed=1234)
+            srng = MRG_RandomStreams(seed=rng_seed)
 
             batch_size = symb_x_t.shape[0]
             noise = srng.normal((batch_size, self.target_dims))
@@ -257,12 +266,18 @@ class GRU_Multistep_Gaussian(GRU):
             # predictions.shape : (batch_size, target_dims)
             predictions = self.get_stochastic_samples(distribution_params, noise)
 
-        f = theano.function(inputs=[symb_x_t] + states_h,
-                            outputs=[predictions] + list(new_states_h))
+        outputs = [predictions]
+        if return_regression_output:
+            # Unlike `distribution_params`, standard deviations are left in log space, like other models output them.
+            outputs.append(self.layer_regression.fprop(new_states_h[-1]))
+
+        f = compile_function(inputs=[symb_x_t] + states_h,
+                             outputs=outputs + list(new_states_h),
+                             cache=self.function_cache, name="sequence_generator")
 
         self.k = k_bak  # Restore original $k$.
 
-        def _gen(x_t, states, previous_direction=None):
+        def _gen(x_t, states, previous_direction=None, subject_ids=None):
             """ Returns the prediction for x_{t+1} for every
                 sequence in the batch given x_{t} and the current states
                 of the model h^{l}_{t}.
@@ -275,6 +290,8 @@ class GRU_Multistep_Gaussian(GRU):
                 Currrent states of the network.
             previous_direction : ndarray with shape (batch_size, 3)
                 If using previous direction, these should be added to the input
+            subject_ids : 1D array of shape (batch_size,), optional
+                ID of the subject of each sequence. Default: use `subject_id` for all of them.
 
             Returns
             -------
@@ -282,9 +299,14 @@ class GRU_Multistep_Gaussian(GRU):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, target_size)
+                Output of the regression layer, only if `return_regression_output` is True.
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
-            subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
+            if subject_ids is None:
+                subject_ids = [subject_id] * len(x_t)
+
+            subject_ids = np.asarray(subject_ids, dtype=floatX)[:, None]
 
             if not self.use_previous_direction:
                 x_t = np.c_[x_t, subject_ids]
@@ -293,7 +315,10 @@ class GRU_Multistep_Gaussian(GRU):
 
             results = f(x_t, *states)
             next_x_t = results[0]
-            new_states = results[1:]
+            new_states = results[len(outputs):]
+            if return_regression_output:
+                return next_x_t, new_states, results[1]
+
             return next_x_t, new_states
 
         return _gen
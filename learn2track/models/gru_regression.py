@@ -7,6 +7,7 @@ from smartlearner.interfaces import Loss
 from learn2track.models import GRU
 from learn2track.models.layers import LayerDense
 from learn2track.neurotools import get_neighborhood_directions
+from learn2track.function_cache import compile_function
 from learn2track.utils import l2distance
 
 floatX = theano.config.floatX
@@ -18,7 +19,7 @@ class GRU_Regression(GRU):
 
     def __init__(self, volume_manager, input_size, hidden_sizes, output_size, activation='tanh', use_previous_direction=False, predict_offset=False,
                  use_layer_normalization=False, drop_prob=0., use_zoneout=False, use_skip_connections=False, neighborhood_radius=None,
-                 learn_to_stop=False, seed=1234, **_):
+                 stack_neighborhood=False, learn_to_stop=False, seed=1234, **_):
         """
         Parameters
         ----------
@@ -46,12 +47,15 @@ class GRU_Regression(GRU):
             Use skip connections from the input to all hidden layers in the network, and from all hidden layers to the output layer
         neighborhood_radius : float
             Add signal in positions around the current streamline coordinate to the input (with given length in voxel space); None = no neighborhood
+        stack_neighborhood : bool
+            Gather the neighborhood from an atlas precomputed with the data of all neighbors (see `VolumeManager.get_neighborhood_atlas`)
         learn_to_stop : bool
             Predict whether the streamline being generated should stop or not
         seed : int
             Random seed used for dropout normalization
         """
         self.neighborhood_radius = neighborhood_radius
+        self.stack_neighborhood = stack_neighborhood
         self.model_input_size = input_size
         if self.neighborhood_radius:
             self.neighborhood_directions = get_neighborhood_directions(self.neighborhood_radius)
@@ -64,6 +68,8 @@ class GRU_Regression(GRU):
         self.input_size = input_size
 
         self.volume_manager = volume_manager
+        # If True, inputs given to `get_output` already hold the diffusion data (see `learn2track.feature_cache`).
+        self.use_cached_features = False
         self.output_size = output_size
         self.use_previous_direction = use_previous_direction
         self.predict_offset = predict_offset
@@ -93,6 +99,7 @@ class GRU_Regression(GRU):
         hyperparameters['use_previous_direction'] = self.use_previous_direction
         hyperparameters['predict_offset'] = self.predict_offset
         hyperparameters['neighborhood_radius'] = self.neighborhood_radius
+        hyperparameters['stack_neighborhood'] = self.stack_neighborhood
         hyperparameters['learn_to_stop'] = self.learn_to_stop
         return hyperparameters
 
@@ -104,47 +111,49 @@ class GRU_Regression(GRU):
 
         return all_params
 
-    def _fprop_step(self, Xi, *args):
+    def _get_fprop_input(self, Xi):
         # Xi.shape : (batch_size, 4)    *if self.use_previous_direction, Xi.shape : (batch_size,7)
         # coords + dwi ID (+ previous_direction)
 
         # coords : streamlines 3D coordinates.
         # coords.shape : (batch_size, 4) where the last column is a dwi ID.
-        # args.shape : n_layers * (batch_size, layer_size)
         batch_size = Xi.shape[0]
         coords = Xi[:, :4]
 
-        # Repeat coords and apply the neighborhood transformations
-        if self.neighborhood_radius:
-            # coords.shape : (batch_size*len(neighbors_positions), 4)
-            coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
-            coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
+        if self.neighborhood_radius and self.stack_neighborhood:
+            # The data of all neighbors are gathered at once from the precomputed neighborhood atlas.
+            # data_at_coords.shape : (batch_size, input_size*len(neighbors_positions))
+            data_at_coords = self.volume_manager.eval_at_coords(coords, neighborhood_radius=self.neighborhood_radius)
+        else:
+            # Repeat coords and apply the neighborhood transformations
+            if self.neighborhood_radius:
+                # coords.shape : (batch_size*len(neighbors_positions), 4)
+                coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
+                coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
 
-        # Get diffusion data.
-        # data_at_coords.shape : (batch_size, input_size)
-        data_at_coords = self.volume_manager.eval_at_coords(coords)
+            # Get diffusion data.
+            # data_at_coords.shape : (batch_size, input_size)
+            data_at_coords = self.volume_manager.eval_at_coords(coords)
 
-        # Concatenate back the neighborhood data into a single input vector
-        if self.neighborhood_radius:
-            data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
+            # Concatenate back the neighborhood data into a single input vector
+            if self.neighborhood_radius:
+                data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
 
         if self.use_previous_direction:
             # previous_direction.shape : (batch_size, 3)
             previous_direction = Xi[:, 4:]
-            fprop_input = T.concatenate([data_at_coords, previous_direction], axis=1)
-        else:
-            fprop_input = data_at_coords
+            return T.concatenate([data_at_coords, previous_direction], axis=1)
 
-        # Hidden state to be passed to the next GRU iteration (next _fprop call)
-        # next_hidden_state.shape : n_layers * (batch_size, layer_size)
-        next_hidden_state = super()._fprop(fprop_input, *args)
+        return data_at_coords
 
+    def _get_outputs(self, hidden_states, Xi):
+        """ Outputs of the model given the states of its hidden layers and its inputs `Xi`, the previous direction being last. """
         # Compute the direction to follow for step (t)
-        output_layer_input = T.concatenate(next_hidden_state, axis=-1) if self.use_skip_connections else next_hidden_state[-1]
+        output_layer_input = T.concatenate(hidden_states, axis=-1) if self.use_skip_connections else hidden_states[-1]
         regression_out = self.layer_regression.fprop(output_layer_input)
 
         if self.predict_offset:
-            regression_out += previous_direction  # Skip-connection from the previous direction.
+            regression_out += Xi[:, -3:]  # Skip-connection from the previous direction.
 
         outputs = (regression_out,)
 
@@ -152,40 +161,65 @@ class GRU_Regression(GRU):
             stopping_out = self.layer_stopping.fprop(output_layer_input)
             outputs = (stopping_out, regression_out)
 
-        return next_hidden_state + outputs
+        return outputs
+
+    def _fprop_step(self, Xi, *args):
+        # args.shape : n_layers * (batch_size, layer_size)
+        fprop_input = self._get_fprop_input(Xi)
+
+        # Hidden state to be passed to the next GRU iteration (next _fprop call)
+        # next_hidden_state.shape : n_layers * (batch_size, layer_size)
+        next_hidden_state = super()._fprop(fprop_input, *args)
+        return next_hidden_state + self._get_outputs(next_hidden_state, Xi)
 
     def get_output(self, X):
         # X.shape : (batch_size, seq_len, n_features=[4|7])
         # For tractography n_features is (x,y,z) + (dwi_id,) + [previous_direction]
+        # or, if self.use_cached_features, the diffusion data + [previous_direction]
+        batch_size, seq_len = X.shape[0], X.shape[1]
+
+        # With teacher forcing, the coordinates of every timestep are known beforehand. Diffusion data
+        # are thus gathered, and projected by the first layer, for all timesteps at once. Only the
+        # recurrence is left to the scan, timestep-major.
+        # X_flat.shape : (seq_len*batch_size, n_features)
+        X_flat = T.transpose(X, axes=(1, 0, 2)).reshape((-1, X.shape[-1]))
+        fprop_input = X_flat if self.use_cached_features else self._get_fprop_input(X_flat)
+        inputs_proj = self.layers[0].project_inputs(fprop_input)
 
         outputs_info_h = []
         for hidden_size in self.hidden_sizes:
-            outputs_info_h.append(T.zeros((X.shape[0], hidden_size)))
-
-        outputs_info = outputs_info_h + [None]
-        if self.learn_to_stop:
-            outputs_info += [None]
+            outputs_info_h.append(T.zeros((batch_size, hidden_size)))
 
-        results, updates = theano.scan(fn=self._fprop_step,
-                                       # We want to scan over sequence elements, not the examples.
-                                       sequences=[T.transpose(X, axes=(1, 0, 2))],
-                                       outputs_info=outputs_info,
-                                       non_sequences=self.parameters + self.volume_manager.volumes,
+        results, updates = theano.scan(fn=self._fprop_projected,
+                                       sequences=[fprop_input.reshape((seq_len, batch_size, -1)),
+                                                  inputs_proj.reshape((seq_len, batch_size, -1))],
+                                       outputs_info=outputs_info_h,
+                                       non_sequences=self.parameters,
                                        strict=True)
 
+        if len(self.hidden_sizes) == 1:
+            results = [results]
+
         self.graph_updates = updates
+
+        # The output layers do not feed back into the recurrence either, apply them on all timesteps at once.
+        # hidden_states.shape : n_layers * (seq_len*batch_size, layer_size)
+        hidden_states = [h.reshape((-1, h.shape[-1])) for h in results]
+        outputs = self._get_outputs(hidden_states, X_flat)
+
         # Put back the examples so they are in the first dimension.
         # regression_out.shape : (batch_size, seq_len, target_size=3)
-        self.regression_out = T.transpose(results[-1], axes=(1, 0, 2))
+        outputs = [T.transpose(out.reshape((seq_len, batch_size, -1)), axes=(1, 0, 2)) for out in outputs]
+        self.regression_out = outputs[-1]
         model_output = self.regression_out
 
         if self.learn_to_stop:
-            self.stopping_out = T.transpose(results[-2], axes=(1, 0, 2))
+            self.stopping_out = outputs[-2]
             model_output = (self.stopping_out, self.regression_out)
 
         return model_output
 
-    def make_sequence_generator(self, subject_id=0, **_):
+    def make_sequence_generator(self, subject_id=0, return_regression_output=False, **_):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -193,6 +227,9 @@ class GRU_Regression(GRU):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        return_regression_output : bool, optional
+            If True, the generated function also returns the output of the regression layer
+            (i.e. the predicted directions). Default: False.
         """
 
         # Build the sequence generator as a theano function.
@@ -211,10 +248,11 @@ class GRU_Regression(GRU):
         if self.learn_to_stop:
             predictions = new_states[-2:]
 
-        f = theano.function(inputs=[symb_x_t] + states_h,
-                            outputs=list(predictions) + list(new_states_h))
+        f = compile_function(inputs=[symb_x_t] + states_h,
+                             outputs=list(predictions) + list(new_states_h),
+                             cache=self.function_cache, name="sequence_generator")
 
-        def _gen(x_t, states, previous_direction=None):
+        def _gen(x_t, states, previous_direction=None, subject_ids=None):
             """ Returns the prediction for x_{t+1} for every
                 sequence in the batch given x_{t} and the current states
                 of the model h^{l}_{t}.
@@ -227,6 +265,8 @@ class GRU_Regression(GRU):
                 Currrent states of the network.
             previous_direction : ndarray with shape (batch_size, 3)
                 If using previous direction, these should be added to the input
+            subject_ids : 1D array of shape (batch_size,), optional
+                ID of the subject of each sequence. Default: use `subject_id` for all of them.
 
             Returns
             -------
@@ -234,9 +274,14 @@ class GRU_Regression(GRU):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, 3)
+                Output of the regression layer, only if `return_regression_output` is True.
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
-            subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
+            if subject_ids is None:
+                subject_ids = [subject_id] * len(x_t)
+
+            subject_ids = np.asarray(subject_ids, dtype=floatX)[:, None]
 
             if not self.use_previous_direction:
                 x_t = np.c_[x_t, subject_ids]
@@ -254,6 +299,9 @@ class GRU_Regression(GRU):
                 new_states = results[1:]
                 output = next_x_t
 
+            if return_regression_output:
+                return output, new_states, next_x_t
+
             return output, new_states
 
         return _gen
@@ -291,7 +291,18 @@ class LayerGRU(object):
     def parameters(self):
         return [self.W, self.b, self.U, self.Uh]
 
+    def project_inputs(self, X):
+        """ Input part of the preactivations (z, r and h concatenated), independent of the recurrence.
+
+        `X` can hold the inputs of several timesteps, e.g. to project them all at once.
+        """
+        return T.dot(X, self.W) + self.b
+
     def fprop(self, Xi, last_h, drop_states=None, drop_value=1.):
+        return self.fprop_projected(self.project_inputs(Xi), last_h, drop_states, drop_value)
+
+    def fprop_projected(self, Xi, last_h, drop_states=None, drop_value=1.):
+        # Xi should be the projected inputs (see `project_inputs`)
         # drop_states should be a mask for zoned out or dropped values in the hidden states
         # drop_value should be 1 for zoneout and 0 for dropout
         def slice_(x, no):
@@ -303,7 +314,6 @@ class LayerGRU(object):
 
             return x[:, no*self.hidden_size: (no+1)*self.hidden_size]
 
-        Xi = (T.dot(Xi, self.W) + self.b)
         preactivation = slice_(Xi, 'zr') + T.dot(last_h, self.U)
 
         gate_z = T.nnet.sigmoid(slice_(preactivation, 'z'))  # Update gate
@@ -364,7 +374,24 @@ class LayerGruNormalized(object):
     def parameters(self):
         return [self.W, self.b_x, self.b_u, self.b_uh, self.U, self.Uh, self.g_x, self.g_u, self.g_uh]
 
+    def _layer_normalize(self, x, g, b):
+        mean = T.mean(x, axis=-1, keepdims=True)
+        std = T.sqrt(T.var(x, axis=-1, keepdims=True) + self.eps)
+        x_normalized = (x - mean) / (std + self.eps)
+        return g * x_normalized + b
+
+    def project_inputs(self, X):
+        """ Input part of the preactivations (z, r and h concatenated), independent of the recurrence.
+
+        `X` can hold the inputs of several timesteps, e.g. to project them all at once.
+        """
+        return self._layer_normalize(T.dot(X, self.W), self.g_x, self.b_x)
+
     def fprop(self, Xi, last_h, drop_states=None, drop_value=1.):
+        return self.fprop_projected(self.project_inputs(Xi), last_h, drop_states, drop_value)
+
+    def fprop_projected(self, Xi, last_h, drop_states=None, drop_value=1.):
+        # Xi should be the projected inputs (see `project_inputs`)
         # drop_states should be a mask for zoned out or dropped values in the hidden states
         # drop_value should be 1 for zoneout and 0 for dropout
         def slice_(x, no):
@@ -376,13 +403,7 @@ class LayerGruNormalized(object):
 
             return x[:, no*self.hidden_size: (no+1)*self.hidden_size]
 
-        def layer_normalize(x, g, b):
-            mean = T.mean(x, axis=1, keepdims=True)
-            std = T.sqrt(T.var(x, axis=1, keepdims=True) + self.eps)
-            x_normalized = (x - mean) / (std + self.eps)
-            return g * x_normalized + b
-
-        Xi = layer_normalize(T.dot(Xi, self.W), self.g_x, self.b_x)
+        layer_normalize = self._layer_normalize
         X_zr = slice_(Xi, 'zr')
         preactivation = X_zr + layer_normalize(T.dot(last_h, self.U), self.g_u, self.b_u)
 
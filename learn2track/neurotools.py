@@ -1,9 +1,8 @@
+import struct
 from collections import OrderedDict
 
 import nibabel as nib
 import numpy as np
-import theano
-import theano.tensor as T
 from dipy.align.bundlemin import distance_matrix_mdf
 from dipy.core.sphere import Sphere, HemiSphere
 from dipy.data import get_sphere
@@ -11,11 +10,12 @@ from dipy.reconst.shm import sph_harm_lookup, smooth_pinv
 from dipy.segment.quickbundles import QuickBundles
 from dipy.tracking.streamline import set_number_of_points
 from scipy.ndimage import map_coordinates
-from smartlearner.utils import sharedX
 
-from learn2track.interpolation import eval_volume_at_3d_coordinates_in_theano
+# Theano is only imported by `VolumeManager`, so tracking with NumPy (see `learn2track.numpy_inference`) does not need it.
+from learn2track.numpy_inference import pack_volume_corners
 
-floatX = theano.config.floatX
+# Ways a `VolumeManager` can store the volumes it gathers data from.
+VOLUME_LAYOUTS = ["flat", "corners"]
 
 
 class TractographyData(object):
@@ -149,34 +149,189 @@ class TractographyData(object):
 
 
 class VolumeManager(object):
-    def __init__(self):
-        self.volumes = []
+    """ Diffusion volumes of the subjects, packed in a single atlas.
+
+    Volumes are flattened over their spatial dimensions and stacked in one shared
+    buffer (`atlas`). Small lookup tables give the offset, the shape and the strides of
+    each volume in it, so data of any mix of subjects are gathered at once (see `eval_at_coords`).
+
+    Models adding the data around each coordinate (see `get_neighborhood_directions`) can
+    also use atlases whose channels already hold the data at every neighbor of each voxel
+    (see `get_neighborhood_atlas`): one gather of 7*C values instead of seven gathers of C values.
+
+    Parameters
+    ----------
+    layout : {'flat', 'corners'}, optional
+        How the data are read by `eval_at_coords`. 'flat' gathers the eight corners surrounding
+        each coordinate from `atlas`. 'corners' reads them contiguously from atlases storing
+        the 2x2x2 block of corners of each voxel (see `pack_volume_corners`), about 8 times as
+        large. Both give the same values. Default: 'flat'.
+    """
+    def __init__(self, layout="flat"):
+        import theano
+
+        if layout not in VOLUME_LAYOUTS:
+            raise ValueError("Unknown volume layout: {} (supported: {}).".format(layout, ", ".join(VOLUME_LAYOUTS)))
+
+        self.layout = layout
+        self.dtype = theano.config.floatX
+        self.atlas = None
+        self.volumes_offsets = []
+        self.volumes_shapes = []
         self.volumes_strides = []
 
+        # Atlases of the data stacked over a neighborhood, indexed by its radius.
+        self.neighborhood_atlases = OrderedDict()
+
+        # Atlases packed by corners, indexed by the radius of their neighborhood (None for `atlas`).
+        self.corners_atlases = OrderedDict()
+        self.corners_offsets = []
+        self.corners_strides = []
+
+        # Lookup tables, indexed by volume ID.
+        self._offsets_table = theano.shared(np.zeros((0,), dtype="int64"), name='volumes_offsets')
+        self._shapes_table = theano.shared(np.zeros((0, 3), dtype="int64"), name='volumes_shapes')
+        self._strides_table = theano.shared(np.zeros((0, 3), dtype="int64"), name='volumes_strides')
+        self._corners_offsets_table = theano.shared(np.zeros((0,), dtype="int64"), name='corners_offsets')
+        self._corners_strides_table = theano.shared(np.zeros((0, 3), dtype="int64"), name='corners_strides')
+
     @property
     def data_dimension(self):
-        return self.volumes[0].get_value().shape[-1]
+        return self.atlas.get_value(borrow=True, return_internal_type=True).shape[-1]
+
+    @property
+    def nb_volumes(self):
+        return len(self.volumes_offsets)
+
+    @property
+    def shared_variables(self):
+        """ Shared variables `eval_at_coords` depends on (e.g. to give to `theano.scan` as non-sequences). """
+        return ([self.atlas, self._offsets_table, self._shapes_table, self._strides_table,
+                 self._corners_offsets_table, self._corners_strides_table]
+                + list(self.neighborhood_atlases.values()) + list(self.corners_atlases.values()))
 
     def register(self, volume):
-        volume_id = len(self.volumes)
-        shape = np.array(volume.shape[:-1], dtype=floatX)
+        from smartlearner.utils import sharedX
+
+        volume_id = self.nb_volumes
+        shape = np.array(volume.shape[:-1], dtype=self.dtype)
         strides = np.r_[1, np.cumprod(shape[::-1])[:-1]][::-1]
+        data = volume.reshape((-1, volume.shape[-1])).astype(self.dtype)
+
+        if self.atlas is None:
+            self.volumes_offsets.append(0)
+            self.atlas = sharedX(data, name='atlas')
+        else:
+            # Sanity check: make sure the size of the last dimension is the same for all volumes.
+            assert self.data_dimension == volume.shape[-1]
+            atlas = self.atlas.get_value(borrow=True)
+            self.volumes_offsets.append(len(atlas))
+            self.atlas.set_value(np.concatenate([atlas, data]), borrow=True)
+
+        # Packed by corners, a volume has one more block than voxels along each axis (see `pack_volume_corners`).
+        corners_shape = shape + 1
+        corners_offset = 0 if volume_id == 0 else self.corners_offsets[-1] + int(np.prod(self.volumes_shapes[-1] + 1))
+        self.corners_offsets.append(corners_offset)
+        self.corners_strides.append(np.r_[1, np.cumprod(corners_shape[::-1])[:-1]][::-1])
+
+        self.volumes_shapes.append(shape)
         self.volumes_strides.append(strides)
-        self.volumes.append(sharedX(volume, name='volume_{}'.format(volume_id)))
+        self._offsets_table.set_value(np.array(self.volumes_offsets, dtype="int64"))
+        self._shapes_table.set_value(np.array(self.volumes_shapes, dtype="int64"))
+        self._strides_table.set_value(np.array(self.volumes_strides, dtype="int64"))
+        self._corners_offsets_table.set_value(np.array(self.corners_offsets, dtype="int64"))
+        self._corners_strides_table.set_value(np.array(self.corners_strides, dtype="int64"))
+
+        # Keep the derived atlases in sync, graphs using them stay valid.
+        for radius, neighborhood_atlas in self.neighborhood_atlases.items():
+            neighborhood_atlas.set_value(self._stack_neighborhood(radius), borrow=True)
+
+        for radius, corners_atlas in self.corners_atlases.items():
+            corners_atlas.set_value(self._pack_corners(radius), borrow=True)
+
+        if self.layout == "corners":
+            self.get_corners_atlas()  # Packed as soon as possible, e.g. to be in `shared_variables` before building a scan.
 
-        # Sanity check: make sure the size of the last dimension is the same for all volumes.
-        assert self.data_dimension == volume.shape[-1]
         return volume_id
 
-    def eval_at_coords(self, coords):
-        data_at_coords = T.zeros((coords.shape[0], self.volumes[0].shape[-1]))
-        for i, (volume, strides) in enumerate(zip(self.volumes, self.volumes_strides)):
-            selection = T.eq(coords[:, 3], i).nonzero()[0]  # Theano's way of doing: coords[:, 3] == i
-            selected_coords = coords[selection, :3]
-            data_at_selected_coords = eval_volume_at_3d_coordinates_in_theano(volume, selected_coords, strides=strides)
-            data_at_coords = T.set_subtensor(data_at_coords[selection], data_at_selected_coords)
+    def _stack_neighborhood(self, radius):
+        atlas = self.atlas.get_value(borrow=True)
+        directions = get_neighborhood_directions(radius)
+
+        stacked_volumes = []
+        for offset, shape in zip(self.volumes_offsets, self.volumes_shapes):
+            shape = tuple(int(s) for s in shape)
+            volume = atlas[offset:offset + int(np.prod(shape))].reshape(shape + (-1,))
+            stacked_volume = np.concatenate([shift_volume(volume, direction) for direction in directions], axis=-1)
+            stacked_volumes.append(stacked_volume.reshape((-1, stacked_volume.shape[-1])))
+
+        return np.concatenate(stacked_volumes).astype(self.dtype)
+
+    def get_neighborhood_atlas(self, radius):
+        """ Returns the atlas whose channels hold the data at every neighbor of each voxel, computing it if needed.
+
+        Row `i` of the returned atlas is the concatenation of the data of row `i` of `atlas` shifted
+        by each direction of `get_neighborhood_directions(radius)`, i.e. the input of a model using
+        that neighborhood at the center of a voxel. Its memory footprint is 7 times that of `atlas`.
+
+        Notes
+        -----
+        Interpolating this atlas at a coordinate equals gathering the neighbors of that coordinate
+        in `atlas` when `radius` is a whole number of voxels. Otherwise, interpolated neighbors are
+        interpolated once more, which slightly smooths them along the axis of their direction.
+        """
+        from smartlearner.utils import sharedX
+
+        radius = float(radius)
+        if radius not in self.neighborhood_atlases:
+            self.neighborhood_atlases[radius] = sharedX(self._stack_neighborhood(radius), name='neighborhood_atlas_{}'.format(radius))
+
+        return self.neighborhood_atlases[radius]
+
+    def _pack_corners(self, neighborhood_radius):
+        atlas = self.atlas if neighborhood_radius is None else self.get_neighborhood_atlas(neighborhood_radius)
+        atlas = atlas.get_value(borrow=True)
 
-        return data_at_coords
+        corners_volumes = []
+        for offset, shape in zip(self.volumes_offsets, self.volumes_shapes):
+            shape = tuple(int(s) for s in shape)
+            volume = atlas[offset:offset + int(np.prod(shape))].reshape(shape + (-1,))
+            corners_volumes.append(pack_volume_corners(volume))
+
+        return np.concatenate(corners_volumes).astype(self.dtype)
+
+    def get_corners_atlas(self, neighborhood_radius=None):
+        """ Returns `atlas` (or the neighborhood atlas of `neighborhood_radius`) packed by corners, computing it if needed.
+
+        Volumes are packed with `pack_volume_corners`: their blocks start at `corners_offsets`
+        and are flattened with `corners_strides`.
+        """
+        from smartlearner.utils import sharedX
+
+        if neighborhood_radius is not None:
+            neighborhood_radius = float(neighborhood_radius)
+
+        if neighborhood_radius not in self.corners_atlases:
+            name = 'corners_atlas' if neighborhood_radius is None else 'corners_neighborhood_atlas_{}'.format(neighborhood_radius)
+            self.corners_atlases[neighborhood_radius] = sharedX(self._pack_corners(neighborhood_radius), name=name)
+
+        return self.corners_atlases[neighborhood_radius]
+
+    def eval_at_coords(self, coords, neighborhood_radius=None):
+        """ Evaluates the data of the volumes at `coords` (see `eval_atlas_at_3d_coordinates_in_theano`).
+
+        If `neighborhood_radius` is provided, the data at all neighbors of each coordinate are gathered
+        at once from the atlas returned by `get_neighborhood_atlas`.
+        """
+        from learn2track.interpolation import eval_atlas_at_3d_coordinates_in_theano, eval_corners_atlas_at_3d_coordinates_in_theano
+
+        if self.layout == "corners":
+            return eval_corners_atlas_at_3d_coordinates_in_theano(self.get_corners_atlas(neighborhood_radius), coords, self._corners_offsets_table,
+                                                                  self._shapes_table, self._corners_strides_table)
+
+        atlas = self.atlas if neighborhood_radius is None else self.get_neighborhood_atlas(neighborhood_radius)
+        return eval_atlas_at_3d_coordinates_in_theano(atlas, coords, self._offsets_table,
+                                                      self._shapes_table, self._strides_table)
 
 
 class MaskClassifierData(object):
@@ -297,6 +452,44 @@ def map_coordinates_3d_4d(input_array, indices, affine=None, order=1):
         return np.ascontiguousarray(np.array(values_4d).T)
 
 
+def shift_volume(volume, shift):
+    """ Evaluates a volume at the coordinates of its voxels shifted by `shift`, using trilinear interpolation.
+
+    Trilinear interpolation is separable: every axis is interpolated in turn, with whole
+    slices of the volume at once. Out-of-bounds voxels are clipped to the border of the
+    volume, the same way `eval_atlas_at_3d_coordinates_in_theano` does.
+
+    Parameters
+    ----------
+    volume : 4D array
+        Data volume.
+    shift : array of shape (3,)
+        Shift to apply, in voxel space.
+
+    Returns
+    -------
+    shifted_volume : 4D array
+        Volume such that `shifted_volume[i, j, k]` is `volume` evaluated at `(i, j, k) + shift`.
+    """
+    shifted_volume = volume
+    for axis, s in enumerate(shift):
+        if s == 0:
+            continue
+
+        size = volume.shape[axis]
+        floor = int(np.floor(s))
+        d = s - floor
+        indices = np.arange(size) + floor
+        slices = np.take(shifted_volume, np.clip(indices, 0, size - 1), axis=axis)
+        if d > 0:
+            next_slices = np.take(shifted_volume, np.clip(indices + 1, 0, size - 1), axis=axis)
+            slices = (1 - d) * slices + d * next_slices
+
+        shifted_volume = slices
+
+    return shifted_volume
+
+
 def eval_volume_at_3d_coordinates(volume, coords):
     """ Evaluates the volume data at the given coordinates using trilinear interpolation.
 
@@ -554,3 +747,135 @@ def get_neighborhood_directions(radius):
     axes = np.identity(3)
     directions = np.concatenate(([[0, 0, 0]], axes, -axes)) * radius
     return directions
+
+
+def _iter_tck_endpoints(filename, chunk_size):
+    """ Yields the first and last points of the streamlines of a .tck file, a chunk of points at a time. """
+    with open(filename, 'rb') as f:
+        if f.readline().strip() != b"mrtrix tracks":
+            raise ValueError("{} is not a TCK file.".format(filename))
+
+        header = {}
+        for line in f:
+            line = line.decode("latin-1").strip()
+            if line == "END":
+                break
+
+            key, _, value = line.partition(":")
+            header[key.strip()] = value.strip()
+
+        datatype = header.get("datatype", "Float32LE")
+        dtype = np.dtype(("<" if datatype.endswith("LE") else ">") + ("f8" if datatype.startswith("Float64") else "f4"))
+        f.seek(int(header["file"].split()[1]))
+
+        # Points are separated by a row of NaN between streamlines and the file ends with a row of infinity.
+        # The last row read is kept for the next chunk since we need to know what comes after it.
+        leftover = np.zeros((0, 3), dtype=dtype)
+        carried_starts = np.zeros((0, 3), dtype=dtype)  # First point of a streamline not finished yet.
+        in_streamline = False
+        at_end = False
+        while not at_end:
+            data = np.fromfile(f, dtype=dtype, count=3 * chunk_size)
+            at_end = len(data) < 3 * chunk_size
+            rows = np.concatenate([leftover, data[:len(data) // 3 * 3].reshape((-1, 3))])
+
+            end_of_file = np.flatnonzero(np.isinf(rows[:, 0]))
+            if len(end_of_file) > 0:
+                rows = rows[:end_of_file[0]]
+                at_end = True
+
+            leftover = rows[len(rows):]
+            if not at_end:
+                rows, leftover = rows[:-1], rows[-1:]
+
+            is_delimiter = np.isnan(rows[:, 0])
+            is_point = np.logical_not(is_delimiter)
+            follows_delimiter = np.r_[not in_streamline, is_delimiter[:-1]]
+            precedes_delimiter = np.r_[is_delimiter[1:], at_end or np.isnan(leftover[0, 0])]
+
+            starts = np.concatenate([carried_starts, rows[is_point & follows_delimiter]])
+            ends = rows[is_point & precedes_delimiter]
+            carried_starts = starts[len(ends):]
+            if len(rows) > 0:
+                in_streamline = is_point[-1]
+
+            yield starts[:len(ends)], ends
+
+
+def _iter_trk_endpoints(filename, header, chunk_size):
+    """ Yields the first and last points of the streamlines of a .trk file (in voxmm), a chunk of values at a time. """
+    endianness = header.get(nib.streamlines.Field.ENDIANNESS, "<")
+    point_size = 4 * (3 + int(header[nib.streamlines.Field.NB_SCALARS_PER_POINT]))
+    properties_size = 4 * int(header[nib.streamlines.Field.NB_PROPERTIES_PER_STREAMLINE])
+    nb_points_format = endianness + "i"
+
+    with open(filename, 'rb') as f:
+        f.seek(1000)  # Size of the TRK header.
+
+        # Every streamline is its number of points followed by its points (and their scalars) then its properties.
+        # Only those numbers are read one by one, points are gathered in a vectorized way once their offsets are known.
+        buffer = b""
+        at_end = False
+        while not at_end:
+            data = f.read(4 * chunk_size)
+            at_end = len(data) < 4 * chunk_size
+            buffer += data
+
+            pos = 0
+            first_points, last_points = [], []
+            while pos + 4 <= len(buffer):
+                nb_points = struct.unpack_from(nb_points_format, buffer, pos)[0]
+                record_size = 4 + nb_points * point_size + properties_size
+                if pos + record_size > len(buffer):
+                    break  # Streamline continues in the next chunk.
+
+                if nb_points > 0:
+                    first_points.append(pos + 4)
+                    last_points.append(pos + 4 + (nb_points - 1) * point_size)
+
+                pos += record_size
+
+            values = np.frombuffer(buffer, dtype=endianness + "f4", count=pos // 4)
+            xyz = np.arange(3)
+            yield (values[np.add.outer(np.array(first_points, dtype=np.int64) // 4, xyz)].reshape((-1, 3)),
+                   values[np.add.outer(np.array(last_points, dtype=np.int64) // 4, xyz)].reshape((-1, 3)))
+
+            buffer = buffer[pos:]
+
+
+def load_streamlines_endpoints(filename, chunk_size=2**20):
+    """ Loads the first and last points of every streamline of a tractogram (.tck|.trk).
+
+    The file is read a chunk at a time and only the endpoints are brought to RAS+mm space,
+    so the coordinates of all the streamlines are never held in memory.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the tractogram.
+    chunk_size : int, optional
+        Number of values (i.e. coordinates) read from the file at once.
+
+    Returns
+    -------
+    starts : ndarray of shape (n_streamlines, 3)
+        First point of every streamline (in RAS+mm).
+    ends : ndarray of shape (n_streamlines, 3)
+        Last point of every streamline (in RAS+mm).
+    """
+    if filename.endswith(".tck"):
+        # TCK points are already in RAS+mm.
+        chunks = list(_iter_tck_endpoints(filename, max(chunk_size // 3, 1)))
+        affine = np.eye(4)
+    elif filename.endswith(".trk"):
+        # Only the header is read when loading lazily.
+        header = nib.streamlines.load(filename, lazy_load=True).header
+        chunks = list(_iter_trk_endpoints(filename, header, chunk_size))
+        # TRK points are in voxmm space.
+        affine = nib.streamlines.trk.get_affine_trackvis_to_rasmm(header)
+    else:
+        raise ValueError("Unsupported tractogram format: {}".format(filename))
+
+    starts = np.concatenate([np.zeros((0, 3))] + [starts for starts, _ in chunks])
+    ends = np.concatenate([np.zeros((0, 3))] + [ends for _, ends in chunks])
+    return nib.affines.apply_affine(affine, starts), nib.affines.apply_affine(affine, ends)
@@ -0,0 +1,1063 @@
+"""
+Pure NumPy implementation of the models' sequence generators.
+
+Tracking calls the sequence generator once per step with small batches, so the
+per-call overhead of a Theano function dominates. The functions in this module
+run the same computations (trilinear sampling of the diffusion volume, GRU cells
+and output heads) directly with NumPy and BLAS, on buffers reused from step to step.
+The loss of the models can also be evaluated from the outputs recorded while tracking.
+
+This module does not depend on Theano: parameters are given as NumPy arrays,
+either copied from a model or loaded from the files it was saved to (see `load_numpy_model`).
+"""
+import json
+from os.path import join as pjoin
+
+import numpy as np
+
+# Corners offsets and interpolation basis, in the same order as `learn2track.interpolation`.
+B1 = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
+               [-1, 0, 0, 0, 1, 0, 0, 0],
+               [-1, 0, 1, 0, 0, 0, 0, 0],
+               [-1, 1, 0, 0, 0, 0, 0, 0],
+               [1, 0, -1, 0, -1, 0, 1, 0],
+               [1, -1, -1, 1, 0, 0, 0, 0],
+               [1, -1, 0, 0, -1, 1, 0, 0],
+               [-1, 1, 1, -1, 1, -1, -1, 1]], dtype="float32")
+
+idx = np.array([[0, 0, 0],
+                [0, 0, 1],
+                [0, 1, 0],
+                [0, 1, 1],
+                [1, 0, 0],
+                [1, 0, 1],
+                [1, 1, 0],
+                [1, 1, 1]], dtype="float32")
+
+SUPPORTED_MODELS = ("GRU_Regression", "GRU_Gaussian", "GRU_Mixture", "GRU_Multistep_Gaussian")
+LOSS_SUPPORTED_MODELS = ("GRU_Regression", "GRU_Gaussian", "GRU_Mixture")
+# Class of the model trained for each value of the hyperparameter 'model' (see `learn.py`).
+MODEL_CLASS_NAMES = {"gru_regression": "GRU_Regression",
+                     "gru_gaussian": "GRU_Gaussian",
+                     "gru_mixture": "GRU_Mixture",
+                     "gru_multistep": "GRU_Multistep_Gaussian"}
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def make_activation_function(name):
+    """ NumPy counterpart of `learn2track.factories.make_activation_function`. """
+    if name == "sigmoid":
+        return sigmoid
+    elif name == "identity":
+        return lambda x: x
+    elif name == "hinge":
+        return lambda x: np.maximum(x, 0.0)
+    elif name == "softplus":
+        return lambda x: np.logaddexp(0., x)
+    elif name == "tanh":
+        return np.tanh
+    elif name == "selu":
+        def selu(x):
+            # See "Self-normalizing Neural Networks": https://arxiv.org/abs/1706.02515
+            alpha = 1.6732632423543772848170429916717
+            scale = 1.0507009873554804934193349852946
+            return scale * np.where(x >= 0.0, x, alpha * (np.exp(np.minimum(x, 0.0)) - 1))
+
+        return selu
+
+    raise NotImplementedError("Unknown: " + str(name))
+
+
+class Workspace(object):
+    """ Preallocated buffers, grown when a bigger batch comes in and sliced otherwise. """
+    def __init__(self, dtype="float32"):
+        self.dtype = dtype
+        self._buffers = {}
+
+    def get(self, name, *shape):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[0] < shape[0] or buf.shape[1:] != shape[1:]:
+            buf = np.empty(shape, dtype=self.dtype)
+            self._buffers[name] = buf
+
+        return buf[:shape[0]]
+
+
+def eval_volume_at_3d_coordinates_in_numpy(volume, shape, strides, coords, workspace=None):
+    """ Evaluates the data volume at given coordinates using trilinear interpolation.
+
+    This function is a NumPy version of `learn2track.interpolation.eval_volume_at_3d_coordinates_in_theano`
+    (corners falling outside the volume are clipped to its border).
+
+    Parameters
+    ----------
+    volume : 2D array of shape (X*Y*Z, C)
+        Data volume flattened over its three spatial dimensions.
+    shape : ndarray of shape (3,)
+        Spatial shape of the volume.
+    strides : ndarray of shape (3,)
+        Strides of the flattened volume for each spatial dimension.
+    coords : ndarray of shape (N, 3)
+        3D coordinates where to evaluate the volume data.
+    workspace : :class:`Workspace` object, optional
+        Buffers to reuse for the output.
+
+    Returns
+    -------
+    values : ndarray of shape (N, C)
+    """
+    floor = np.floor(coords)
+
+    # Flat indices of the 8 corners surrounding each coordinate.
+    corners = floor[:, None, :] + idx
+    np.clip(corners, 0, shape - 1, out=corners)
+    indices = np.dot(corners, strides).astype(np.intp)
+
+    return _interpolate(volume, indices, coords - floor, workspace)
+
+
+def eval_atlas_at_3d_coordinates_in_numpy(atlas, offsets, shapes, strides, coords, volume_ids, workspace=None):
+    """ Evaluates the data volumes packed in an atlas at given coordinates using trilinear interpolation.
+
+    This function is a NumPy version of `learn2track.interpolation.eval_atlas_at_3d_coordinates_in_theano`.
+
+    Parameters
+    ----------
+    atlas : 2D array of shape (nb_voxels, C)
+        Data volumes, each one flattened over its three spatial dimensions, stacked one after the other.
+    offsets : 1D int array of shape (nb_volumes,)
+        First row of each volume in the atlas.
+    shapes : ndarray of shape (nb_volumes, 3)
+        Spatial shape of each volume.
+    strides : ndarray of shape (nb_volumes, 3)
+        Strides of each flattened volume for each spatial dimension.
+    coords : ndarray of shape (N, 3)
+        3D coordinates where to evaluate the data.
+    volume_ids : 1D int array of shape (N,)
+        ID of the volume to evaluate at each coordinate.
+    workspace : :class:`Workspace` object, optional
+        Buffers to reuse for the output.
+
+    Returns
+    -------
+    values : ndarray of shape (N, C)
+    """
+    if len(volume_ids) > 0 and np.all(volume_ids == volume_ids[0]):
+        # Single volume, its strides are the same for every coordinate.
+        i = int(volume_ids[0])
+        floor = np.floor(coords)
+        corners = floor[:, None, :] + idx
+        np.clip(corners, 0, shapes[i] - 1, out=corners)
+        indices = np.dot(corners, strides[i]).astype(np.intp)
+        indices += offsets[i]
+        return _interpolate(atlas, indices, coords - floor, workspace)
+
+    floor = np.floor(coords)
+    corners = floor[:, None, :] + idx
+    np.clip(corners, 0, shapes[volume_ids][:, None, :] - 1, out=corners)
+    indices = np.einsum('nkc,nc->nk', corners, strides[volume_ids]).astype(np.intp)
+    indices += offsets[volume_ids][:, None]
+    return _interpolate(atlas, indices, coords - floor, workspace)
+
+
+def pack_volume_corners(volume):
+    """ Stores, for each voxel of a volume, the data of the 2x2x2 block of voxels it is the first corner of.
+
+    Blocks start from voxel -1 along each axis, and voxels outside the volume are clipped to its border.
+    Every coordinate thus finds its eight (clipped) corners contiguously in a single block, see
+    `eval_corners_atlas_at_3d_coordinates_in_numpy`. The packed volume is about 8 times as large.
+
+    Parameters
+    ----------
+    volume : 4D array of shape (X, Y, Z, C)
+        Data volume.
+
+    Returns
+    -------
+    corners_volume : 2D array of shape ((X+1)*(Y+1)*(Z+1), 8*C)
+        Block of each voxel, flattened in C order. Corners are ordered like `idx`.
+    """
+    shape = volume.shape[:3]
+    corners_volume = np.empty(tuple(s + 1 for s in shape) + (8, volume.shape[-1]), dtype=volume.dtype)
+    for i, corner in enumerate(idx.astype(int)):
+        # Clipped indices of this corner for the blocks starting from voxel -1 to voxel s-1, along each axis.
+        indices = [np.clip(np.arange(-1, s) + c, 0, s - 1) for s, c in zip(shape, corner)]
+        corners_volume[:, :, :, i] = volume[np.ix_(*indices)]
+
+    return corners_volume.reshape((-1, 8 * volume.shape[-1]))
+
+
+def eval_corners_atlas_at_3d_coordinates_in_numpy(corners_atlas, offsets, shapes, strides, coords, volume_ids, workspace=None):
+    """ Evaluates the data volumes packed by corners in an atlas at given coordinates using trilinear interpolation.
+
+    This function is a NumPy version of `learn2track.interpolation.eval_corners_atlas_at_3d_coordinates_in_theano`.
+
+    Parameters
+    ----------
+    corners_atlas : 2D array of shape (nb_blocks, 8*C)
+        Packed data volumes (see `pack_volume_corners`), stacked one after the other.
+    offsets : 1D int array of shape (nb_volumes,)
+        First row of each packed volume in the atlas.
+    shapes : ndarray of shape (nb_volumes, 3)
+        Spatial shape of each volume (before packing).
+    strides : ndarray of shape (nb_volumes, 3)
+        Strides of each flattened packed volume for each spatial dimension.
+    coords : ndarray of shape (N, 3)
+        3D coordinates where to evaluate the data.
+    volume_ids : 1D int array of shape (N,)
+        ID of the volume to evaluate at each coordinate.
+    workspace : :class:`Workspace` object, optional
+        Buffers to reuse for the output.
+
+    Returns
+    -------
+    values : ndarray of shape (N, C)
+    """
+    N = len(coords)
+    floor = np.floor(coords)
+
+    # Block whose corners are the (clipped) corners surrounding each coordinate.
+    blocks = np.clip(floor, -1, shapes[volume_ids] - 1) + 1
+    indices = np.einsum('nc,nc->n', blocks, strides[volume_ids]).astype(np.intp)
+    indices += offsets[volume_ids]
+
+    # P.shape : (N, 8, C)
+    P = corners_atlas[indices].reshape((N, 8, -1))
+
+    # Weights of the corners, in closed form (ordered like `idx`).
+    d = (coords - floor).astype(corners_atlas.dtype)
+    w = np.stack([1 - d, d], axis=1)
+    weights = (w[:, :, None, None, 0] * w[:, None, :, None, 1] * w[:, None, None, :, 2]).reshape((N, 8))
+
+    out = None if workspace is None else workspace.get("interpolation", N, 1, P.shape[-1])
+    values = np.matmul(weights[:, None, :], P, out=out)
+    return values[:, 0]
+
+
+def _interpolate(volume, indices, d, workspace=None):
+    """ Interpolates the rows `indices` (N, 8) of a flattened volume at the offsets `d` (N, 3) from the first corner. """
+    N = len(indices)
+
+    # P.shape : (N, 8, C)
+    P = volume[indices]
+
+    dx, dy, dz = d[:, 0], d[:, 1], d[:, 2]
+    Q1 = np.stack([np.ones_like(dx), dx, dy, dz, dx*dy, dy*dz, dx*dz, dx*dy*dz], axis=1)
+    weights = np.dot(Q1, B1).astype(volume.dtype)
+
+    out = None if workspace is None else workspace.get("interpolation", N, 1, volume.shape[-1])
+    values = np.matmul(weights[:, None, :], P, out=out)
+    return values[:, 0]
+
+
+class NumpyDense(object):
+    """ Affine layer `activation(X.W + b)`, optionally L2-normalized (see `LayerDense`, `LayerRegression`). """
+    def __init__(self, W, b, activation="identity", normed=False):
+        self.W = W
+        self.b = b
+        self.activation_fct = make_activation_function(activation)
+        self.normed = normed
+
+    @classmethod
+    def from_layer(cls, layer):
+        return cls(layer.W.get_value(), layer.b.get_value(),
+                   activation=getattr(layer, 'activation', "identity"),
+                   normed=getattr(layer, 'normed', False))
+
+    @classmethod
+    def from_params(cls, params, name, activation="identity"):
+        return cls(params[name + '_W'], params[name + '_b'], activation=activation)
+
+    @property
+    def output_size(self):
+        return self.W.shape[1]
+
+    @property
+    def parameters(self):
+        return [self.W, self.b]
+
+    def fprop(self, X):
+        out = self.activation_fct(np.dot(X, self.W) + self.b)
+        if self.normed:
+            out /= np.sqrt(np.sum(out**2, axis=-1, keepdims=True) + 1e-8)
+
+        return out
+
+
+class NumpyGRU(object):
+    """ NumPy version of `LayerGRU.fprop` (no dropout/zoneout). """
+    def __init__(self, W, b, U, Uh, activation="tanh", name="GRU"):
+        self.W = W
+        self.b = b
+        self.U = U
+        self.Uh = Uh
+        self.hidden_size = U.shape[0]
+        self.activation_fct = make_activation_function(activation)
+        self.name = name
+
+    @classmethod
+    def from_layer(cls, layer):
+        return cls(layer.W.get_value(), layer.b.get_value(), layer.U.get_value(), layer.Uh.get_value(),
+                   activation=layer.activation, name=layer.name)
+
+    @classmethod
+    def from_params(cls, params, name, activation="tanh"):
+        return cls(params[name + '_W'], params[name + '_b'], params[name + '_U'], params[name + '_Uh'],
+                   activation=activation, name=name)
+
+    @property
+    def parameters(self):
+        return [self.W, self.b, self.U, self.Uh]
+
+    def fprop(self, Xi, last_h, workspace):
+        N, h = len(Xi), self.hidden_size
+
+        Xi_proj = np.dot(Xi, self.W, out=workspace.get(self.name + "_Xi", N, 3*h))
+        Xi_proj += self.b
+        preactivation = np.dot(last_h, self.U, out=workspace.get(self.name + "_zr", N, 2*h))
+        preactivation += Xi_proj[:, :2*h]
+
+        gates = sigmoid(preactivation)
+        gate_z = gates[:, :h]  # Update gate
+        gate_r = gates[:, h:]  # Reset gate
+
+        # Candidate activation
+        c = np.dot(last_h * gate_r, self.Uh, out=workspace.get(self.name + "_c", N, h))
+        c += Xi_proj[:, 2*h:]
+        c = self.activation_fct(c)
+
+        return last_h + gate_z * (c - last_h)
+
+
+class NumpyGruNormalized(NumpyGRU):
+    """ NumPy version of `LayerGruNormalized.fprop` (no dropout/zoneout). """
+    PARAMS_NAMES = ('W', 'U', 'Uh', 'b_x', 'b_u', 'b_uh', 'g_x', 'g_u', 'g_uh')
+
+    def __init__(self, W, U, Uh, b_x, b_u, b_uh, g_x, g_u, g_uh, activation="tanh", name="GRU", eps=1e-5):
+        super().__init__(W, b_x, U, Uh, activation=activation, name=name)
+        self.b_x, self.b_u, self.b_uh = b_x, b_u, b_uh
+        self.g_x, self.g_u, self.g_uh = g_x, g_u, g_uh
+        self.eps = eps
+
+    @classmethod
+    def from_layer(cls, layer):
+        params = {name: getattr(layer, name).get_value() for name in cls.PARAMS_NAMES}
+        return cls(activation=layer.activation, name=layer.name, eps=layer.eps, **params)
+
+    @classmethod
+    def from_params(cls, params, name, activation="tanh"):
+        return cls(activation=activation, name=name, **{param_name: params[name + '_' + param_name] for param_name in cls.PARAMS_NAMES})
+
+    @property
+    def parameters(self):
+        return [getattr(self, name) for name in self.PARAMS_NAMES]
+
+    def _layer_normalize(self, x, g, b):
+        mean = np.mean(x, axis=1, keepdims=True)
+        std = np.sqrt(np.var(x, axis=1, keepdims=True) + self.eps)
+        x -= mean
+        x /= std + self.eps
+        x *= g
+        x += b
+        return x
+
+    def fprop(self, Xi, last_h, workspace):
+        N, h = len(Xi), self.hidden_size
+
+        Xi_proj = self._layer_normalize(np.dot(Xi, self.W, out=workspace.get(self.name + "_Xi", N, 3*h)), self.g_x, self.b_x)
+        preactivation = self._layer_normalize(np.dot(last_h, self.U, out=workspace.get(self.name + "_zr", N, 2*h)), self.g_u, self.b_u)
+        preactivation += Xi_proj[:, :2*h]
+
+        gates = sigmoid(preactivation)
+        gate_z = gates[:, :h]  # Update gate
+        gate_r = gates[:, h:]  # Reset gate
+
+        # Candidate activation
+        c = self._layer_normalize(np.dot(last_h, self.Uh, out=workspace.get(self.name + "_c", N, h)), self.g_uh, self.b_uh)
+        c *= gate_r
+        c += Xi_proj[:, 2*h:]
+        c = self.activation_fct(c)
+
+        return last_h + gate_z * (c - last_h)
+
+
+class NumpyVolumeManager(object):
+    """ NumPy counterpart of `neurotools.VolumeManager`, for the models loaded with `load_numpy_model`.
+
+    Volumes are packed in an atlas, along with the same lookup tables, but in arrays instead of
+    Theano shared variables. Derived atlases (see `get_neighborhood_atlas` and `get_corners_atlas`)
+    are built when first needed.
+
+    Parameters
+    ----------
+    layout : {'flat', 'corners'}, optional
+        How the data are read (see `neurotools.VolumeManager`). Default: 'flat'.
+    dtype : str, optional
+        Type of the data in the atlases. Default: 'float32'.
+    """
+    def __init__(self, layout="flat", dtype="float32"):
+        from learn2track.neurotools import VOLUME_LAYOUTS
+
+        if layout not in VOLUME_LAYOUTS:
+            raise ValueError("Unknown volume layout: {} (supported: {}).".format(layout, ", ".join(VOLUME_LAYOUTS)))
+
+        self.layout = layout
+        self.dtype = dtype
+        self.atlas = None
+        self.volumes_offsets = []
+        self.volumes_shapes = []
+        self.volumes_strides = []
+        self.corners_offsets = []
+        self.corners_strides = []
+
+        # Derived atlases, indexed by the radius of their neighborhood (None for `atlas` packed by corners).
+        self.neighborhood_atlases = {}
+        self.corners_atlases = {}
+
+    @property
+    def data_dimension(self):
+        return self.atlas.shape[-1]
+
+    @property
+    def nb_volumes(self):
+        return len(self.volumes_offsets)
+
+    @property
+    def arrays(self):
+        """ Atlases built so far. """
+        return [self.atlas] + list(self.neighborhood_atlases.values()) + list(self.corners_atlases.values())
+
+    def register(self, volume):
+        volume_id = self.nb_volumes
+        shape = np.array(volume.shape[:-1], dtype=self.dtype)
+        data = volume.reshape((-1, volume.shape[-1])).astype(self.dtype)
+
+        if self.atlas is None:
+            self.volumes_offsets.append(0)
+            self.atlas = data
+        else:
+            # Sanity check: make sure the size of the last dimension is the same for all volumes.
+            assert self.data_dimension == volume.shape[-1]
+            self.volumes_offsets.append(len(self.atlas))
+            self.atlas = np.concatenate([self.atlas, data])
+
+        # Packed by corners, a volume has one more block than voxels along each axis (see `pack_volume_corners`).
+        corners_offset = 0 if volume_id == 0 else self.corners_offsets[-1] + int(np.prod(self.volumes_shapes[-1] + 1))
+        self.corners_offsets.append(corners_offset)
+        self.corners_strides.append(np.r_[1, np.cumprod((shape + 1)[::-1])[:-1]][::-1])
+        self.volumes_shapes.append(shape)
+        self.volumes_strides.append(np.r_[1, np.cumprod(shape[::-1])[:-1]][::-1])
+
+        # Derived atlases are built again, including the new volume, when next needed.
+        self.neighborhood_atlases.clear()
+        self.corners_atlases.clear()
+        return volume_id
+
+    def _get_volumes(self, atlas):
+        """ Returns the volumes packed in `atlas` (or in an atlas derived from it), with their spatial shape. """
+        volumes = []
+        for offset, shape in zip(self.volumes_offsets, self.volumes_shapes):
+            shape = tuple(int(s) for s in shape)
+            volumes.append(atlas[offset:offset + int(np.prod(shape))].reshape(shape + (-1,)))
+
+        return volumes
+
+    def get_neighborhood_atlas(self, radius):
+        """ Returns the atlas whose channels hold the data at every neighbor of each voxel, computing it if needed
+        (see `neurotools.VolumeManager.get_neighborhood_atlas`).
+        """
+        from learn2track.neurotools import get_neighborhood_directions, shift_volume
+
+        radius = float(radius)
+        if radius not in self.neighborhood_atlases:
+            directions = get_neighborhood_directions(radius)
+            stacked_volumes = [np.concatenate([shift_volume(volume, direction) for direction in directions], axis=-1)
+                               for volume in self._get_volumes(self.atlas)]
+            self.neighborhood_atlases[radius] = np.concatenate([stacked_volume.reshape((-1, stacked_volume.shape[-1]))
+                                                                for stacked_volume in stacked_volumes]).astype(self.dtype)
+
+        return self.neighborhood_atlases[radius]
+
+    def get_corners_atlas(self, neighborhood_radius=None):
+        """ Returns `atlas` (or the neighborhood atlas of `neighborhood_radius`) packed by corners, computing it if needed
+        (see `neurotools.VolumeManager.get_corners_atlas`).
+        """
+        if neighborhood_radius is not None:
+            neighborhood_radius = float(neighborhood_radius)
+
+        if neighborhood_radius not in self.corners_atlases:
+            atlas = self.atlas if neighborhood_radius is None else self.get_neighborhood_atlas(neighborhood_radius)
+            corners_volumes = [pack_volume_corners(volume) for volume in self._get_volumes(atlas)]
+            self.corners_atlases[neighborhood_radius] = np.concatenate(corners_volumes).astype(self.dtype)
+
+        return self.corners_atlases[neighborhood_radius]
+
+
+class NumpyModel(object):
+    """ Model saved by `GRU.save`, loaded without Theano (see `load_numpy_model`).
+
+    It has the attributes of the model used by the functions of this module, its layers
+    being :class:`NumpyGRU` (or :class:`NumpyGruNormalized`) and :class:`NumpyDense` objects.
+
+    Parameters
+    ----------
+    model_name : str
+        Class of the saved model, one of `SUPPORTED_MODELS`.
+    volume_manager : :class:`NumpyVolumeManager` object
+        Volumes the model gathers its inputs from.
+    hyperparams : dict
+        Hyperparameters of the saved model (see `GRU.hyperparameters`).
+    params : dict
+        Parameters of the saved model, indexed by name.
+    """
+    def __init__(self, model_name, volume_manager, hyperparams, params):
+        self.model_name = model_name
+        self.volume_manager = volume_manager
+        self.input_size = hyperparams['input_size']
+        hidden_sizes = hyperparams['hidden_sizes']
+        self.hidden_sizes = [hidden_sizes] if type(hidden_sizes) is int else hidden_sizes
+        self.output_size = hyperparams.get('output_size', hyperparams.get('target_dims'))
+        self.n_gaussians = hyperparams.get('n_gaussians')
+        self.use_skip_connections = hyperparams.get('use_skip_connections', False)
+        self.use_previous_direction = hyperparams.get('use_previous_direction', False)
+        self.predict_offset = hyperparams.get('predict_offset', False)
+        self.learn_to_stop = hyperparams.get('learn_to_stop', False)
+        self.neighborhood_radius = hyperparams.get('neighborhood_radius')
+        self.stack_neighborhood = hyperparams.get('stack_neighborhood', False)
+        self.drop_prob = 0.
+
+        self.model_input_size = self.input_size
+        if self.neighborhood_radius:
+            from learn2track.neurotools import get_neighborhood_directions
+            self.neighborhood_directions = get_neighborhood_directions(self.neighborhood_radius)
+            # Model input size is increased when using neighborhood
+            self.model_input_size = self.input_size * len(self.neighborhood_directions)
+
+        layer_class = NumpyGruNormalized if hyperparams.get('use_layer_normalization', False) else NumpyGRU
+        self.layers = [layer_class.from_params(params, "GRU{}".format(i), activation=hyperparams.get('activation', "tanh"))
+                       for i in range(len(self.hidden_sizes))]
+
+        # Output layers are named and activated like in the constructor of each model.
+        if model_name == "GRU_Regression":
+            self.layer_regression = NumpyDense.from_params(params, "GRU_Regression", activation="tanh" if self.predict_offset else "identity")
+        else:
+            self.layer_regression = NumpyDense.from_params(params, "Regression")
+
+        if self.learn_to_stop:
+            self.layer_stopping = NumpyDense.from_params(params, model_name + "_stopping", activation="sigmoid")
+
+    def __str__(self):
+        return "{} (NumPy), input size: {}, hidden sizes: {}".format(self.model_name, self.input_size, self.hidden_sizes)
+
+    @property
+    def parameters(self):
+        output_layers = [self.layer_regression] + ([self.layer_stopping] if self.learn_to_stop else [])
+        return [param for layer in self.layers + output_layers for param in layer.parameters]
+
+    def get_init_states(self, batch_size):
+        return [np.zeros((batch_size, hidden_size), dtype=self.volume_manager.dtype) for hidden_size in self.hidden_sizes]
+
+
+def load_numpy_model(experiment_path, hyperparams, volume_manager):
+    """ Loads the model of an experiment from the files it was saved to, without Theano.
+
+    Parameters
+    ----------
+    experiment_path : str
+        Folder of the experiment, where the model was saved (see `GRU.save`).
+    hyperparams : dict
+        Hyperparameters of the experiment, telling which model was trained.
+    volume_manager : :class:`NumpyVolumeManager` object
+        Volumes the model gathers its inputs from.
+
+    Returns
+    -------
+    model : :class:`NumpyModel` object
+    """
+    model_name = MODEL_CLASS_NAMES.get(hyperparams['model'])
+    if model_name is None:
+        raise ValueError("NumPy inference is not supported for {} (supported: {}).".format(hyperparams['model'], ", ".join(MODEL_CLASS_NAMES)))
+
+    loaddir = pjoin(experiment_path, model_name)
+    with open(pjoin(loaddir, "hyperparams.json")) as f:
+        model_hyperparams = json.load(f)
+
+    with np.load(pjoin(loaddir, "params.npz")) as params:
+        # Parameters take the type of the data, so that layers can write in the buffers of a `Workspace`.
+        params = {name: value.astype(volume_manager.dtype) for name, value in params.items()}
+
+    return NumpyModel(model_name, volume_manager, model_hyperparams, params)
+
+
+def get_model_name(model):
+    """ Returns the class of `model`, or of the model it was loaded from (see `NumpyModel`). """
+    return model.model_name if isinstance(model, NumpyModel) else type(model).__name__
+
+
+def _get_value(variable):
+    """ Returns a copy of the value of a Theano shared variable, or the array itself (see `NumpyVolumeManager`). """
+    return variable if isinstance(variable, np.ndarray) else variable.get_value()
+
+
+def _check_model(model):
+    model_name = get_model_name(model)
+    if model_name not in SUPPORTED_MODELS:
+        raise ValueError("NumPy inference is not supported for {} (supported: {}).".format(model_name, ", ".join(SUPPORTED_MODELS)))
+
+    if model.drop_prob:
+        raise ValueError("NumPy inference does not support dropout/zoneout; set `model.drop_prob = 0.` first.")
+
+
+def _make_numpy_gather(model, workspace):
+    """ Makes a function returning the diffusion data the inputs of `model` are made of, at given coordinates.
+
+    The atlas of `model.volume_manager` (or its neighborhood atlas, see `stack_neighborhood`) is copied once, along with its lookup tables,
+    in the layout of the volume manager.
+    """
+    volume_manager = model.volume_manager
+    neighborhood_radius = getattr(model, 'neighborhood_radius', None)
+    stacked_neighborhood_radius = None
+    if neighborhood_radius and getattr(model, 'stack_neighborhood', False):
+        # The data of all neighbors are gathered at once, like a model without neighborhood.
+        stacked_neighborhood_radius = neighborhood_radius
+        neighborhood_radius = None
+
+    eval_atlas = eval_atlas_at_3d_coordinates_in_numpy
+    if volume_manager.layout == "corners":
+        eval_atlas = eval_corners_atlas_at_3d_coordinates_in_numpy
+        atlas = _get_value(volume_manager.get_corners_atlas(stacked_neighborhood_radius))
+        offsets = np.array(volume_manager.corners_offsets, dtype=np.intp)
+        strides = np.array(volume_manager.corners_strides, dtype=atlas.dtype)
+    else:
+        atlas = _get_value(volume_manager.atlas)
+        if stacked_neighborhood_radius:
+            atlas = _get_value(volume_manager.get_neighborhood_atlas(stacked_neighborhood_radius))
+
+        offsets = np.array(volume_manager.volumes_offsets, dtype=np.intp)
+        strides = np.array(volume_manager.volumes_strides, dtype=atlas.dtype)
+
+    shapes = np.array(volume_manager.volumes_shapes, dtype=atlas.dtype)
+    neighborhood_directions = model.neighborhood_directions.astype(atlas.dtype) if neighborhood_radius else None
+
+    def _gather(x_t, subject_ids):
+        batch_size = len(x_t)
+        subject_ids = subject_ids.astype(np.intp, copy=False)
+
+        # Get diffusion data, including the neighborhood if needed.
+        coords = x_t
+        if neighborhood_radius:
+            coords = (np.repeat(x_t, len(neighborhood_directions), axis=0) + np.tile(neighborhood_directions, (batch_size, 1)))
+            subject_ids = np.repeat(subject_ids, len(neighborhood_directions))
+
+        data_at_coords = eval_atlas(atlas, offsets, shapes, strides, coords, subject_ids, workspace=workspace)
+        return data_at_coords.reshape((batch_size, -1))
+
+    _gather.dtype = atlas.dtype
+    return _gather
+
+
+def _make_numpy_fprop(model, workspace):
+    """ Makes a function running the layers of `model` on the diffusion data gathered by `_make_numpy_gather`. """
+    learn_to_stop = getattr(model, 'learn_to_stop', False)
+    if isinstance(model, NumpyModel):
+        layers, layer_regression = model.layers, model.layer_regression
+        layer_stopping = model.layer_stopping if learn_to_stop else None
+    else:
+        layers = [(NumpyGruNormalized if hasattr(layer, 'g_x') else NumpyGRU).from_layer(layer) for layer in model.layers]
+        layer_regression = NumpyDense.from_layer(model.layer_regression)
+        layer_stopping = NumpyDense.from_layer(model.layer_stopping) if learn_to_stop else None
+    use_skip_connections = model.use_skip_connections
+    use_previous_direction = model.use_previous_direction
+    predict_offset = getattr(model, 'predict_offset', False)
+
+    def _fprop(data_at_coords, states, previous_direction):
+        Xi = data_at_coords
+        if use_previous_direction:
+            Xi = np.concatenate([data_at_coords, previous_direction], axis=1)
+
+        new_states = []
+        input = Xi
+        for layer, last_h in zip(layers, states):
+            h = layer.fprop(input, last_h, workspace)
+            new_states.append(h)
+            input = np.concatenate([h, Xi], axis=-1) if use_skip_connections else h
+
+        output_layer_input = np.concatenate(new_states, axis=-1) if use_skip_connections else new_states[-1]
+        regression_out = layer_regression.fprop(output_layer_input)
+        if predict_offset:
+            regression_out += previous_direction  # Skip-connection from the previous direction.
+
+        stopping = layer_stopping.fprop(output_layer_input) if learn_to_stop else None
+        return regression_out, stopping, new_states
+
+    return _fprop
+
+
+def _make_numpy_sampler(model, use_max_component, rng):
+    """ Makes a function drawing directions from the output of the regression layer of `model`. """
+    model_name = get_model_name(model)
+
+    def _sample_gaussian(mu, sigma):
+        if use_max_component:
+            return mu
+
+        return mu + sigma * rng.normal(size=mu.shape).astype(mu.dtype)
+
+    def _get_samples(regression_out):
+        if model_name == "GRU_Regression":
+            return regression_out
+
+        elif model_name == "GRU_Gaussian":
+            return _sample_gaussian(regression_out[:, :3], np.exp(regression_out[:, 3:]))
+
+        elif model_name == "GRU_Multistep_Gaussian":
+            return _sample_gaussian(regression_out[:, :3], np.exp(regression_out[:, 3:6]))
+
+        elif model_name == "GRU_Mixture":
+            n = model.n_gaussians
+            logits = regression_out[:, :n]
+            mixture_weights = np.exp(logits - logits.max(axis=1, keepdims=True))
+            mixture_weights /= mixture_weights.sum(axis=1, keepdims=True)
+            means = regression_out[:, n:4*n].reshape((-1, n, 3))
+            xs = np.arange(len(regression_out))
+
+            if use_max_component:
+                return means[xs, np.argmax(mixture_weights, axis=1)]
+
+            # Pick one component per sequence by inverting the cumulative distribution.
+            cdf = np.cumsum(mixture_weights, axis=1)
+            choices = np.minimum(np.sum(cdf < rng.uniform(size=(len(cdf), 1)) * cdf[:, -1:], axis=1), n - 1)
+            stds = np.exp(regression_out[:, 4*n:7*n].reshape((-1, n, 3))[xs, choices])
+            return means[xs, choices] + stds * rng.normal(size=(len(xs), 3)).astype(means.dtype)
+
+    return _get_samples
+
+
+def make_numpy_sampler(model, use_max_component=False, rng_seed=1234):
+    """ Makes a NumPy function drawing directions from the output of the regression layer of `model`
+    (e.g. as returned by its sequence generator when built with `return_regression_output=True`).
+
+    Parameters
+    ----------
+    model : :class:`GRU` object
+        One of the models listed in `SUPPORTED_MODELS`, with dropout disabled.
+    use_max_component : bool, optional
+        Use the maximum of the probability distribution instead of sampling values
+    rng_seed : int, optional
+        Seed of the random generator used when sampling values. Default: 1234.
+    """
+    _check_model(model)
+    return _make_numpy_sampler(model, use_max_component, np.random.RandomState(rng_seed))
+
+
+def make_numpy_sequence_generator(model, subject_id=0, use_max_component=False, rng_seed=1234, return_regression_output=False):
+    """ Makes a NumPy function that returns the prediction for x_{t+1} for every
+    sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
+
+    The returned function has the same interface and outputs as the one built by
+    `model.make_sequence_generator`. Parameters and diffusion volumes are copied
+    out of `model` once; the stochastic samples are drawn with NumPy, hence they
+    differ from the ones drawn by Theano for the same `rng_seed`.
+
+    Parameters
+    ----------
+    model : :class:`GRU` object
+        One of the models listed in `SUPPORTED_MODELS`, with dropout disabled, or a :class:`ModelEnsemble`.
+    subject_id : int, optional
+        ID of the subject from which its diffusion data will be used. Default: 0.
+    use_max_component : bool, optional
+        Use the maximum of the probability distribution instead of sampling values
+    rng_seed : int, optional
+        Seed of the random generator used when sampling values. Default: 1234.
+    return_regression_output : bool, optional
+        If True, the returned function also returns the output of the regression layer. Default: False.
+    """
+    if isinstance(model, ModelEnsemble):
+        return make_numpy_ensemble_sequence_generator(model, subject_id=subject_id, use_max_component=use_max_component,
+                                                      rng_seed=rng_seed)
+
+    _check_model(model)
+    rng = np.random.RandomState(rng_seed)
+    workspace = Workspace(dtype=model.volume_manager.atlas.dtype)
+    _gather = _make_numpy_gather(model, workspace)
+    _fprop = _make_numpy_fprop(model, workspace)
+    _get_samples = _make_numpy_sampler(model, use_max_component, rng)
+    learn_to_stop = getattr(model, 'learn_to_stop', False)
+
+    def _gen(x_t, states, previous_direction=None, subject_ids=None):
+        """ Returns the prediction for x_{t+1} for every
+            sequence in the batch given x_{t} and the current states
+            of the model h^{l}_{t}.
+
+        Parameters
+        ----------
+        x_t : ndarray with shape (batch_size, 3)
+            Streamline coordinate (x, y, z).
+        states : list of 2D array of shape (batch_size, hidden_size)
+            Currrent states of the network.
+        previous_direction : ndarray with shape (batch_size, 3)
+            If using previous direction, these should be added to the input
+        subject_ids : 1D array of shape (batch_size,), optional
+            ID of the subject of each sequence. Default: use `subject_id` for all of them.
+
+        Returns
+        -------
+        next_x_t : ndarray with shape (batch_size, 3)
+            Directions to follow.
+        new_states : list of 2D array of shape (batch_size, hidden_size)
+            Updated states of the network after seeing x_t.
+        regression_output : ndarray with shape (batch_size, regression_layer_size)
+            Output of the regression layer, only if `return_regression_output` is True.
+        """
+        x_t = np.asarray(x_t, dtype=_gather.dtype)
+        if previous_direction is not None:
+            previous_direction = np.asarray(previous_direction, dtype=_gather.dtype)
+
+        if subject_ids is None:
+            subject_ids = np.full(len(x_t), subject_id)
+
+        regression_out, stopping, new_states = _fprop(_gather(x_t, np.asarray(subject_ids)), states, previous_direction)
+        next_x_t = _get_samples(regression_out)
+        output = (next_x_t, stopping) if learn_to_stop else next_x_t
+
+        if return_regression_output:
+            return output, new_states, regression_out
+
+        return output, new_states
+
+    return _gen
+
+
+class ModelEnsemble(object):
+    """ Several models tracking together, their predictions being combined at every step.
+
+    Models must take the same inputs and share the same `VolumeManager`: the diffusion data
+    is gathered once per step for all of them (see `make_numpy_ensemble_sequence_generator`).
+    The states of the ensemble are the ones of every model, concatenated in the order of `models`.
+
+    Parameters
+    ----------
+    models : list of :class:`GRU` objects
+        Models listed in `SUPPORTED_MODELS`, with dropout disabled.
+    combine : {'mean', 'mixture'}, optional
+        How predictions are combined. Default: 'mean'.
+    """
+    COMBINE_MODES = ("mean", "mixture")
+
+    def __init__(self, models, combine="mean"):
+        if combine not in self.COMBINE_MODES:
+            raise ValueError("Unknown way of combining predictions: {} (supported: {}).".format(combine, ", ".join(self.COMBINE_MODES)))
+
+        volume_manager = models[0].volume_manager
+        if any(model.volume_manager is not volume_manager for model in models):
+            raise ValueError("Models of an ensemble must share the same `VolumeManager`.")
+
+        if len(set((model.input_size, getattr(model, 'neighborhood_radius', None) or None, getattr(model, 'stack_neighborhood', False))
+                   for model in models)) > 1:
+            raise ValueError("Models of an ensemble must take the same inputs (including the neighborhood).")
+
+        self.models = list(models)
+        self.combine = combine
+        self.volume_manager = volume_manager
+        self.input_size = models[0].input_size
+        self.hidden_sizes = [hidden_size for model in models for hidden_size in model.hidden_sizes]
+        self.learn_to_stop = any(getattr(model, 'learn_to_stop', False) for model in models)
+
+    def __str__(self):
+        return "Ensemble ({}) of:\n".format(self.combine) + "\n".join(str(model) for model in self.models)
+
+    @property
+    def parameters(self):
+        return [param for model in self.models for param in model.parameters]
+
+    def get_init_states(self, batch_size):
+        return [state for model in self.models for state in model.get_init_states(batch_size)]
+
+    def make_sequence_generator(self, subject_id=0, use_max_component=False, rng_seed=1234, **_):
+        """ Same as `make_numpy_ensemble_sequence_generator`; there is no Theano version. """
+        return make_numpy_ensemble_sequence_generator(self, subject_id=subject_id, use_max_component=use_max_component, rng_seed=rng_seed)
+
+
+def _get_max_component_weights(model, regression_out):
+    """ Returns the mixture weight of the most likely component predicted by `model` (1 if it predicts a single one). """
+    if get_model_name(model) == "GRU_Mixture":
+        logits = regression_out[:, :model.n_gaussians]
+        mixture_weights = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return np.max(mixture_weights, axis=1) / np.sum(mixture_weights, axis=1)
+
+    return np.ones(len(regression_out), dtype=regression_out.dtype)
+
+
+def make_numpy_ensemble_sequence_generator(ensemble, subject_id=0, use_max_component=False, rng_seed=1234):
+    """ Makes a NumPy function that returns the prediction of an ensemble of models for x_{t+1}
+    for every sequence in the batch given x_{t} and the current states of the models.
+
+    The diffusion data is gathered once and fed to every model. Their predictions are then combined
+    according to `ensemble.combine`:
+
+    * 'mean': the directions drawn from every model are averaged.
+    * 'mixture': directions are drawn from the mixture of the distributions predicted by the models,
+      all models having the same weight. With `use_max_component`, the most likely component
+      over all models is followed instead.
+
+    Likelihoods to keep growing are averaged over the models that learned to stop.
+
+    Parameters
+    ----------
+    ensemble : :class:`ModelEnsemble` object
+        Models to combine.
+    subject_id : int, optional
+        ID of the subject from which its diffusion data will be used. Default: 0.
+    use_max_component : bool, optional
+        Use the maximum of the probability distributions instead of sampling values
+    rng_seed : int, optional
+        Seed of the random generator used when sampling values. Default: 1234.
+    """
+    models = ensemble.models
+    for model in models:
+        _check_model(model)
+
+    rng = np.random.RandomState(rng_seed)
+    dtype = ensemble.volume_manager.atlas.dtype
+    _gather = _make_numpy_gather(models[0], Workspace(dtype=dtype))
+    # Every model gets its own workspace since layers of different models can have the same name.
+    fprops = [_make_numpy_fprop(model, Workspace(dtype=dtype)) for model in models]
+    samplers = [_make_numpy_sampler(model, use_max_component, rng) for model in models]
+    states_offsets = np.r_[0, np.cumsum([len(model.hidden_sizes) for model in models])]
+    learn_to_stop = [getattr(model, 'learn_to_stop', False) for model in models]
+    pick_max_component = ensemble.combine == "mixture" and use_max_component
+
+    def _gen(x_t, states, previous_direction=None, subject_ids=None):
+        """ Returns the prediction for x_{t+1} for every
+            sequence in the batch given x_{t} and the current states
+            of the models h^{l}_{t}.
+
+        See the function returned by `make_numpy_sequence_generator` for the parameters and the outputs.
+        """
+        x_t = np.asarray(x_t, dtype=_gather.dtype)
+        if previous_direction is not None:
+            previous_direction = np.asarray(previous_direction, dtype=_gather.dtype)
+
+        if subject_ids is None:
+            subject_ids = np.full(len(x_t), subject_id)
+
+        data_at_coords = _gather(x_t, np.asarray(subject_ids))
+
+        directions = []
+        weights = []
+        stoppings = []
+        new_states = []
+        for model, _fprop, _get_samples, start, end in zip(models, fprops, samplers, states_offsets[:-1], states_offsets[1:]):
+            regression_out, stopping, model_states = _fprop(data_at_coords, states[start:end], previous_direction)
+            directions.append(_get_samples(regression_out))
+            new_states += model_states
+            if stopping is not None:
+                stoppings.append(stopping)
+            if pick_max_component:
+                weights.append(_get_max_component_weights(model, regression_out))
+
+        # directions.shape : (n_models, batch_size, 3)
+        directions = np.stack(directions)
+        xs = np.arange(len(x_t))
+        if ensemble.combine == "mean":
+            next_x_t = np.mean(directions, axis=0)
+        elif pick_max_component:
+            next_x_t = directions[np.argmax(weights, axis=0), xs]
+        else:
+            # Sampling the mixture of the models is sampling a model, then its distribution.
+            next_x_t = directions[rng.randint(len(models), size=len(x_t)), xs]
+
+        if any(learn_to_stop):
+            return (next_x_t, np.mean(stoppings, axis=0)), new_states
+
+        return next_x_t, new_states
+
+    return _gen
+
+
+def _logsumexp(x, axis):
+    x_max = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(x_max, axis=axis) + np.log(np.sum(np.exp(x - x_max), axis=axis))
+
+
+def make_numpy_loss(model, normalize=False):
+    """ Makes a NumPy function that computes the loss of sequences given
+    the outputs of the model at every step and the directions actually taken.
+
+    The loss is the same as the default one used to train the model (see `factories.loss_factory`),
+    averaged over time steps. For models that learn to stop, the stopping targets decrease
+    linearly from 1 to 0.5 along each sequence, like in `TractographyBatchScheduler`.
+
+    Parameters
+    ----------
+    model : :class:`GRU` object
+        One of the models listed in `LOSS_SUPPORTED_MODELS`.
+    normalize : bool, optional
+        Whether the model was trained on normalized directions (see hyperparameter 'normalize'). Default: False.
+    """
+    model_name = get_model_name(model)
+    if model_name not in LOSS_SUPPORTED_MODELS:
+        raise ValueError("NumPy loss is not supported for {} (supported: {}).".format(model_name, ", ".join(LOSS_SUPPORTED_MODELS)))
+
+    d = model.output_size
+    log_2pi = np.log(2 * np.pi)
+
+    def _loss_per_time_step(regression_outputs, targets):
+        if model_name == "GRU_Regression":
+            if normalize:
+                regression_outputs = regression_outputs / np.sqrt(np.sum(regression_outputs**2, axis=-1, keepdims=True) + 1e-6)
+
+            return np.sqrt(np.sum((regression_outputs - targets)**2, axis=-1) + 1e-6)
+
+        elif model_name == "GRU_Gaussian":
+            mu, log_sigma = regression_outputs[..., :3], regression_outputs[..., 3:]
+            square_mahalanobis_dist = np.sum(((targets - mu) / np.exp(log_sigma))**2, axis=-1)
+            return 0.5 * (d * log_2pi + 2 * np.sum(log_sigma, axis=-1) + square_mahalanobis_dist)
+
+        elif model_name == "GRU_Mixture":
+            n = model.n_gaussians
+            logits = regression_outputs[..., :n]
+            log_mixture_weights = logits - _logsumexp(logits, axis=-1)[..., None]
+            means = regression_outputs[..., n:4*n].reshape(regression_outputs.shape[:-1] + (n, 3))
+            log_stds = regression_outputs[..., 4*n:7*n].reshape(regression_outputs.shape[:-1] + (n, 3))
+
+            log_prefix = -2 * log_mixture_weights + d * log_2pi + 2 * np.sum(log_stds, axis=-1)
+            square_mahalanobis_dist = np.sum(((targets[..., None, :] - means) / np.exp(log_stds))**2, axis=-1)
+            return -_logsumexp(-0.5 * (log_prefix + square_mahalanobis_dist), axis=-1)
+
+    def _loss(regression_outputs, stopping, targets):
+        """ Returns the loss of every sequence.
+
+        Parameters
+        ----------
+        regression_outputs : ndarray with shape (batch_size, seq_len, regression_layer_size)
+            Output of the regression layer at every step (see `return_regression_output`).
+        stopping : ndarray with shape (batch_size, seq_len)
+            Predicted likelihood to keep growing at every step. Ignored if the model doesn't learn to stop.
+        targets : ndarray with shape (batch_size, seq_len, 3)
+            Directions (unnormalized) actually taken at every step.
+
+        Returns
+        -------
+        loss_per_seq : ndarray with shape (batch_size,)
+            Loss of every sequence, averaged over its time steps.
+        """
+        batch_size, seq_len = targets.shape[:2]
+        if seq_len == 0:
+            return np.zeros(batch_size, dtype=targets.dtype)
+
+        if normalize:
+            targets = targets / np.sqrt(np.sum(targets**2, axis=-1, keepdims=True))
+
+        loss_per_time_step = _loss_per_time_step(regression_outputs, targets)
+
+        if getattr(model, 'learn_to_stop', False):
+            stopping_targets = np.linspace(1., 0.5, num=seq_len)
+            loss_per_time_step += -(stopping_targets * np.log(stopping) + (1 - stopping_targets) * np.log(1 - stopping))
+
+        return np.mean(loss_per_time_step, axis=1)
+
+    return _loss
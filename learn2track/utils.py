@@ -3,8 +3,6 @@ from __future__ import print_function
 import os
 import sys
 import numpy as np
-import theano
-import theano.tensor as T
 import shutil
 import hashlib
 
@@ -12,7 +10,7 @@ from collections import OrderedDict
 from time import time
 from os.path import join as pjoin
 
-import smartlearner.utils as smartutils
+# Theano is imported where needed, so tracking with NumPy (see `learn2track.numpy_inference`) does not need it.
 
 
 class Timer():
@@ -66,6 +64,8 @@ def find_closest(sphere, xyz, normed=True):
 
 
 def logsumexp(x, axis=None, keepdims=False):
+    import theano.tensor as T
+
     max_value = T.max(x, axis=axis, keepdims=True)
     res = max_value + T.log(T.sum(T.exp(x-max_value), axis=axis, keepdims=True))
     if not keepdims:
@@ -80,11 +80,15 @@ def logsumexp(x, axis=None, keepdims=False):
 
 
 def softmax(x, axis=None):
+    import theano.tensor as T
+
     return T.exp(x - logsumexp(x, axis=axis, keepdims=True))
 
 
 def l2distance(x, y=None, axis=-1, keepdims=False, eps=0.0):
     """ Computes the L2 distance between x and y if y is given, else computes the L2 norm of x. """
+    import theano.tensor as T
+
     if y is not None:
         diff = x - y
     else:
@@ -99,14 +103,17 @@ def chunk(sequence, n):
         yield sequence[i:i + n]
 
 
-def log_variables(batch_scheduler, model, *symb_vars):
+def log_variables(batch_scheduler, model, *symb_vars, function_cache=None):
+    from learn2track.function_cache import compile_function
+
     # Gather updates from the optimizer and the batch scheduler.
-    f = theano.function([],
-                        symb_vars,
-                        givens=batch_scheduler.givens,
-                        updates=model.updates,
-                        name="compute_loss",
-                        on_unused_input='ignore')
+    f = compile_function([],
+                         symb_vars,
+                         givens=batch_scheduler.givens,
+                         updates=model.updates,
+                         cache=function_cache,
+                         name="compute_loss",
+                         on_unused_input='ignore')
 
     log = [[] for _ in range(len(symb_vars))]
     for j in batch_scheduler:
@@ -119,6 +126,8 @@ def log_variables(batch_scheduler, model, *symb_vars):
 
 
 def maybe_create_experiment_folder(args, exclude=[], retrocompatibility_defaults={}):
+    import smartlearner.utils as smartutils
+
     # Extract experiments hyperparameters
     hyperparams = OrderedDict(sorted(vars(args).items()))
 
@@ -1,10 +1,13 @@
 import numpy as np
 import theano
 import theano.tensor as T
+from collections import OrderedDict
 
 from smartlearner.interfaces import View
 from smartlearner import views
 
+from learn2track.function_cache import compile_function
+
 
 class LossView(View):
     def __init__(self, loss, batch_scheduler):
@@ -16,6 +19,47 @@ class LossView(View):
                                              name="compute_error")
 
 
+class CachedLossView(View):
+    """ Same as `smartlearner.views.LossView`, its function going through `function_cache` (see `learn2track.function_cache`). """
+    def __init__(self, loss, batch_scheduler, function_cache=None):
+        super().__init__()
+        self.batch_scheduler = batch_scheduler
+
+        losses = loss.losses  # Builds the graph, hence the updates of the model.
+
+        # Gather updates from the model and the batch scheduler.
+        graph_updates = OrderedDict()
+        graph_updates.update(loss.model.updates)
+        graph_updates.update(batch_scheduler.updates)
+
+        self.compute_loss = compile_function([],
+                                             losses,
+                                             updates=graph_updates,
+                                             givens=batch_scheduler.givens,
+                                             cache=function_cache,
+                                             name="compute_loss")
+
+    def update(self, status):
+        losses = []
+        for _ in self.batch_scheduler:
+            losses.append(self.compute_loss())
+
+        losses = np.concatenate(losses)
+        return losses.mean(), losses.std(ddof=1) / np.sqrt(len(losses)), losses
+
+    @property
+    def mean(self):
+        return views.ItemGetter(self, attribute=0)
+
+    @property
+    def stderror(self):
+        return views.ItemGetter(self, attribute=1)
+
+    @property
+    def losses(self):
+        return views.ItemGetter(self, attribute=2)
+
+
 class RegressionError(View):
     def __init__(self, predict_fct, dataset, batch_size=100):
         super(RegressionError, self).__init__()
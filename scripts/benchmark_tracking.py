@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import contextlib
+import itertools
+import json
+import resource
+import time
+
+import numpy as np
+import nibabel as nib
+from dipy.core.gradients import gradient_table
+
+import theano
+
+from learn2track import neurotools, factories
+from learn2track.numpy_inference import ModelEnsemble, eval_atlas_at_3d_coordinates_in_numpy, eval_corners_atlas_at_3d_coordinates_in_numpy
+from scripts.track import Tracker, TrackingTelemetry, track, batch_track, make_tracking_is_stopping
+
+floatX = theano.config.floatX
+
+MODELS = ["gru_regression", "gru_gaussian", "gru_mixture", "ffnn_regression"]
+
+
+def build_argparser():
+    DESCRIPTION = ("Benchmark the tracking of randomly initialized models in a synthetic phantom. "
+                   "Results are printed (or saved) as JSON.")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--models', nargs='+', choices=MODELS, default=MODELS,
+                   help="models to benchmark. Default: all of them.")
+    p.add_argument('--hidden-sizes', type=int, nargs='+', default=[100],
+                   help="number of hidden units of each layer of the models. Default: 100")
+    p.add_argument('--volume-size', type=int, default=30,
+                   help="size of the (cubic) phantom, in voxels. Default: 30")
+    p.add_argument('--nb-gradients', type=int, default=65,
+                   help="number of diffusion gradients of the phantom (including one b0). Default: 65")
+    p.add_argument('--nb-seeds', type=int, default=1000,
+                   help="number of seeds, drawn in the voxels of the phantom's bundle. Default: 1000")
+    p.add_argument('--batch-size', type=int,
+                   help="number of streamlines to process at the same time. Default: all seeds at once")
+    p.add_argument('--step-size', type=float, default=0.5,
+                   help="step size between two consecutive points in a streamlines (in voxel). Default: 0.5")
+    p.add_argument('--max-nb-points', type=int, default=200,
+                   help="maximum number of points a streamline can have. Default: 200")
+    p.add_argument('--theta', type=float, default=45,
+                   help="maximum angle (in degree) between two consecutive steps. Default: 45")
+    p.add_argument('--seed', type=int, default=1234,
+                   help="seed used to build the phantom, the seeds and the models. Default: 1234")
+    p.add_argument('--ensemble-size', type=int, default=1,
+                   help="if greater than 1, benchmark an ensemble of that many models of each kind (see track.py --ensemble). Default: 1")
+    p.add_argument('--neighborhood-radius', type=float,
+                   help="if specified, models add the data of 6 neighbors at that distance (in voxel) to their input. Default: no neighborhood")
+    p.add_argument('--stack-neighborhood', action="store_true",
+                   help="if specified, the neighbors are gathered at once from an atlas precomputed with the data of all neighbors "
+                        "(see learn.py --stack-neighborhood). It takes 7 times the memory of the volume ('atlas_nbytes' in the results) "
+                        "and some time to build ('stack_time'), in exchange for one gather per step instead of seven.")
+    p.add_argument('--volume-layouts', nargs='+', choices=neurotools.VOLUME_LAYOUTS, default=["flat"],
+                   help="layouts of the volumes to benchmark (see track.py --volume-layout). 'corners' reads the 8 corners of a "
+                        "coordinate from one row but takes about 8 times the memory ('atlas_nbytes'); 'gather_time' times the "
+                        "interpolation alone. Default: flat")
+
+    engine = p.add_argument_group("Tracking engine (see track.py)")
+    engine.add_argument('--numpy-inference', action="store_true")
+    engine.add_argument('--continuous-batching', action="store_true")
+    engine.add_argument('--bidirectional', action="store_true",
+                        help="also run batch_track with the two-pass method ('batch_track_two_pass'), to compare both.")
+    engine.add_argument('--sort-seeds', action="store_true")
+    engine.add_argument('--sort-sprouts', action="store_true")
+
+    p.add_argument('--out', type=str,
+                   help="JSON file where to save the results. Default: print them.")
+
+    return p
+
+
+def make_phantom(volume_size, nb_gradients, seed=1234):
+    """ Builds a diffusion phantom containing a bundle of concentric arcs.
+
+    Voxels of the bundle follow a single tensor oriented along the arcs;
+    the other voxels contain isotropic diffusion. Some noise is added to the signal.
+
+    Returns
+    -------
+    dwi : `nib.Nifti1Image` object
+        Diffusion weighted images of shape (volume_size, volume_size, volume_size, nb_gradients).
+    gradients : `dipy.core.gradients.GradientTable` object
+        Diffusion gradients of the phantom.
+    mask : 3D array
+        Voxels belonging to the bundle.
+    """
+    rng = np.random.RandomState(seed)
+    bvals = np.array([0] + [1000] * (nb_gradients - 1))
+    bvecs = rng.randn(nb_gradients, 3)
+    bvecs /= np.sqrt(np.sum(bvecs ** 2, axis=1, keepdims=True))
+    gradients = gradient_table(bvals, bvecs)
+
+    # Arcs are centered on the z-axis going through the middle of the volume.
+    center = (volume_size - 1) / 2.
+    x, y, _ = np.meshgrid(*[np.arange(volume_size) - center] * 3, indexing='ij')
+    radius = np.sqrt(x**2 + y**2)
+    mask = (radius >= volume_size / 6.) & (radius <= volume_size / 2.5)
+
+    directions = np.stack([-y, x, np.zeros_like(x)], axis=-1) / np.maximum(radius, 1e-6)[..., None]
+    cos2 = np.dot(directions, bvecs.T)**2
+
+    # Single tensor signal: exp(-b * (l_perp + (l_para - l_perp) * cos^2)).
+    l_para, l_perp, l_iso = 1.7e-3, 0.3e-3, 3e-3
+    signal = np.exp(-bvals * (l_perp + (l_para - l_perp) * cos2))
+    signal[~mask] = np.exp(-bvals * l_iso)
+    signal += rng.normal(0, 0.02, size=signal.shape)
+
+    dwi = nib.Nifti1Image(np.abs(signal).astype(np.float32), affine=np.eye(4))
+    return dwi, gradients, mask
+
+
+def make_seeds(mask, nb_seeds, seed=1234):
+    """ Draws `nb_seeds` seeds uniformly in the voxels of `mask`. """
+    rng = np.random.RandomState(seed)
+    indices = np.array(np.where(mask)).T
+    voxels = indices[rng.randint(len(indices), size=nb_seeds)]
+    return (voxels + rng.uniform(-0.5, 0.5, size=voxels.shape)).astype(floatX)
+
+
+def make_model(name, volume_manager, hidden_sizes, neighborhood_radius=None, stack_neighborhood=False, seed=1234):
+    """ Creates a randomly initialized model tracking in the volumes of `volume_manager`. """
+    hyperparams = {'model': name,
+                   'hidden_sizes': hidden_sizes,
+                   'activation': 'tanh',
+                   'feed_previous_direction': False,
+                   'predict_offset': False,
+                   'use_layer_normalization': False,
+                   'drop_prob': 0.,
+                   'dropout_prob': 0.,
+                   'use_zoneout': False,
+                   'skip_connections': False,
+                   'neighborhood_radius': neighborhood_radius,
+                   'stack_neighborhood': stack_neighborhood,
+                   'learn_to_stop': False,
+                   'n_gaussians': 2,
+                   'seed': seed}
+    model = factories.model_factory(hyperparams,
+                                    input_size=volume_manager.data_dimension,
+                                    output_size=3,
+                                    volume_manager=volume_manager)
+    model.initialize(factories.weigths_initializer_factory("orthogonal", seed=seed))
+    return model
+
+
+def get_peak_rss():
+    """ Returns the peak resident set size of this process (in bytes). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux reports kilobytes.
+
+
+def benchmark_gather(volume_manager, coords, nb_repeats=10):
+    """ Times the interpolation of the volume at `coords`, with Theano and with NumPy, in the layout of `volume_manager`. """
+    symb_coords = theano.tensor.matrix()
+    theano_gather = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords))
+    coords_and_ids = np.c_[coords, np.zeros(len(coords))].astype(floatX)
+
+    shapes = np.array(volume_manager.volumes_shapes, dtype=floatX)
+    volume_ids = np.zeros(len(coords), dtype=np.intp)
+    if volume_manager.layout == "corners":
+        atlas = volume_manager.get_corners_atlas().get_value(borrow=True)
+        offsets = np.array(volume_manager.corners_offsets, dtype=np.intp)
+        strides = np.array(volume_manager.corners_strides, dtype=floatX)
+        numpy_gather = lambda: eval_corners_atlas_at_3d_coordinates_in_numpy(atlas, offsets, shapes, strides, coords, volume_ids)
+    else:
+        atlas = volume_manager.atlas.get_value(borrow=True)
+        offsets = np.array(volume_manager.volumes_offsets, dtype=np.intp)
+        strides = np.array(volume_manager.volumes_strides, dtype=floatX)
+        numpy_gather = lambda: eval_atlas_at_3d_coordinates_in_numpy(atlas, offsets, shapes, strides, coords, volume_ids)
+
+    times = {}
+    for engine, gather in [('theano', lambda: theano_gather(coords_and_ids)), ('numpy', numpy_gather)]:
+        gather()  # Warm up.
+        start = time.perf_counter()
+        for _ in range(nb_repeats):
+            gather()
+        times[engine] = (time.perf_counter() - start) / nb_repeats
+
+    return times
+
+
+def benchmark_tracker(model, seeds, step_size, is_stopping, args):
+    """ Tracks `seeds` in a single direction, timing separately the model, the stopping criteria and the harvest. """
+    start = time.perf_counter()
+    tracker = Tracker(model, is_stopping, keep_last_n_states=0, max_nb_points=is_stopping.max_nb_points,
+                      rng_seed=args.seed, use_numpy_inference=args.numpy_inference, sort_sprouts=args.sort_sprouts)
+    setup_time = time.perf_counter() - start
+
+    stats = {}
+    telemetry = TrackingTelemetry()
+    start = time.perf_counter()
+    tractogram = track(tracker, seeds, step_size, is_stopping, stats=stats, telemetry=telemetry)
+    elapsed = time.perf_counter() - start
+
+    summary = telemetry.summary
+    nb_steps = max(summary['nb_steps'], 1)
+    nb_points = int(sum(map(len, tractogram.streamlines)))
+    return {'setup_time': setup_time,
+            'time': elapsed,
+            'nb_streamlines': len(tractogram),
+            'nb_points': nb_points,
+            'nb_steps': summary['nb_steps'],
+            'streamlines_per_sec': len(tractogram) / elapsed,
+            'points_per_sec': nb_points / elapsed,
+            'time_per_step': {'model': summary['time_grow'] / nb_steps,
+                              'stopping': summary['time_stopping'] / nb_steps,
+                              'harvest': summary['time_harvest'] / nb_steps},
+            'mean_active_batch_width': stats.get('nb_sprouts_steps', 0) / nb_steps}
+
+
+def benchmark_batch_track(model, volume, seeds, step_size, is_stopping, args, bidirectional=False):
+    """ Tracks `seeds` in both directions, the way track.py does (at once if `bidirectional`, else in two passes). """
+    track_args = argparse.Namespace(track_like_peter=False, pft_nb_retry=0, pft_nb_backtrack_steps=0,
+                                    use_max_component=False, flip_x=False, flip_y=False, flip_z=False,
+                                    verbose=False, seeding_rng_seed=args.seed,
+                                    continuous_batching=args.continuous_batching,
+                                    numpy_inference=args.numpy_inference,
+                                    bidirectional=bidirectional,
+                                    sort_seeds=args.sort_seeds, sort_sprouts=args.sort_sprouts,
+                                    samples_per_seed=1)
+
+    start = time.perf_counter()
+    tractogram = batch_track(model, volume, seeds, step_size=step_size, batch_size=args.batch_size,
+                             is_stopping=is_stopping, args=track_args)
+    elapsed = time.perf_counter() - start
+
+    nb_points = int(sum(map(len, tractogram.streamlines)))
+    return {'time': elapsed,
+            'nb_streamlines': len(tractogram),
+            'nb_points': nb_points,
+            'streamlines_per_sec': len(tractogram) / elapsed,
+            'points_per_sec': nb_points / elapsed}
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+
+    results = {'config': vars(args), 'results': []}
+    # Keep stdout for the results, tracking progress goes to stderr.
+    with contextlib.redirect_stdout(sys.stderr):
+        dwi, gradients, mask = make_phantom(args.volume_size, args.nb_gradients, seed=args.seed)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+        seeds = make_seeds(mask, args.nb_seeds, seed=args.seed)
+        is_stopping = make_tracking_is_stopping(mask.astype(np.float32), np.eye(4), 0.5, args.max_nb_points, np.deg2rad(args.theta))
+
+        for layout, name in itertools.product(args.volume_layouts, args.models):
+            volume_manager = neurotools.VolumeManager(layout=layout)
+            volume_manager.register(volume)
+
+            start = time.perf_counter()
+            if args.neighborhood_radius and args.stack_neighborhood:
+                volume_manager.get_neighborhood_atlas(args.neighborhood_radius)
+            stack_time = time.perf_counter() - start
+
+            models = [make_model(name, volume_manager, args.hidden_sizes, neighborhood_radius=args.neighborhood_radius,
+                                 stack_neighborhood=args.stack_neighborhood, seed=args.seed + i)
+                      for i in range(args.ensemble_size)]
+
+            result = {'model': name,
+                      'volume_layout': layout,
+                      'stack_time': stack_time,
+                      'gather_time': benchmark_gather(volume_manager, seeds)}
+            try:
+                model = models[0] if len(models) == 1 else ModelEnsemble(models)
+                result['tracker'] = benchmark_tracker(model, seeds, args.step_size, is_stopping, args)
+                result['batch_track'] = benchmark_batch_track(model, volume, seeds, args.step_size, is_stopping, args,
+                                                              bidirectional=args.bidirectional)
+                if args.bidirectional:
+                    result['batch_track_two_pass'] = benchmark_batch_track(model, volume, seeds, args.step_size, is_stopping, args)
+            except ValueError as e:  # E.g. an engine not supporting that model.
+                result['error'] = str(e)
+
+            # Derived atlases are built when first needed, so all of them exist once the models have tracked.
+            atlases = [volume_manager.atlas] + list(volume_manager.neighborhood_atlases.values()) + list(volume_manager.corners_atlases.values())
+            result['atlas_nbytes'] = sum(atlas.get_value(borrow=True).nbytes for atlas in atlases)
+            result['peak_rss'] = get_peak_rss()
+            results['results'].append(result)
+
+    if args.out is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,13 @@ import os
 from os.path import join as pjoin
 import argparse
 
-from smartlearner import views
 from smartlearner.status import Status
 from smartlearner import utils as smartutils
 
 from learn2track.utils import Timer
 from learn2track.factories import loss_factory, batch_scheduler_factory
+from learn2track.function_cache import make_function_cache
+from learn2track.views import CachedLossView
 
 from learn2track import datasets
 from learn2track.neurotools import VolumeManager
@@ -100,6 +101,7 @@ def main():
         else:
             raise NameError("Unknown model: {}".format(hyperparams['model']))
         model.drop_prob = 0.  # Make sure dropout/zoneout is not used when testing
+        model.function_cache = make_function_cache(experiment_path, model, hyperparams)
 
     with Timer("Building evaluation function"):
         # Override K for gru_multistep
@@ -108,7 +110,7 @@ def main():
 
         batch_scheduler = batch_scheduler_factory(hyperparams, dataset, train_mode=False, batch_size_override=args.batch_size)
         loss = loss_factory(hyperparams, model, dataset, loss_type=args.loss_type)
-        l2_error = views.LossView(loss=loss, batch_scheduler=batch_scheduler)
+        l2_error = CachedLossView(loss=loss, batch_scheduler=batch_scheduler, function_cache=model.function_cache)
 
     with Timer("Evaluating...", newline=True):
         results_file = pjoin(experiment_path, "results.json")
@@ -14,6 +14,7 @@ from matplotlib import cm
 from matplotlib import colors as mplcolors
 
 from learn2track.factories import loss_factory, batch_scheduler_factory
+from learn2track.function_cache import make_function_cache
 from learn2track.neurotools import VolumeManager
 
 import numpy as np
@@ -103,7 +104,8 @@ def evaluation_tractogram(hyperparams, model, dataset, batch_size_override, metr
                                                          model,
                                                          loss.loss_per_time_step,
                                                          dataset.symb_inputs * 1,
-                                                         dataset.symb_targets * 1)
+                                                         dataset.symb_targets * 1,
+                                                         function_cache=model.function_cache)
         # Regrouping data into streamlines will only work if the original streamlines were NOT shuffled, resampled or augmented
         timesteps_loss = ArraySequence()
         seq_loss = []
@@ -125,7 +127,8 @@ def evaluation_tractogram(hyperparams, model, dataset, batch_size_override, metr
                                                                             loss.loss_per_seq,
                                                                             dataset.symb_inputs * 1,
                                                                             dataset.symb_targets * 1,
-                                                                            dataset.symb_mask * 1)
+                                                                            dataset.symb_mask * 1,
+                                                                            function_cache=model.function_cache)
         timesteps_loss = ArraySequence([l[:int(m.sum())] for l, m in zip(chain(*timestep_losses), chain(*masks))])
         seq_loss = np.array(list(chain(*seq_losses)))
         timesteps_inputs = ArraySequence([i[:int(m.sum())] for i, m in zip(chain(*inputs), chain(*masks))])
@@ -193,7 +196,8 @@ def prediction_tractogram(hyperparams, model, dataset, batch_size_override, pred
                                                                      loss.loss_per_time_step,
                                                                      dataset.symb_inputs * 1,
                                                                      dataset.symb_targets * 1,
-                                                                     dataset.symb_mask * 1)
+                                                                     dataset.symb_mask * 1,
+                                                                     function_cache=model.function_cache)
     if hyperparams['model'] == 'ffnn_regression':
         # Regrouping data into streamlines will only work if the original streamlines were NOT shuffled, resampled or augmented
         timesteps_prediction = ArraySequence()
@@ -298,6 +302,7 @@ def main():
             model = FFNN_Regression.create(experiment_path, volume_manager=volume_manager)
         else:
             raise NameError("Unknown model: {}".format(hyperparams['model']))
+        model.function_cache = make_function_cache(experiment_path, model, hyperparams)
         print(str(model))
 
     tractogram_file = pjoin(experiment_path, args.out)
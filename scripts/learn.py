@@ -27,7 +27,8 @@ from learn2track.factories import model_factory
 from learn2track.factories import loss_factory
 
 from learn2track import datasets
-from learn2track.neurotools import VolumeManager
+from learn2track.feature_cache import DTYPES, load_or_compute_features
+from learn2track.neurotools import VolumeManager, VOLUME_LAYOUTS
 
 
 def build_train_gru_argparser(subparser):
@@ -261,6 +262,13 @@ def build_argparser():
     dataset.add_argument('--neighborhood-radius', type=float,
                          help='if specified, the model will add data from neighboring points to the input (6 points, along each axis), with specified length '
                               '(in voxel space). Default: None (no neighborhood)')
+    dataset.add_argument('--stack-neighborhood', action='store_true',
+                         help='if specified, the data of all neighbors of every voxel are precomputed in a single volume, 7 times as large, '
+                              'so the neighborhood is interpolated with one gather instead of seven. Neighbors are slightly smoothed '
+                              'unless --neighborhood-radius is a whole number of voxels. (Training speedup).')
+    dataset.add_argument('--volume-layout', choices=VOLUME_LAYOUTS, default="flat",
+                         help="how diffusion volumes are stored: 'corners' stores the 2x2x2 corners of every voxel contiguously, "
+                              "so each interpolation reads a single row, using about 8 times the memory. Default: %(default)s")
 
     duration = p.add_argument_group("Training duration options")
     duration.add_argument('--max-epoch', type=int, metavar='N', default=100,
@@ -284,6 +292,10 @@ def build_argparser():
                           help='if specified, training streamlines will not be resampled between batches (streamlines will keep their original step size)')
     training.add_argument('--sort-streamlines', action="store_true",
                           help='if specified, streamlines will be approximatively regrouped according to their lengths. (Training speedup).')
+    training.add_argument('--cache-features', choices=DTYPES,
+                          help='if specified, the diffusion data at every point of the streamlines are interpolated once and stored, with that precision, '
+                               'in the experiment folder; batches then feed them instead of interpolating the volumes again at each epoch. '
+                               'Requires --keep-step-size and no --noisy-streamlines-sigma. (Training speedup).')
 
     # Optimizer options
     optimizer = p.add_argument_group("Optimizer (required)")
@@ -319,7 +331,17 @@ def main():
     print(args)
     print("Using Theano v.{}".format(theano.version.short_version))
 
-    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view', 'shuffle_streamlines']
+    if args.stack_neighborhood and not args.neighborhood_radius:
+        parser.error("--stack-neighborhood requires --neighborhood-radius.")
+
+    if args.cache_features is not None:
+        if not args.keep_step_size or args.noisy_streamlines_sigma is not None:
+            parser.error("--cache-features requires --keep-step-size and no --noisy-streamlines-sigma.")
+
+        if args.model == 'gru_multistep':
+            parser.error("--cache-features is not supported by the gru_multistep model.")
+
+    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view', 'shuffle_streamlines', 'cache_features', 'volume_layout']
     # Use this for hyperparams added in a new version, but nonexistent from older versions
     retrocompatibility_defaults = {'feed_previous_direction': False,
                                    'predict_offset': False,
@@ -331,6 +353,7 @@ def main():
                                    'use_zoneout': False,
                                    'skip_connections': False,
                                    'neighborhood_radius': False,
+                                   'stack_neighborhood': False,
                                    'learn_to_stop': False}
     experiment_path, hyperparams, resuming = utils.maybe_create_experiment_folder(args, exclude=hyperparams_to_exclude,
                                                                                   retrocompatibility_defaults=retrocompatibility_defaults)
@@ -342,15 +365,30 @@ def main():
     print("Resuming:" if resuming else "Creating:", experiment_path)
 
     with Timer("Loading dataset", newline=True):
-        trainset_volume_manager = VolumeManager()
-        validset_volume_manager = VolumeManager()
+        trainset_volume_manager = VolumeManager(layout=args.volume_layout)
+        validset_volume_manager = VolumeManager(layout=args.volume_layout)
         trainset = datasets.load_tractography_dataset(args.train_subjects, trainset_volume_manager, name="trainset",
                                                       use_sh_coeffs=args.use_sh_coeffs)
         validset = datasets.load_tractography_dataset(args.valid_subjects, validset_volume_manager, name="validset",
                                                       use_sh_coeffs=args.use_sh_coeffs)
         print("Dataset sizes:", len(trainset), " |", len(validset))
 
-        batch_scheduler = batch_scheduler_factory(hyperparams, dataset=trainset, train_mode=True)
+        if hyperparams['stack_neighborhood']:
+            # Precomputed once, instead of gathering every neighbor at each batch.
+            trainset_volume_manager.get_neighborhood_atlas(hyperparams['neighborhood_radius'])
+            validset_volume_manager.get_neighborhood_atlas(hyperparams['neighborhood_radius'])
+
+        trainset_features = validset_features = None
+        if args.cache_features is not None:
+            # Diffusion data are interpolated once, instead of at every epoch.
+            trainset_features = load_or_compute_features(experiment_path, trainset, trainset_volume_manager,
+                                                         neighborhood_radius=hyperparams['neighborhood_radius'],
+                                                         stack_neighborhood=hyperparams['stack_neighborhood'], dtype=args.cache_features)
+            validset_features = load_or_compute_features(experiment_path, validset, validset_volume_manager,
+                                                         neighborhood_radius=hyperparams['neighborhood_radius'],
+                                                         stack_neighborhood=hyperparams['stack_neighborhood'], dtype=args.cache_features)
+
+        batch_scheduler = batch_scheduler_factory(hyperparams, dataset=trainset, train_mode=True, features=trainset_features)
         print("An epoch will be composed of {} updates.".format(batch_scheduler.nb_updates_per_epoch))
 
         print("Volume data dimensions: {}".format(trainset_volume_manager.data_dimension))
@@ -367,6 +405,7 @@ def main():
                               volume_manager=trainset_volume_manager)
         model.initialize(weigths_initializer_factory(args.weights_initialization,
                                                      seed=args.initialization_seed))
+        model.use_cached_features = args.cache_features is not None
 
         print("Network architecture: ", get_model_architecture(model))
 
@@ -419,7 +458,8 @@ def main():
         valid_loss = loss_factory(hyperparams, model, validset)
         valid_batch_scheduler = batch_scheduler_factory(hyperparams,
                                                         dataset=validset,
-                                                        train_mode=False)
+                                                        train_mode=False,
+                                                        features=validset_features)
 
         valid_error = views.LossView(loss=valid_loss, batch_scheduler=valid_batch_scheduler)
         trainer.append_task(tasks.Print("Validset - Error        : {0:.2f} | {1:.2f}", valid_error.sum, valid_error.mean))
@@ -427,7 +467,8 @@ def main():
         if hyperparams['model'] == 'ffnn_regression':
             valid_batch_scheduler2 = batch_scheduler_factory(hyperparams,
                                                              dataset=validset,
-                                                             train_mode=False)
+                                                             train_mode=False,
+                                                             features=validset_features)
 
             valid_l2 = loss_factory(hyperparams, model, validset, loss_type="expected_value")
             valid_l2_error = views.LossView(loss=valid_l2, batch_scheduler=valid_batch_scheduler2)
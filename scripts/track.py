@@ -10,9 +10,16 @@ sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
 
 import numpy as np
 import argparse
+import copy
+import json
+import multiprocessing
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
 from os.path import join as pjoin
 
-import theano
 import time
 
 import dipy
@@ -20,16 +27,13 @@ import nibabel as nib
 from nibabel.streamlines import Tractogram
 from dipy.tracking.streamline import compress_streamlines
 
-from smartlearner import views
-from smartlearner import utils as smartutils
-
-from learn2track import datasets
-from learn2track.factories import loss_factory, batch_scheduler_factory
+# Modules depending on Theano are imported where needed, so that tracking with --numpy-inference does not need it.
 from learn2track.utils import Timer
 
 from learn2track import neurotools
 
-floatX = theano.config.floatX
+# Type of the coordinates. Models running with Theano accept it, whatever their `floatX`.
+floatX = "float32"
 
 # Constant
 STOPPING_MASK =       int('00000001', 2)
@@ -37,20 +41,34 @@ STOPPING_LENGTH =     int('00000010', 2)
 STOPPING_CURVATURE =  int('00000100', 2)
 STOPPING_LIKELIHOOD = int('00001000', 2)
 
+# With --continuous-batching, fresh seeds are planted once that fraction of the batch is free.
+REFILL_RATIO = 0.25
+# With --continuous-batching, seeds are tracked (forward then backward) in chunks of that many batches.
+CONTINUOUS_BATCHING_CHUNK_FACTOR = 16
+# Number of seeds tracked at the same time when no --batch-size is given. Seeds are split in chunks the same way
+# whatever the number of workers, so they are tracked with the same random draws (see `get_chunk_rng_seed`).
+DEFAULT_BATCH_SIZE = 50000
+
 
 def build_argparser():
     DESCRIPTION = "Generate a tractogram from a LSTM model trained on ismrm2015 challenge data."
     p = argparse.ArgumentParser(description=DESCRIPTION)
 
     p.add_argument('name', type=str, help='name/path of the experiment.')
-    p.add_argument('dwi', type=str, help="diffusion weighted images (.nii|.nii.gz).")
-    p.add_argument('--out', type=str,
-                   help="name of the output tractogram (.tck|.trk). Default: auto generate a meaningful name")
+    p.add_argument('dwi', type=str, nargs="+",
+                   help="diffusion weighted images (.nii|.nii.gz). Giving several DWIs tracks all those subjects at once, "
+                        "using the same model, and saves one tractogram per subject.")
+    p.add_argument('--out', type=str, nargs="+",
+                   help="name of the output tractogram (.tck|.trk), one per DWI. Default: auto generate a meaningful name")
     p.add_argument('--prefix', type=str,
                    help="prefix to use for the name of the output tractogram, only if it is auto generated.")
 
     p.add_argument('--seeds', type=str, nargs="+", required=True,
-                   help="use extermities of the streamlines in these tractograms (.trk|.tck) as seed points.")
+                   help="use extermities of the streamlines in these tractograms (.trk|.tck) as seed points. "
+                        "When giving several DWIs, one seeding file per DWI.")
+    p.add_argument('--samples-per-seed', type=int, default=1, metavar='N',
+                   help="number of streamlines to draw from every seed. They share their first step: the model runs once per seed, "
+                        "then only sampling differs (probabilistic GRU models only). Default: 1")
     p.add_argument('--nb-seeds-per-voxel', type=int, default=1,
                    help="number of seeds per voxel, only if --seeds is a seeding mask (i.e. a nifti file). Default: 1")
     p.add_argument('--seeding-rng-seed', type=int, default=1234,
@@ -65,15 +83,57 @@ def build_argparser():
     p.add_argument('--min-length', type=int, help="minimum length (in mm) for a streamline. Default: 20 mm", default=20)
     p.add_argument('--max-length', type=int, help="maximum length (in mm) for a streamline. Default: 200 mm", default=200)
     p.add_argument('--step-size', type=float, help="step size between two consecutive points in a streamlines (in mm). Default: use model's output as-is")
-    p.add_argument('--mask', type=str,
-                   help="if provided, streamlines will stop if going outside this mask (.nii|.nii.gz).")
+    p.add_argument('--mask', type=str, nargs="+",
+                   help="if provided, streamlines will stop if going outside this mask (.nii|.nii.gz), one per DWI.")
     p.add_argument('--mask-threshold', type=float, default=0.05,
                    help="streamlines will be terminating if they pass through a voxel with a value from the mask lower than this value. Default: 0.05")
 
     p.add_argument('--filter-threshold', type=float,
-                   help="If specified, only streamlines with a loss value lower than the specified value will be kept.")
-
-    p.add_argument('--batch-size', type=int, help="number of streamlines to process at the same time. Default: the biggest possible")
+                   help="If specified, only streamlines with a loss value lower than the specified value will be kept. "
+                        "The loss is computed by feeding the saved streamlines (compressed, in RAS+mm) to the model again, "
+                        "unless --track-loss is given.")
+    p.add_argument('--track-loss', action="store_true",
+                   help="if specified with --filter-threshold, compute the loss of streamlines while tracking them instead "
+                        "(not supported with --bidirectional). The loss is then the one of the uncompressed streamlines in voxel space, "
+                        "i.e. what the model actually saw, so thresholds tuned without --track-loss do not carry over.")
+
+    p.add_argument('--batch-size', type=int,
+                   help="number of streamlines to process at the same time. Default: {:,}, halved until it fits in memory".format(DEFAULT_BATCH_SIZE))
+    p.add_argument('--memory-budget', type=parse_memory_size,
+                   help="memory (e.g. 512M, 4G) available for tracking, used to pick the biggest possible --batch-size. "
+                        "Split among the workers when using --nb-workers.")
+    p.add_argument('--nb-workers', type=int, default=1,
+                   help="number of processes tracking chunks of --batch-size seeds in parallel. Default: 1")
+    p.add_argument('--checkpoint', action="store_true",
+                   help="if specified, save progress after every chunk of seeds (in '<output>.checkpoint/') so an interrupted run can be resumed with --resume.")
+    p.add_argument('--resume', action="store_true",
+                   help="if specified, resume an interrupted --checkpoint run by skipping the chunks of seeds already tracked.")
+    p.add_argument('--continuous-batching', action="store_true",
+                   help="if specified, plant fresh seeds as soon as streamlines are done so about --batch-size streamlines are always growing.")
+    p.add_argument('--sort-seeds', action="store_true",
+                   help="if specified, track the seeds of every chunk along a Z-order curve so streamlines growing together "
+                        "read neighboring parts of the volume. Streamlines are still saved in seed order.")
+    p.add_argument('--sort-sprouts', action="store_true",
+                   help="if specified, also sort growing streamlines along a Z-order curve every time finished ones are removed.")
+    p.add_argument('--telemetry', type=str, metavar='FILE',
+                   help="if specified, write statistics about every tracking step to FILE, as JSON lines "
+                        "(one FILE.<pid> per worker when using --nb-workers).")
+    p.add_argument('--bidirectional', action="store_true",
+                   help="if specified, grow both directions from the seeds at once, each one from fresh model states, and join them, "
+                        "instead of tracking backward by feeding the forward half back to the model.")
+    p.add_argument('--numpy-inference', action="store_true",
+                   help="if specified, run the model with NumPy instead of calling a Theano function at every step (GRU models only). "
+                        "The model is then loaded without Theano, unless --filter-threshold is used without --track-loss.")
+    p.add_argument('--volume-layout', choices=neurotools.VOLUME_LAYOUTS, default="flat",
+                   help="how diffusion volumes are stored: 'corners' stores the 2x2x2 corners of every voxel contiguously, "
+                        "so each interpolation reads a single row, using about 8 times the memory. Default: %(default)s")
+    p.add_argument('--ensemble', type=str, nargs="+", metavar='NAME',
+                   help="name/path of other experiments whose models track along with the one of `name`, their predictions "
+                        "being combined at every step (see --ensemble-mode). Models run with NumPy (GRU models only).")
+    p.add_argument('--ensemble-mode', choices=["mean", "mixture"], default="mean",
+                   help="how predictions of an --ensemble are combined: 'mean' follows the average of the directions of all models, "
+                        "'mixture' follows the direction of a model picked at random (or the most likely one with --use-max-component). "
+                        "Default: mean")
 
     p.add_argument('--dilate-mask', action="store_true",
                    help="if specified, apply binary dilation on the tracking mask.")
@@ -135,11 +195,15 @@ def count_flags(flags, ref_flag):
     return is_flag_set(flags, ref_flag).sum()
 
 
-def compute_loss_errors(streamlines, model, hyperparams):
+def compute_loss_errors(streamlines, model, hyperparams, subject_id=0):
+    from learn2track import datasets
+    from learn2track.factories import loss_factory, batch_scheduler_factory
+    from learn2track.views import CachedLossView
+
     # Create dummy dataset for these new streamlines.
     tracto_data = neurotools.TractographyData(None, None, None)
     tracto_data.add(streamlines, bundle_name="Generated")
-    tracto_data.subject_id = 0
+    tracto_data.subject_id = subject_id
     dataset = datasets.TractographyDataset([tracto_data], "Generated", keep_on_cpu=True)
 
     # Override K for gru_multistep
@@ -147,7 +211,7 @@ def compute_loss_errors(streamlines, model, hyperparams):
         hyperparams['k'] = 1
     batch_scheduler = batch_scheduler_factory(hyperparams, dataset, train_mode=False, batch_size_override=1000, use_data_augment=False)
     loss = loss_factory(hyperparams, model, dataset)
-    loss_view = views.LossView(loss=loss, batch_scheduler=batch_scheduler)
+    loss_view = CachedLossView(loss=loss, batch_scheduler=batch_scheduler, function_cache=model.function_cache)
     return loss_view.losses.view()
 
 
@@ -167,6 +231,9 @@ def make_is_outside_mask(mask, affine, threshold=0):
     -------
     function
     """
+    # Invert the affine once instead of at every call of `neurotools.map_coordinates_3d_4d`.
+    inv_affine = np.linalg.inv(affine)
+
     def _is_outside_mask(streamlines, *args):
         """
         Parameters
@@ -180,7 +247,8 @@ def make_is_outside_mask(mask, affine, threshold=0):
             Array telling whether a streamline last coordinate is outside the mask.
         """
         last_coordinates = streamlines[:, -1, :]
-        mask_values = neurotools.map_coordinates_3d_4d(mask, last_coordinates, affine=affine, order=1)
+        last_coordinates = np.dot(last_coordinates, inv_affine[:3, :3]) + inv_affine[:3, 3]
+        mask_values = neurotools.map_coordinates_3d_4d(mask, last_coordinates, order=1)
         return mask_values < threshold
 
     return _is_outside_mask
@@ -216,7 +284,7 @@ def make_is_too_long(max_length):
             Array telling wheter a streamline is too long or not.
         """
         # np.isfinite(streamlines[:, :, 0]) > max_length
-        return np.asarray([streamlines.shape[1] > max_length] * len(streamlines))
+        return np.full(len(streamlines), streamlines.shape[1] > max_length, dtype=bool)
 
     return _is_too_long
 
@@ -339,16 +407,21 @@ def make_is_stopping(stopping_criteria):
 
         if to_check is None:
             idx = np.arange(len(streamlines))
-        elif isinstance(to_check, np.ndarray) and to_check.dtype == np.bool:
-            assert len(to_check) == len(streamlines)
-            idx = np.where(to_check)[0]
         else:
-            idx = to_check
+            if isinstance(to_check, np.ndarray) and to_check.dtype == np.bool_:
+                assert len(to_check) == len(streamlines)
+                idx = np.where(to_check)[0]
+            else:
+                idx = to_check
+
+            # Select streamlines to check once, not for every criterion.
+            streamlines = streamlines[idx]
+            stopping_likelihood = stopping_likelihood[idx]
 
         undone = np.ones(len(idx), dtype=bool)
         flags = np.zeros(len(idx), dtype=np.uint8)
         for flag, stopping_criterion in stopping_criteria.items():
-            done = stopping_criterion(streamlines[idx], stopping_likelihood[idx])
+            done = stopping_criterion(streamlines, stopping_likelihood)
             undone[done] = False
             flags[done] |= flag
 
@@ -358,6 +431,226 @@ def make_is_stopping(stopping_criteria):
     return _is_stopping
 
 
+def make_fused_is_stopping(mask, affine, mask_threshold, max_length, max_theta, likelihood_threshold):
+    """ Makes a function that checks which streamlines should we stop tracking, using all the usual criteria.
+
+    It gives the same results as `make_is_stopping` used with `make_is_outside_mask`, `make_is_too_long`,
+    `make_is_too_curvy` and `make_is_unlikely`, but evaluates all criteria together while only looking
+    at the last three points of the streamlines.
+
+    Parameters
+    ----------
+    mask : 3D array
+        3D image defining a mask (see `make_is_outside_mask`).
+    affine : ndarray of shape (4, 4)
+        Matrix representing the affine transformation that aligns streamlines coordinates on top of `mask`.
+    mask_threshold : float
+        Voxels value higher or equal to this threshold are considered as part of the interior of the mask.
+    max_length : int
+        Maximum number of points a streamline can have.
+    max_theta : float
+        Maximum angle, in degree, two consecutive segments can have with each other.
+    likelihood_threshold : float
+        Minimum likelihood that streamlines must have.
+
+    Returns
+    -------
+    function
+    """
+    inv_affine = np.linalg.inv(affine)
+    max_theta = np.deg2rad(max_theta)  # Internally use radian.
+
+    def _is_stopping(streamlines, stopping_likelihood, to_check=None):
+        """
+        Parameters
+        ----------
+        streamlines : 3D array of shape (n_streamlines, n_points, 3)
+            Streamlines coordinates.
+        stopping_likelihood : 2D array of shape (n_streamlines, 1)
+            Stopping likelihood for all streamlines
+        to_check : 1D array, optional
+            Only check specific streamlines (see `make_is_stopping`).
+
+        Returns
+        -------
+        undone : 1D array
+            Array containing the indices of ongoing streamlines.
+        done : 1D array
+            Array containing the indices of streamlines that should be stopped.
+        flags : 1D array
+            Array containing a flag explaining why a streamline should be stopped.
+        """
+        if to_check is None:
+            idx = np.arange(len(streamlines))
+        elif isinstance(to_check, np.ndarray) and to_check.dtype == np.bool_:
+            idx = np.where(to_check)[0]
+        else:
+            idx = to_check
+
+        nb_points = streamlines.shape[1]
+        last_points = streamlines[idx, -3:]  # Only copy what is needed.
+        flags = np.zeros(len(idx), dtype=np.uint8)
+
+        # Mask
+        last_coordinates = np.dot(last_points[:, -1], inv_affine[:3, :3]) + inv_affine[:3, 3]
+        mask_values = neurotools.map_coordinates_3d_4d(mask, last_coordinates, order=1)
+        flags[mask_values < mask_threshold] |= STOPPING_MASK
+
+        # Length
+        if nb_points > max_length:
+            flags |= STOPPING_LENGTH
+
+        # Curvature
+        if nb_points >= 3:
+            last_segments = last_points[:, -1] - last_points[:, -2]
+            before_last_segments = last_points[:, -2] - last_points[:, -3]
+            last_segments /= np.sqrt(np.sum(last_segments**2, axis=1, keepdims=True))
+            before_last_segments /= np.sqrt(np.sum(before_last_segments**2, axis=1, keepdims=True))
+            angles = np.arccos(np.sum(last_segments * before_last_segments, axis=1))
+            flags[angles > max_theta] |= STOPPING_CURVATURE
+
+        # Likelihood
+        flags[stopping_likelihood[idx, 0] < likelihood_threshold] |= STOPPING_LIKELIHOOD
+
+        done = flags != 0
+        return idx[np.logical_not(done)], idx[done], flags[done]
+
+    return _is_stopping
+
+
+def make_is_empty():
+    """ Makes a function that checks which streamlines have no points. """
+
+    def _is_empty(tractogram):
+        """
+        Parameters
+        ----------
+        tractogram : `nib.streamlines.Tractogram` object
+            Streamlines to check.
+
+        Returns
+        -------
+        empty : 1D array of shape (n_streamlines,)
+            Array telling whether a streamline has no points or not.
+        """
+        return np.array(list(map(len, tractogram.streamlines))) <= 0
+
+    return _is_empty
+
+
+def make_is_too_short(min_length):
+    """ Makes a function that checks which streamlines are shorter than `min_length` mm.
+
+    Parameters
+    ----------
+    min_length : float
+        Minimum length (in mm) for a streamline.
+    """
+
+    def _is_too_short(tractogram):
+        """
+        Parameters
+        ----------
+        tractogram : `nib.streamlines.Tractogram` object
+            Streamlines to check (in RAS+mm).
+
+        Returns
+        -------
+        too_short : 1D array of shape (n_streamlines,)
+            Array telling whether a streamline is too short or not.
+        """
+        return np.asarray(dipy.tracking.streamline.length(tractogram.streamlines)) < min_length
+
+    return _is_too_short
+
+
+def make_is_stopped_by(ref_flag):
+    """ Makes a function that checks which streamlines were stopped because of `ref_flag`.
+
+    Parameters
+    ----------
+    ref_flag : int
+        One of the stopping flags constant variable defined above.
+    """
+
+    def _is_stopped_by(tractogram):
+        """
+        Parameters
+        ----------
+        tractogram : `nib.streamlines.Tractogram` object
+            Streamlines to check. They must have 'stopping_flags' in their `data_per_streamline`.
+
+        Returns
+        -------
+        stopped : 1D array of shape (n_streamlines,)
+            Array telling whether a streamline was stopped because of `ref_flag` or not.
+        """
+        return is_flag_set(tractogram.data_per_streamline['stopping_flags'][:, 0], ref_flag)
+
+    return _is_stopped_by
+
+
+def make_has_high_loss(model, hyperparams, threshold, subject_id=0):
+    """ Makes a function that checks which streamlines produce a loss higher than `threshold`.
+
+    Streamlines are fed to `model` (see `compute_loss_errors`) unless their loss has been computed
+    while tracking them (see --track-loss), in which case it is found in `data_per_streamline['losses']`
+    (see `make_tracking_loss`). Both losses differ: the former is the one of the compressed streamlines in RAS+mm.
+
+    Parameters
+    ----------
+    model : `smartlearner.interfaces.Model` object
+        Model used to evaluate the loss of the streamlines.
+    hyperparams : dict
+        Hyperparameters of the experiment `model` comes from.
+    threshold : float
+        Maximum loss value a streamline can produce.
+    subject_id : int, optional
+        ID of the subject whose diffusion volume the streamlines are evaluated in. Default: 0.
+
+    The returned function has a `print_summary` attribute printing the mean loss of all the streamlines it checked.
+    """
+    # Streamlines are checked one batch at a time, their mean loss is only reported once (see `StreamlinesFilterChain.close`).
+    stats = {'nb_losses': 0, 'sum': 0., 'sum_squares': 0.}
+
+    def _has_high_loss(tractogram):
+        """
+        Parameters
+        ----------
+        tractogram : `nib.streamlines.Tractogram` object
+            Streamlines to check.
+
+        Returns
+        -------
+        high_loss : 1D array of shape (n_streamlines,)
+            Array telling whether a streamline produces a loss higher than `threshold` or not.
+        """
+        if len(tractogram) == 0:
+            return np.zeros(0, dtype=bool)
+
+        if 'losses' in tractogram.data_per_streamline:
+            losses = tractogram.data_per_streamline['losses'].reshape(-1)
+        else:
+            losses = compute_loss_errors(tractogram.streamlines, model, hyperparams, subject_id)
+
+        stats['nb_losses'] += len(losses)
+        stats['sum'] += np.sum(losses, dtype=np.float64)
+        stats['sum_squares'] += np.sum(np.square(losses, dtype=np.float64))
+        return losses > threshold
+
+    def _print_summary():
+        nb_losses = stats['nb_losses']
+        if nb_losses == 0:
+            return
+
+        mean = stats['sum'] / nb_losses
+        std = np.sqrt(max(stats['sum_squares'] - nb_losses * mean**2, 0.) / max(nb_losses - 1, 1))
+        print("Mean loss: {:.4f} ± {:.4f}".format(mean, std / np.sqrt(nb_losses)))
+
+    _has_high_loss.print_summary = _print_summary
+    return _has_high_loss
+
+
 def rotate(directions, axis, degree=180):
     assert degree == 180, "Only supports rotation of 180 degrees."
     new_directions = []
@@ -367,18 +660,210 @@ def rotate(directions, axis, degree=180):
     return np.stack(new_directions, axis=0)
 
 
+def get_morton_order(points):
+    """ Returns the indices sorting `points` (in voxel space) along a Z-order (Morton) curve.
+
+    The curve goes through the volume octant by octant, so points that are next to each
+    other in that order are also close in the volume. Points in the same voxel share the same code.
+    """
+    if len(points) == 0:
+        return np.arange(0)
+
+    voxels = np.floor(points - points.min(axis=0)).astype(np.uint64)
+    nb_bits = min(int(voxels.max()).bit_length(), 21)  # 3 x 21 bits fit in a uint64.
+    codes = np.zeros(len(points), dtype=np.uint64)
+    for bit in range(nb_bits):
+        for axis in range(3):
+            # Interleave the bits of the coordinates: ...z1y1x1z0y0x0
+            codes |= ((voxels[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + axis)
+
+    return np.argsort(codes, kind='mergesort')
+
+
+class SproutBuffer(object):
+    """ Growable buffer holding the coordinates of the sprouts being tracked.
+
+    New points are written in place in a preallocated array of shape
+    (nb_sprouts, capacity, 3) instead of rebuilding the whole array at every step.
+    The capacity is doubled whenever a sprout would overflow it.
+    Other values recorded at every step (e.g. the outputs of the model) can be held the same way.
+    """
+    def __init__(self, seeds, capacity=None):
+        """
+        Parameters
+        ----------
+        seeds : 3D array of shape (nb_sprouts, nb_points, 3)
+            Initial points of every sprout.
+        capacity : int, optional
+            Maximum number of points a sprout is expected to have. Default: grow as needed.
+        """
+        nb_sprouts, nb_points = seeds.shape[:2]
+        capacity = max(nb_points + 1, capacity or 0)
+        self.data = np.zeros((nb_sprouts, capacity) + seeds.shape[2:], dtype=seeds.dtype)
+        self.data[:, :nb_points] = seeds
+        self.lengths = np.full(nb_sprouts, nb_points, dtype=np.int64)
+        self.size = nb_sprouts
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nb_points(self):
+        return self.lengths.max() if self.size > 0 else 0
+
+    def view(self):
+        """ Returns a view (no copy) of the sprouts as a 3D array of shape (nb_sprouts, nb_points, 3).
+
+        Notes
+        -----
+        Only meaningful when all sprouts have the same length, which is the
+        case for sprouts that are grown together by a `Tracker`.
+        """
+        return self.data[:self.size, :self.nb_points]
+
+    def _reserve(self, nb_points):
+        if nb_points <= self.data.shape[1]:
+            return
+
+        capacity = max(nb_points, 2 * self.data.shape[1])
+        data = np.zeros((self.data.shape[0], capacity) + self.data.shape[2:], dtype=self.data.dtype)
+        data[:self.size, :self.data.shape[1]] = self.data[:self.size]
+        self.data = data
+
+    def append(self, points):
+        """ Writes one new point at the end of every sprout. """
+        self._reserve(self.nb_points + 1)
+        self.data[np.arange(self.size), self.lengths] = points
+        self.lengths += 1
+
+    def get(self, idx, trim=0):
+        """ Returns a copy of the sprouts at `idx`, without their last `trim` points. """
+        return [self.data[i, :self.lengths[i] - trim].copy() for i in idx]
+
+    def keep(self, idx):
+        """ Compacts the buffer in place so that it only contains the sprouts at `idx`. """
+        nb_points = self.nb_points
+        kept = self.data[idx, :nb_points]
+        self.size = len(kept)
+        self.data[:self.size, :nb_points] = kept
+        self.lengths = self.lengths[idx]
+
+
+class StateHistory(object):
+    """ Ring buffer of the model states of every sprout over the last `depth` steps.
+
+    States are copied in preallocated arrays of shape (depth, nb_sprouts, hidden_size), one per layer,
+    and the oldest step is overwritten by the newest. Sprouts removed with `keep` are not moved:
+    only the mapping from sprouts to rows of the arrays is updated. With a `depth` of 0
+    (i.e. when not regrowing sprouts), nothing is stored.
+    """
+    def __init__(self, depth, init_states):
+        """
+        Parameters
+        ----------
+        depth : int
+            Number of steps to remember.
+        init_states : list of 2D array of shape (nb_sprouts, hidden_size)
+            Initial states of the model, used to allocate the buffers.
+        """
+        self.depth = depth
+        self.nb_steps = 0
+        self._rows = np.arange(len(init_states[0]))
+        self._buffers = [np.empty((depth,) + state.shape, dtype=state.dtype) for state in init_states] if depth > 0 else []
+
+    def __len__(self):
+        return min(self.nb_steps, self.depth)
+
+    def _slot(self, step):
+        """ Returns the position in the buffers of `step` (-1 being the most recent one). """
+        assert -len(self) <= step < 0, "Step {} is not in history.".format(step)
+        return (self.nb_steps + step) % self.depth
+
+    def push(self, states):
+        """ Remembers the states of every sprout, forgetting the oldest ones if needed. """
+        if self.depth == 0:
+            return
+
+        slot = self.nb_steps % self.depth
+        for buffer, state in zip(self._buffers, states):
+            buffer[slot, self._rows] = state
+
+        self.nb_steps += 1
+
+    def get(self, step, idx):
+        """ Returns a copy of the states of the sprouts at `idx`, `-step` steps ago. """
+        slot = self._slot(step)
+        return [buffer[slot, self._rows[idx]] for buffer in self._buffers]
+
+    def set(self, step, idx, states):
+        """ Overwrites the states of the sprouts at `idx`, `-step` steps ago. """
+        slot = self._slot(step)
+        for buffer, state in zip(self._buffers, states):
+            buffer[slot, self._rows[idx]] = state
+
+    def keep(self, idx):
+        """ Forgets every sprout except the ones at `idx`. """
+        self._rows = self._rows[idx]
+
+    def duplicate(self, nb_copies=2):
+        """ Returns a history where every sprout appears `nb_copies` times: first all sprouts, then their copies. """
+        history = copy.copy(self)
+        history._rows = np.arange(nb_copies * len(self._rows))
+        history._buffers = [np.concatenate([buffer[:, self._rows]] * nb_copies, axis=1) for buffer in self._buffers]
+        return history
+
+    def extend(self, states):
+        """ Returns a history with new sprouts after the current ones, whose states were `states` at every remembered step. """
+        history = copy.copy(self)
+        history._rows = np.arange(len(self._rows) + len(states[0]))
+        history._buffers = [np.concatenate([buffer[:, self._rows], np.broadcast_to(state, (self.depth,) + state.shape)], axis=1)
+                            for buffer, state in zip(self._buffers, states)]
+        return history
+
+
 class Tracker(object):
-    def __init__(self, model, is_stopping, keep_last_n_states=1, use_max_component=False, flip_x=False, flip_y=False, flip_z=False, compress_streamlines=False):
+    def __init__(self, model, is_stopping, keep_last_n_states=1, use_max_component=False, flip_x=False, flip_y=False, flip_z=False, compress_streamlines=False,
+                 max_nb_points=None, rng_seed=1234, use_numpy_inference=False, sort_sprouts=False, subject_id=0, loss=None,
+                 nb_samples_per_seed=1):
         self.model = model
-        self.learn_to_stop = model.learn_to_stop
+        self.learn_to_stop = getattr(model, 'learn_to_stop', False)  # Not all models can learn to stop (e.g. FFNN_Regression).
         self._is_stopping = is_stopping
-        self.grower = model.make_sequence_generator(use_max_component=use_max_component)
-        self.keep_last_n_states = max(keep_last_n_states, 1)
-        self._history = []
+        # With a `loss` (see `numpy_inference.make_numpy_loss`), outputs of the model are recorded at every step
+        # so the loss of streamlines can be given at harvest, without feeding them to the model again.
+        self.loss = loss
+        # With several samples per seed, the first step is taken once per seed, then sampled for every sprout (see `_branch`).
+        self.nb_samples_per_seed = nb_samples_per_seed
+        self._sampler = None
+        if nb_samples_per_seed > 1:
+            from learn2track.numpy_inference import make_numpy_sampler
+            self._sampler = make_numpy_sampler(model, use_max_component=use_max_component, rng_seed=[rng_seed, 1])
+
+        self._nb_branches = 1
+        generator_kwargs = dict(use_max_component=use_max_component, rng_seed=rng_seed)
+        if loss is not None or nb_samples_per_seed > 1:
+            # Only asked for when needed, so models whose generator cannot return it still track.
+            generator_kwargs['return_regression_output'] = True
+        if use_numpy_inference:
+            from learn2track.numpy_inference import make_numpy_sequence_generator
+            self.grower = make_numpy_sequence_generator(model, **generator_kwargs)
+        else:
+            self.grower = model.make_sequence_generator(**generator_kwargs)
+        self.keep_last_n_states = max(keep_last_n_states, 0)
+        self._history = None
         self.flip_x = flip_x
         self.flip_y = flip_y
         self.flip_z = flip_z
         self.compress_streamlines = compress_streamlines
+        self.max_nb_points = max_nb_points
+        self.sort_sprouts = sort_sprouts
+        self.subject_id = subject_id  # Whose diffusion volume is used (see `neurotools.VolumeManager`).
+        self._buffer = None
+        self._outputs = None
+        self._stopping_cache = None
+
+    @property
+    def sprouts(self):
+        return self._buffer.view()
 
     @property
     def states(self):
@@ -386,12 +871,9 @@ class Tracker(object):
 
     @states.setter
     def states(self, values):
-        # Add new states to history; free space if needed.
-        self._history += [self._states.copy()]
-        if len(self._history) > self.keep_last_n_states:
-            self._history = self._history[1:]
-
-        self._states = values.copy()
+        # Add current states to history, overwriting the oldest ones if needed.
+        self._history.push(self._states)
+        self._states = list(values)
 
     def is_stopping(self, sprouts, sprouts_stop):
         undone, done, stopping_flags = self._is_stopping(sprouts, sprouts_stop)
@@ -400,20 +882,41 @@ class Tracker(object):
     def is_ripe(self):
         return len(self.sprouts) == 0
 
+    def for_subject(self, subject_id, is_stopping):
+        """ Returns a copy of this tracker (sharing its grower) tracking in the volume of another subject. """
+        tracker = copy.copy(self)
+        tracker.subject_id = subject_id
+        tracker._is_stopping = is_stopping
+        return tracker
+
+    def _check_sprouts(self):
+        """ Checks which sprouts should stop, reusing the result as long as sprouts haven't changed. """
+        if self._stopping_cache is None:
+            self._stopping_cache = self.is_stopping(self.sprouts, self.sprouts_stop)
+
+        return self._stopping_cache
+
     def get(self, flag):
-        _, done, stopping_flags = self.is_stopping(self.sprouts, self.sprouts_stop)
+        _, done, stopping_flags = self._check_sprouts()
         return done[(stopping_flags & flag) != 0]
 
     def plant(self, seeds):
         if seeds.ndim == 2:
             seeds = seeds[:, None, :]
 
-        self.sprouts = seeds.copy()
-        self.sprouts_stop = np.ones((self.sprouts.shape[0], 1))
+        # Sprouts cannot have more than `max_nb_points`+1 points since they are stopped right after.
+        capacity = None if self.max_nb_points is None else self.max_nb_points + 2
+        self._buffer = SproutBuffer(seeds, capacity=capacity)
+        self.sprouts_stop = np.ones((len(seeds), 1))
+        self.seed_ids = np.arange(len(seeds))  # Index of the seed of every sprout.
         self._states = self.model.get_init_states(batch_size=len(seeds))
+        self._history = StateHistory(self.keep_last_n_states, self._states)
+        self._outputs = None
+        self._stopping_cache = None
+        self._nb_branches = self.nb_samples_per_seed
 
-    def _grow_step(self, sprouts, states, step_size):
-
+    def _get_grower_inputs(self, sprouts):
+        """ Returns the last point and the previous direction of every sprout. """
         # Always feed previous direction, grower will choose to use it or not
         if sprouts.shape[1] >= 2:
             previous_direction = sprouts[:, -1, :] - sprouts[:, -2, :]
@@ -421,10 +924,63 @@ class Tracker(object):
             previous_direction = np.zeros_like(sprouts[:, -1, :])
 
         previous_direction = previous_direction / np.sqrt(np.sum(previous_direction ** 2, axis=1, keepdims=True) + 1e-6)
+        return sprouts[:, -1, :], previous_direction
+
+    def _predict(self, x_t, states, previous_direction, subject_ids):
+        """ Calls the grower.
+
+        Returns
+        -------
+        outputs : 2D array or tuple of 2D arrays
+            Outputs of the grower (see `_get_new_points`).
+        new_states : list of 2D array
+            Updated states of the model.
+        regression_output : 2D array of shape (n_sprouts, regression_layer_size)
+            Output of the regression layer of the model, needed by `loss` and to draw several samples per seed.
+            None if there is no `loss` and a single sample per seed.
+        """
+        if self._sampler is None and self.loss is None:
+            outputs, new_states = self.grower(x_t=x_t, states=states, previous_direction=previous_direction, subject_ids=subject_ids)
+            return outputs, new_states, None
+
+        return self.grower(x_t=x_t, states=states, previous_direction=previous_direction, subject_ids=subject_ids)
+
+    def _get_step_outputs(self, outputs, regression_output):
+        """ Returns the outputs of the model needed by `loss`: the output of its regression layer, followed by the
+        likelihood to keep growing if the model learns to stop. None if there is no `loss`.
+        """
+        if self.loss is None:
+            return None
+
+        if self.learn_to_stop:
+            return np.concatenate([regression_output, outputs[1]], axis=1)
+
+        return np.array(regression_output)  # Copy, directions may be flipped in place.
+
+    def _grow_step(self, sprouts, states, step_size):
+        """ Predicts the next point of every sprout.
+
+        Returns
+        -------
+        new_points : 2D array of shape (n_sprouts, 3)
+            Next coordinates to append to the sprouts.
+        stopping : 2D array of shape (n_sprouts, 1)
+            Likelihood to keep growing.
+        new_states : list of 2D array
+            Updated states of the model.
+        step_outputs : 2D array of shape (n_sprouts, n_outputs)
+            Outputs of the model to record (see `_get_step_outputs`).
+        """
+        x_t, previous_direction = self._get_grower_inputs(sprouts)
 
         # Get next unnormalized directions
-        outputs, new_states = self.grower(x_t=sprouts[:, -1, :], states=states, previous_direction=previous_direction)
+        outputs, new_states, regression_output = self._predict(x_t, states, previous_direction, np.full(len(x_t), self.subject_id))
+        step_outputs = self._get_step_outputs(outputs, regression_output)
+        new_points, stopping = self._get_new_points(sprouts, outputs, step_size)
+        return new_points, stopping, new_states, step_outputs
 
+    def _get_new_points(self, sprouts, outputs, step_size):
+        """ Turns the grower's `outputs` into the next point and the stopping likelihood of every sprout. """
         if self.learn_to_stop:
             directions, stopping = outputs
         else:
@@ -444,35 +1000,120 @@ class Tracker(object):
             directions = normalized_directions * step_size
 
         # Take a step i.e. it's growing!
-        new_sprouts = np.concatenate([sprouts, sprouts[:, [-1], :] + directions[:, None, :]], axis=1)
-        return new_sprouts, stopping, new_states
+        new_points = sprouts[:, -1, :] + directions
+        return new_points, stopping
 
     def grow(self, step_size):
-        self.sprouts, self.sprouts_stop, self.states = self._grow_step(self.sprouts, self.states, step_size)
+        x_t, previous_direction = self._get_grower_inputs(self.sprouts)
+        outputs, new_states, regression_output = self._predict(x_t, self.states, previous_direction,
+                                                               np.full(len(x_t), self.subject_id))
+        self._take_step(outputs, new_states, regression_output, step_size)
+
+    def _take_step(self, outputs, new_states, regression_output, step_size):
+        """ Moves every sprout to its next point and updates its states, given the outputs of `_predict`. """
+        if self._nb_branches > 1:
+            outputs, new_states, regression_output = self._branch(outputs, new_states, regression_output)
+
+        step_outputs = self._get_step_outputs(outputs, regression_output)
+        new_points, stopping = self._get_new_points(self.sprouts, outputs, step_size)
+        self.states = new_states
+        self._add_points(new_points, stopping)
+        self._record(step_outputs)
+
+    def _branch(self, outputs, new_states, regression_output):
+        """ Turns every sprout, about to take its first step, into `nb_samples_per_seed` sprouts.
+
+        The model ran once per seed: samples of a seed only differ by the direction drawn from its output.
+        They are then grown independently, starting from copies of the states of their seed. Seed ids become
+        sample ids, sample `k` of seed `i` having id `i * nb_samples_per_seed + k`.
+
+        Returns
+        -------
+        outputs, new_states, regression_output
+            Same as `_predict`, for every sample.
+        """
+        nb_samples, nb_seeds = self._nb_branches, len(self.sprouts)
+        rows = np.tile(np.arange(nb_seeds), nb_samples)
+        regression_output = regression_output[rows]
+        directions = self._sampler(regression_output)
+        outputs = (directions, outputs[1][rows]) if self.learn_to_stop else directions
+        new_states = [s[rows] for s in new_states]
+
+        self._buffer = SproutBuffer(self.sprouts[rows], capacity=self._buffer.data.shape[1])
+        self.sprouts_stop = self.sprouts_stop[rows]
+        self.seed_ids = self.seed_ids[rows] * nb_samples + np.repeat(np.arange(nb_samples), nb_seeds)
+        self._states = [s[rows] for s in self._states]
+        self._history = self._history.duplicate(nb_samples)
+        self._stopping_cache = None
+        self._nb_branches = 1
+        return outputs, new_states, regression_output
+
+    def _add_points(self, new_points, stopping):
+        self._buffer.append(new_points)
+        self.sprouts_stop = stopping
+        self._stopping_cache = None
+
+    def _record(self, step_outputs):
+        """ Records the outputs of the model that led to the last point of every sprout (see `_predict`). """
+        if step_outputs is None:
+            return
+
+        if self._outputs is None:
+            # Sprouts have one more point than steps: their seed.
+            self._outputs = SproutBuffer(np.zeros((len(step_outputs), 0, step_outputs.shape[1]), dtype=step_outputs.dtype),
+                                         capacity=self._buffer.data.shape[1] - 1)
+
+        self._outputs.append(step_outputs)
+
+    def _get_losses(self, idx):
+        """ Evaluates `loss` on the sprouts at `idx`, using the outputs recorded while growing them. """
+        # Like in `harvest`, the last point is not part of the streamlines.
+        points = self.sprouts[idx, :-1]
+        targets = points[:, 1:] - points[:, :-1]
+        step_outputs = self._outputs.view()[idx, :targets.shape[1]]
+        if self.learn_to_stop:
+            return self.loss(step_outputs[..., :-1], step_outputs[..., -1], targets)
+
+        return self.loss(step_outputs, None, targets)
 
     def _keep(self, idx):
         # Update remaining sprouts and their states.
-        self.sprouts = self.sprouts[idx]
+        self._buffer.keep(idx)
+        if self._outputs is not None:
+            self._outputs.keep(idx)
+        self._stopping_cache = None
         self.sprouts_stop = self.sprouts_stop[idx]
+        self.seed_ids = self.seed_ids[idx]
         self._states = [s[idx] for s in self._states]
 
-        # Rewrite history
-        for i, state in enumerate(self._history):
-            self._history[i] = [s[idx] for s in state]
+        self._history.keep(idx)
+
+    def _compaction_order(self, undone):
+        """ Returns the order in which to keep `undone` sprouts, sorted along a Z-order curve if `sort_sprouts`. """
+        if self.sort_sprouts and len(undone) > 1:
+            # Sprouts growing next to each other read neighboring parts of the volume.
+            return undone[get_morton_order(self.sprouts[undone, -1])]
+
+        return undone
 
     def harvest(self):
-        undone, done, stopping_flags = self.is_stopping(self.sprouts, self.sprouts_stop)
+        undone, done, stopping_flags = self._check_sprouts()
 
         # Do not keep last point since it almost surely raised the stopping flag.
-        streamlines = list(self.sprouts[done, :-1])
+        streamlines = self._buffer.get(done, trim=1)
         if self.compress_streamlines:
             streamlines = compress_streamlines(streamlines)
 
-        tractogram = Tractogram(streamlines=streamlines,
-                                data_per_streamline={"stopping_flags": stopping_flags})
+        data_per_streamline = {"stopping_flags": stopping_flags,
+                               "seed_ids": self.seed_ids[done]}
+        if self.loss is not None:
+            data_per_streamline["losses"] = self._get_losses(done)
+
+        tractogram = Tractogram(streamlines=streamlines, data_per_streamline=data_per_streamline)
 
         # Keep only undone sprouts
-        self._keep(undone)
+        if len(done) > 0:
+            self._keep(self._compaction_order(undone))
 
         return tractogram
 
@@ -481,10 +1122,12 @@ class Tracker(object):
             # Cannot regrow sprouts that are too small.
             return 0
 
-        # Get sprouts that needs regrowing.
-        sprouts = self.sprouts[idx, :-backtrack_n_steps]
+        # Get a copy of the sprouts that needs regrowing, their last points will be overwritten in place.
+        sprouts = self.sprouts[idx]
+        outputs = None if self._outputs is None else self._outputs.view()[idx]
+        nb_points = sprouts.shape[1] - backtrack_n_steps
         stopping = np.ones((sprouts.shape[0], 1))
-        states = [s[idx] for s in self._history[-backtrack_n_steps]]
+        states = self._history.get(-backtrack_n_steps, idx)
         idx_to_keep = np.arange(len(sprouts))
 
         local_history = []
@@ -494,10 +1137,15 @@ class Tracker(object):
                 return 0
 
             local_history += [states]
-            sprouts, stopping, states = self._grow_step(sprouts, states, step_size)
+            new_points, stopping, states, step_outputs = self._grow_step(sprouts[:, :nb_points], states, step_size)
+            sprouts[:, nb_points] = new_points
+            if outputs is not None:
+                outputs[:, nb_points - 1] = step_outputs
+            nb_points += 1
 
-            undone, _, _ = self.is_stopping(sprouts, stopping)
+            undone, _, _ = self.is_stopping(sprouts[:, :nb_points], stopping)
             sprouts = sprouts[undone]
+            outputs = None if outputs is None else outputs[undone]
             stopping = stopping[undone]
             states = [s[undone] for s in states]
             idx_to_keep = idx_to_keep[undone]
@@ -508,15 +1156,17 @@ class Tracker(object):
 
         # Update original sprouts and their states.
         self.sprouts[idx[idx_to_keep]] = sprouts
+        if outputs is not None:
+            self._outputs.view()[idx[idx_to_keep]] = outputs
         self.sprouts_stop[idx[idx_to_keep]] = stopping
+        self._stopping_cache = None
         for i, state in enumerate(self._states):
             self._states[i][idx[idx_to_keep]] = states[i]
 
         # Rewrite history
-        assert len(self._history[-backtrack_n_steps:]) == len(local_history)
-        for j, old_states in enumerate(self._history[-backtrack_n_steps:], start=-backtrack_n_steps):
-            for i, old_state in enumerate(old_states):
-                self._history[j][i][idx[idx_to_keep]] = local_history[j][i]
+        assert len(local_history) == backtrack_n_steps
+        for step, old_states in zip(range(-backtrack_n_steps, 0), local_history):
+            self._history.set(step, idx[idx_to_keep], old_states)
 
         return len(idx_to_keep)  # Number of successful regrowths.
 
@@ -532,19 +1182,19 @@ class PeterTracker(Tracker):
             # Cannot regrow sprouts that are too small.
             return 0
 
-        # Get sprouts that needs regrowing.
-        sprouts = self.sprouts[idx, :-backtrack_n_steps]
+        # Get a copy of the sprouts that needs regrowing, their last point will be overwritten in place.
+        sprouts = self.sprouts[idx]
         idx_to_keep = np.arange(len(sprouts))
 
         if len(sprouts) == 0:
             # Nothing left to regrow, no sprouts could be saved.
             return 0
 
-        previous_directions = self.sprouts[idx, -2, :] - self.sprouts[idx, -3, :]
-        predicted_directions = self.sprouts[idx, -1, :] - self.sprouts[idx, -2, :]
+        previous_directions = sprouts[:, -2, :] - sprouts[:, -3, :]
+        predicted_directions = sprouts[:, -1, :] - sprouts[:, -2, :]
         directions = rotate(predicted_directions, axis=previous_directions, degree=180)
 
-        sprouts = np.concatenate([sprouts, sprouts[:, [-1], :] + directions[:, None, :]], axis=1)
+        sprouts[:, -1, :] = sprouts[:, -2, :] + directions
         stopping = np.ones((sprouts.shape[0], 1))
         # TODO: need to update the state of RNN-like models.
         states = self.states
@@ -559,6 +1209,7 @@ class PeterTracker(Tracker):
         # Update original sprouts and their states.
         self.sprouts[idx[idx_to_keep]] = sprouts
         self.sprouts_stop[idx[idx_to_keep]] = stopping
+        self._stopping_cache = None
         for i, state in enumerate(self._states):
             self._states[i][idx[idx_to_keep]] = states[i]
 
@@ -569,8 +1220,13 @@ class BackwardTracker(Tracker):
     def plant(self, seeds):
         self.seeds = seeds
         self.nb_init_steps = np.asarray(list(map(len, seeds)))
-        self.sprouts = np.asarray([s[0] for s in seeds])[:, None, :]
+        capacity = None if self.max_nb_points is None else self.max_nb_points + 2
+        self._buffer = SproutBuffer(np.asarray([s[0] for s in seeds])[:, None, :], capacity=capacity)
+        self.seed_ids = np.arange(len(seeds))
         self._states = self.model.get_init_states(batch_size=len(seeds))
+        self._history = StateHistory(self.keep_last_n_states, self._states)
+        self._outputs = None
+        self._stopping_cache = None
 
     def is_stopping(self, sprouts, sprouts_stop):
         undone, done, stopping_flags = self._is_stopping(sprouts, sprouts_stop)
@@ -587,18 +1243,19 @@ class BackwardTracker(Tracker):
 
         return undone, done, stopping_flags
 
-    def grow(self, step_size):
-        new_sprouts, stopping, self.states = self._grow_step(self.sprouts, self.states, step_size)
+    def _add_points(self, new_points, stopping):
+        nb_points = self.sprouts.shape[1] + 1
 
         # Only update sprouts once they are done initializing.
         # However always update their states.
-        init_undone = self.nb_init_steps >= new_sprouts.shape[1]
+        init_undone = self.nb_init_steps >= nb_points
         if np.any(init_undone):
-            new_sprouts[init_undone, -1] = [s[new_sprouts.shape[1]-1] for s, undone in zip(self.seeds, init_undone) if undone]
+            new_points[init_undone] = [s[nb_points-1] for s, undone in zip(self.seeds, init_undone) if undone]
             stopping[init_undone, -1] = 1.
 
-        self.sprouts = new_sprouts
+        self._buffer.append(new_points)
         self.sprouts_stop = stopping
+        self._stopping_cache = None
 
     def regrow(self, idx, step_size, backtrack_n_steps):
         init_done = self.nb_init_steps < self.sprouts.shape[1]
@@ -619,130 +1276,1323 @@ class BackwardPeterTracker(BackwardTracker, PeterTracker):
         return PeterTracker.regrow(self, idx, step_size, backtrack_n_steps)
 
 
-def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps=0, verbose=False):
-    """ Generates streamlines using the Particle Filtering Tractography algorithm.
-
-    This algorithm is inspired from Girard etal. (2014) Neuroimage.
+class BidirectionalTracker(Tracker):
+    """ Grows both halves of the streamlines at the same time, starting from the seeds.
 
-    Parameters
-    ----------
-    is_stopping : function
-        Tells whether a streamlines should stop being tracked.
-        This function expects a list of streamlines and returns a 3-tuple:
-          the indices of the streamlines that are undone,
-          the indices of the streamlines that are done,
-          the reasons why the streamlines should be stopped.
+    Once the first step has been taken from a seed, a second sprout (the backward half) is
+    started at that seed: the model takes its first step from fresh states, heading in the opposite direction.
+    That way, the forward half never has to be fed back to the model (see `BackwardTracker`).
+    Halves are joined when both are done; their total number of points cannot exceed `max_nb_points`.
+    Since the joined streamlines are not fed to the model from one end to the other, they have no `loss`.
     """
-    tractogram = None
-    tracker.plant(seeds)
+    def plant(self, seeds):
+        if self.loss is not None:
+            raise ValueError("Streamlines tracked in both directions at once cannot be given a loss.")
+
+        super().plant(seeds)
+        self.is_backward = np.zeros(len(seeds), dtype=bool)
+        self.partner_lengths = np.zeros(len(seeds), dtype=np.int64)  # 0: partner is still growing.
+        self._pending = {}
+        self._split = False
+
+    def _take_step(self, outputs, new_states, regression_output, step_size):
+        super()._take_step(outputs, new_states, regression_output, step_size)
+        if not self._split:
+            self._start_backward_halves(step_size)
+
+    def _branch(self, outputs, new_states, regression_output):
+        rows = np.tile(np.arange(len(self.sprouts)), self._nb_branches)
+        self.is_backward = self.is_backward[rows]
+        self.partner_lengths = self.partner_lengths[rows]
+        return super()._branch(outputs, new_states, regression_output)
+
+    def _start_backward_halves(self, step_size):
+        """ Takes the first step of the backward half of every sprout, which just took its first (forward) step.
+
+        The model is given the seed, fresh states and the reversed initial direction as previous direction.
+        Since a direction and its opposite describe the same fiber, predictions heading back towards
+        the forward half are turned around.
+        """
+        self._split = True
+        forward = self.sprouts
+        x_t, previous_direction = self._get_grower_inputs(forward[:, ::-1])  # From the first point to the seed.
+        init_states = self.model.get_init_states(batch_size=len(forward))
+        outputs, new_states, _ = self._predict(x_t, init_states, previous_direction, np.full(len(x_t), self.subject_id))
+        new_points, stopping = self._get_new_points(forward[:, :1], outputs, step_size)
+
+        directions = new_points - x_t
+        heading_forward = np.sum(directions * (forward[:, 1] - x_t), axis=1) > 0
+        new_points[heading_forward] = x_t[heading_forward] - directions[heading_forward]
+        backward = np.repeat(forward[:, :1], 2, axis=1)
+        backward[:, 1] = new_points
+
+        self._buffer = SproutBuffer(np.concatenate([forward, backward]), capacity=self._buffer.data.shape[1])
+        self.sprouts_stop = np.concatenate([self.sprouts_stop, stopping])
+        self._states = [np.concatenate([s, s_new]) for s, s_new in zip(self._states, new_states)]
+        self._history = self._history.extend(init_states)
+        self.seed_ids = np.r_[self.seed_ids, self.seed_ids]
+        self.is_backward = np.r_[self.is_backward, np.ones(len(self.is_backward), dtype=bool)]
+        self.partner_lengths = np.r_[self.partner_lengths, self.partner_lengths]
+        self._stopping_cache = None
+
+    def _check_sprouts(self):
+        if self._stopping_cache is None:
+            undone, done, stopping_flags = self.is_stopping(self.sprouts, self.sprouts_stop)
+
+            if self.max_nb_points is not None and len(undone) > 0:
+                # Both halves count towards the length of the joined streamline (they share the seed).
+                nb_points = self.sprouts.shape[1]
+                partner_lengths = self.partner_lengths[undone]
+                partner_lengths = np.where(partner_lengths > 0, partner_lengths, nb_points)
+                too_long = nb_points + partner_lengths - 1 > self.max_nb_points
+                if np.any(too_long):
+                    done = np.r_[done, undone[too_long]].astype(int)
+                    stopping_flags = np.r_[stopping_flags, np.full(np.sum(too_long), STOPPING_LENGTH, dtype=stopping_flags.dtype)]
+                    undone = undone[~too_long]
+
+            self._stopping_cache = undone, done, stopping_flags
+
+        return self._stopping_cache
 
-    i = 1
-    while not tracker.is_ripe():
-        if verbose:
-            print("pts: {}/{} ({:,} remaining)".format(i+1, is_stopping.max_nb_points, len(tracker.sprouts)), end="")
+    def harvest(self):
+        undone, done, stopping_flags = self._check_sprouts()
 
-        tracker.grow(step_size)
+        # Do not keep last point since it almost surely raised the stopping flag.
+        halves = self._buffer.get(done, trim=1)
+
+        streamlines = []
+        joined_stopping_flags = []
+        joined_seed_ids = []
+        pending_seed_ids = []
+        pending_lengths = []
+        for i, half, flags in zip(done, halves, stopping_flags):
+            seed_id = self.seed_ids[i]
+            if seed_id not in self._pending:
+                self._pending[seed_id] = (half, flags)
+                pending_seed_ids.append(seed_id)
+                pending_lengths.append(len(half))
+                continue
+
+            other_half, other_flags = self._pending.pop(seed_id)
+            forward, backward = (other_half, half) if self.is_backward[i] else (half, other_half)
+            streamlines.append(np.concatenate([backward[::-1], forward[1:]]))
+            # Like the two-pass tracking, report why the backward half stopped.
+            joined_stopping_flags.append(flags if self.is_backward[i] else other_flags)
+            joined_seed_ids.append(seed_id)
+
+        if len(pending_seed_ids) > 0 and len(undone) > 0:
+            # Tell the other halves, still growing, how long their partner is (all at once: seed ids are sorted once).
+            pending_seed_ids = np.array(pending_seed_ids)
+            order = np.argsort(pending_seed_ids)
+            undone_seed_ids = self.seed_ids[undone]
+            positions = np.minimum(np.searchsorted(pending_seed_ids, undone_seed_ids, sorter=order), len(order) - 1)
+            is_partner = pending_seed_ids[order[positions]] == undone_seed_ids
+            self.partner_lengths[undone[is_partner]] = np.array(pending_lengths)[order[positions[is_partner]]]
 
-        for _ in range(nb_retry):
-            if verbose:
-                print(".", end="")
-                sys.stdout.flush()
+        if self.compress_streamlines:
+            streamlines = compress_streamlines(streamlines)
 
-            for backtrack_n_steps in range(1, nb_backtrack_steps+1):
-                idx = tracker.get(flag=STOPPING_MASK | STOPPING_CURVATURE | STOPPING_LIKELIHOOD)
-                if len(idx) == 0:
-                    # No sprouts to be saved.
-                    break
+        tractogram = Tractogram(streamlines=streamlines,
+                                data_per_streamline={"stopping_flags": np.array(joined_stopping_flags, dtype=np.uint8),
+                                                     "seed_ids": np.array(joined_seed_ids, dtype=np.int64)})
 
-                nb_saved = tracker.regrow(idx, step_size, backtrack_n_steps=backtrack_n_steps)
-                print("{}/{} saved.".format(nb_saved, len(idx)))
+        # Keep only undone sprouts
+        if len(done) > 0:
+            self._keep(self._compaction_order(undone))
 
-            if len(idx) == 0:
-                # No sprouts to be saved.
-                break
+        return tractogram
 
-        if tractogram is None:
-            tractogram = tracker.harvest()
-        else:
-            tractogram += tracker.harvest()
+    def _keep(self, idx):
+        super()._keep(idx)
+        self.is_backward = self.is_backward[idx]
+        self.partner_lengths = self.partner_lengths[idx]
 
-        if verbose and nb_retry == 0:
-            print("")
 
-        i += 1
+class BidirectionalPeterTracker(BidirectionalTracker, PeterTracker):
+    pass
 
-    return tractogram
 
+class TractogramWriter(object):
+    """ Saves streamlines to a tractogram file (.tck|.trk) from a background thread.
 
-def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
-    if batch_size is None:
-        batch_size = len(seeds)
+    Streamlines given to `write` are queued and consumed by a `nib.streamlines.LazyTractogram`
+    that is being saved by a separate thread, so streamlines never have to be all in memory.
 
-    nb_retry = 1 if args.track_like_peter else args.pft_nb_retry
-    nb_backtrack_steps = 1 if args.track_like_peter else args.pft_nb_backtrack_steps
-    TrackerCls = PeterTracker if args.track_like_peter else Tracker
-    BackwardTrackerCls = BackwardPeterTracker if args.track_like_peter else BackwardTracker
+    Parameters
+    ----------
+    filename : str
+        Path of the tractogram file to create.
+    max_queued : int, optional
+        Maximum number of tractograms waiting to be written. When reached, `write` blocks.
+    """
+    def __init__(self, filename, max_queued=4):
+        self.filename = filename
+        self.nb_streamlines = 0
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._done = False
+        self._thread = threading.Thread(target=self._run, name="TractogramWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _streamlines(self):
+        while True:
+            tractogram = self._queue.get()
+            if tractogram is None:
+                self._done = True
+                break
 
-    while True:
+            for s in tractogram.streamlines:
+                yield s
+
+    def _run(self):
         try:
-            time.sleep(1)
-            print("Trying to track {:,} streamlines at the same time.".format(batch_size))
-            tractogram = None#nib.streamlines.Tractogram()
+            # Streamlines written are expected to already be in RAS+mm.
+            tractogram = nib.streamlines.LazyTractogram(self._streamlines, affine_to_rasmm=np.eye(4))
+            nib.streamlines.save(tractogram, self.filename)
+        except Exception as e:
+            self._error = e
+            # Keep consuming so pending `write` and `close` calls don't block forever.
+            while not self._done:
+                self._done = self._queue.get() is None
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError("Failed to write {}".format(self.filename)) from self._error
+
+    def write(self, tractogram):
+        """ Queues streamlines to be written.
 
-            for start in range(0, len(seeds), batch_size):
-                print("{:,} / {:,}".format(start, len(seeds)))
-                end = start + batch_size
-
-                # Forward tracking
-                tracker = TrackerCls(model, is_stopping, args.pft_nb_backtrack_steps, args.use_max_component,
-                                     args.flip_x, args.flip_y, args.flip_z, compress_streamlines=False)
-                batch_tractogram = track(tracker=tracker, seeds=seeds[start:end], step_size=step_size, is_stopping=is_stopping,
-                                         nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose)
-
-                stopping_flags = batch_tractogram.data_per_streamline['stopping_flags'].astype(np.uint8)
-                print("Forward pass stopped because of - mask: {:,}\t curv: {:,}\t length: {:,}\t likelihood: {:,}".format(
-                    count_flags(stopping_flags, STOPPING_MASK),
-                    count_flags(stopping_flags, STOPPING_CURVATURE),
-                    count_flags(stopping_flags, STOPPING_LENGTH),
-                    count_flags(stopping_flags, STOPPING_LIKELIHOOD)))
-
-                # Backward tracking
-                tracker = BackwardTrackerCls(model, is_stopping, args.pft_nb_backtrack_steps, args.use_max_component,
-                                             args.flip_x, args.flip_y, args.flip_z, compress_streamlines=True)
-                streamlines = [s[::-1] for s in batch_tractogram.streamlines]  # Flip streamlines (the first half).
-                batch_tractogram = track(tracker=tracker, seeds=streamlines, step_size=step_size, is_stopping=is_stopping,
-                                         nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose)
-
-                stopping_flags = batch_tractogram.data_per_streamline['stopping_flags'].astype(np.uint8)
-                print("Backward pass stopped because of - mask: {:,}\t curv: {:,}\t length: {:,}\t likelihood: {:,}".format(
-                    count_flags(stopping_flags, STOPPING_MASK),
-                    count_flags(stopping_flags, STOPPING_CURVATURE),
-                    count_flags(stopping_flags, STOPPING_LENGTH),
-                    count_flags(stopping_flags, STOPPING_LIKELIHOOD)))
-
-                if tractogram is None:
-                    tractogram = batch_tractogram
-                else:
-                    tractogram += batch_tractogram
+        Parameters
+        ----------
+        tractogram : `nib.streamlines.Tractogram` object
+            Streamlines (in RAS+mm) to add to the tractogram file.
+        """
+        self._check()
+        if len(tractogram) == 0:
+            return
 
-            return tractogram
+        self._queue.put(tractogram)
+        self.nb_streamlines += len(tractogram)
 
-        except MemoryError:
-            print("{:,} streamlines is too much!".format(batch_size))
-            batch_size //= 2
-            if batch_size < 0:
-                raise MemoryError("Might needs a bigger graphic card!")
+    def close(self):
+        """ Waits for all queued streamlines to be written, then closes the file. """
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
 
-        except RuntimeError as e:
-            if "out of memory" in e.args[0]:
-                print("{:,} streamlines is too much!".format(batch_size))
-                batch_size //= 2
-                if batch_size < 0:
-                    raise MemoryError("Might needs a bigger graphic card!")
 
-            else:
+class StreamlinesFilterChain(object):
+    """ Cleans streamlines and sends them to a `TractogramWriter` while tracking goes on.
+
+    Harvested streamlines (in voxel space) are kept aside until `flush` is called, i.e. once
+    a batch of seeds has been completely tracked. They are then brought back to RAS+mm,
+    checked against every rejection criterion and handed to the writer(s). That way, memory
+    usage depends on the batch size rather than on the total number of streamlines.
+
+    Parameters
+    ----------
+    rejection_criteria : list of tuple
+        Each tuple contains a description of what is being removed (e.g. "empty streamlines") and
+        a function expecting a `nib.streamlines.Tractogram` and returning a boolean array
+        indicating which streamlines should be rejected. Criteria are applied in order.
+    affine_to_rasmm : 2D array of shape (4, 4)
+        Affine bringing harvested streamlines back to RAS+mm.
+    writer : `TractogramWriter` object
+        Where to send kept streamlines.
+    rejected_writer : `TractogramWriter` object, optional
+        If provided, where to send rejected streamlines.
+    """
+    def __init__(self, rejection_criteria, affine_to_rasmm, writer, rejected_writer=None):
+        self.rejection_criteria = rejection_criteria
+        self.affine_to_rasmm = affine_to_rasmm
+        self.writer = writer
+        self.rejected_writer = rejected_writer
+
+        self._pending = []
+        self.nb_generated = 0
+        self.nb_rejected = [0] * len(rejection_criteria)
+        self.lengths_sum = 0.
+        self.lengths_min = np.inf
+        self.lengths_max = -np.inf
+
+    @property
+    def stopping_flags(self):
+        """ Stopping flags of the streamlines not flushed yet. """
+        if len(self._pending) == 0:
+            return np.zeros(0, dtype=np.uint8)
+
+        return np.concatenate([t.data_per_streamline['stopping_flags'] for t in self._pending]).astype(np.uint8)
+
+    def add(self, tractogram):
+        """ Keeps harvested streamlines aside until the next `flush`. """
+        if tractogram is not None and len(tractogram) > 0:
+            self._pending.append(tractogram)
+
+    def discard(self):
+        """ Drops streamlines added since the last `flush` (e.g. their batch has to be tracked again). """
+        self._pending = []
+
+    def flush(self):
+        """ Cleans streamlines added since the last `flush` and sends them to the writer(s). """
+        if len(self._pending) == 0:
+            return
+
+        data_per_streamline = {'stopping_flags': self.stopping_flags}
+        if all('losses' in t.data_per_streamline for t in self._pending):
+            # Computed while tracking (see `make_has_high_loss`).
+            data_per_streamline['losses'] = np.concatenate([t.data_per_streamline['losses'] for t in self._pending])
+
+        tractogram = Tractogram(streamlines=[s for t in self._pending for s in t.streamlines],
+                                data_per_streamline=data_per_streamline)
+        self._pending = []
+        self.nb_generated += len(tractogram)
+
+        # Streamlines have been generated in voxel space.
+        # Transform them them back to RAS+mm space.
+        tractogram.affine_to_rasmm = self.affine_to_rasmm
+        tractogram.to_world()  # Performed in-place.
+
+        for i, (_, is_rejected) in enumerate(self.rejection_criteria):
+            rejected = is_rejected(tractogram)
+            self.nb_rejected[i] += rejected.sum()
+
+            if self.rejected_writer is not None:
+                self.rejected_writer.write(tractogram[rejected])
+
+            tractogram = tractogram[np.logical_not(rejected)]
+
+        if len(tractogram) > 0:
+            lengths = dipy.tracking.streamline.length(tractogram.streamlines)
+            self.lengths_sum += lengths.sum()
+            self.lengths_min = min(self.lengths_min, lengths.min())
+            self.lengths_max = max(self.lengths_max, lengths.max())
+
+        self.writer.write(tractogram)
+
+    def get_state(self):
+        """ Returns the statistics gathered so far (see `set_state`). """
+        state = {'nb_generated': int(self.nb_generated),
+                 'nb_rejected': [int(n) for n in self.nb_rejected],
+                 'lengths_sum': float(self.lengths_sum),
+                 'lengths_min': float(self.lengths_min),
+                 'lengths_max': float(self.lengths_max),
+                 'nb_written': self.writer.nb_streamlines}
+
+        if self.rejected_writer is not None:
+            state['nb_rejected_written'] = self.rejected_writer.nb_streamlines
+
+        return state
+
+    def set_state(self, state):
+        """ Restores statistics gathered by a previous run (see `get_state`). """
+        self.nb_generated = state['nb_generated']
+        self.nb_rejected = list(state['nb_rejected'])
+        self.lengths_sum = state['lengths_sum']
+        self.lengths_min = state['lengths_min']
+        self.lengths_max = state['lengths_max']
+        self.writer.nb_streamlines = state['nb_written']
+        if self.rejected_writer is not None:
+            self.rejected_writer.nb_streamlines = state['nb_rejected_written']
+
+    def close(self):
+        """ Flushes remaining streamlines and closes the writer(s). """
+        self.flush()
+        self.writer.close()
+        if self.rejected_writer is not None:
+            self.rejected_writer.close()
+
+        # Criteria gathering statistics over all batches (e.g. `make_has_high_loss`) report them once.
+        for _, is_rejected in self.rejection_criteria:
+            if hasattr(is_rejected, 'print_summary'):
+                is_rejected.print_summary()
+
+    def print_summary(self):
+        print("Generated {:,} (compressed) streamlines".format(self.nb_generated))
+        if self.writer.nb_streamlines > 0:
+            print("Average length: {:.2f} mm.".format(self.lengths_sum / self.writer.nb_streamlines))
+            print("Minimum length: {:.2f} mm. Maximum length: {:.2f}".format(self.lengths_min, self.lengths_max))
+
+        for (description, _), nb_rejected in zip(self.rejection_criteria, self.nb_rejected):
+            print("Removed {:,} {}".format(nb_rejected, description))
+
+        print("Saved {:,} (compressed) streamlines to {}".format(self.writer.nb_streamlines, self.writer.filename))
+        if self.rejected_writer is not None:
+            print("Saved {:,} (compressed) rejected streamlines to {}".format(self.rejected_writer.nb_streamlines,
+                                                                              self.rejected_writer.filename))
+
+
+class SubjectsFilterChain(object):
+    """ Sends the streamlines of every subject to its own `StreamlinesFilterChain`.
+
+    Streamlines added are expected to have their subject in `data_per_streamline['subject_ids']`
+    (see `track_seeds_chunk`).
+    """
+    def __init__(self, filter_chains):
+        self.filter_chains = filter_chains
+
+    def add(self, tractogram):
+        if tractogram is None or len(tractogram) == 0:
+            return
+
+        subject_ids = tractogram.data_per_streamline['subject_ids'].reshape(-1)
+        for subject_id, filter_chain in enumerate(self.filter_chains):
+            filter_chain.add(tractogram[subject_ids == subject_id])
+
+    def discard(self):
+        for filter_chain in self.filter_chains:
+            filter_chain.discard()
+
+    def flush(self):
+        for filter_chain in self.filter_chains:
+            filter_chain.flush()
+
+    def close(self):
+        for filter_chain in self.filter_chains:
+            filter_chain.close()
+
+    def print_summary(self):
+        for filter_chain in self.filter_chains:
+            filter_chain.print_summary()
+
+
+class ShardedTractogramWriter(object):
+    """ Saves streamlines in one tractogram file (shard) per chunk of seeds.
+
+    Streamlines given to `write` are kept until `save_shard` is called. Once tracking is done,
+    `close` concatenates every shard, in seed order, into the final tractogram file.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the final tractogram file (.tck|.trk).
+    shards_dir : str
+        Folder where to save the shards.
+    seed_ranges : list of tuple, optional
+        Seed ranges (start, end) of shards saved by a previous run.
+    """
+    def __init__(self, filename, shards_dir, seed_ranges=()):
+        self.filename = filename
+        self.shards_dir = shards_dir
+        self.seed_ranges = list(seed_ranges)
+        self.nb_streamlines = 0
+        self._pending = []
+
+        if not os.path.isdir(self.shards_dir):
+            os.makedirs(self.shards_dir)
+
+    def _shard_filename(self, start, end):
+        ext = os.path.splitext(self.filename)[1]
+        return pjoin(self.shards_dir, "{:012d}-{:012d}{}".format(start, end, ext))
+
+    def write(self, tractogram):
+        """ Keeps streamlines (in RAS+mm) until the next call to `save_shard`. """
+        if len(tractogram) > 0:
+            self._pending.append(tractogram)
+            self.nb_streamlines += len(tractogram)
+
+    def save_shard(self, start, end):
+        """ Saves pending streamlines as the shard of seeds `start` to `end`. """
+        self.seed_ranges.append((start, end))
+        if len(self._pending) == 0:
+            return
+
+        tractogram = Tractogram([s for t in self._pending for s in t.streamlines], affine_to_rasmm=np.eye(4))
+        self._pending = []
+
+        # Write to a temporary file first so a shard is never partially written.
+        shard_filename = self._shard_filename(start, end)
+        tmp_filename = pjoin(self.shards_dir, "tmp" + os.path.splitext(shard_filename)[1])
+        nib.streamlines.save(tractogram, tmp_filename)
+        os.replace(tmp_filename, shard_filename)
+
+    def close(self):
+        """ Concatenates every shard, in seed order, into the final tractogram file. """
+        writer = TractogramWriter(self.filename)
+        for start, end in sorted(self.seed_ranges):
+            shard_filename = self._shard_filename(start, end)
+            if os.path.isfile(shard_filename):
+                writer.write(nib.streamlines.load(shard_filename).tractogram)
+
+        writer.close()
+
+
+class TrackingCheckpoint(object):
+    """ Keeps track of tracking progress so an interrupted run can be resumed.
+
+    After each chunk of seeds has been tracked, the cleaned streamlines it produced are saved in
+    their own shard (see `ShardedTractogramWriter`) and the seed range is marked as done, along
+    with the statistics of the filter chain.
+
+    Parameters
+    ----------
+    path : str
+        Folder where to save the checkpoint.
+    nb_seeds : int
+        Total number of seeds to track.
+    filename : str
+        Path of the final tractogram file.
+    rejected_filename : str, optional
+        If provided, path of the final tractogram file containing the rejected streamlines.
+    resume : bool, optional
+        If True, reload the progress made by a previous run, if any.
+    """
+    def __init__(self, path, nb_seeds, filename, rejected_filename=None, resume=False):
+        self.path = path
+        self.nb_seeds = nb_seeds
+        self.done = []
+        self.filter_chain_state = None
+
+        progress_filename = pjoin(self.path, "progress.json")
+        if resume and os.path.isfile(progress_filename):
+            with open(progress_filename) as f:
+                progress = json.load(f)
+            if progress['nb_seeds'] != nb_seeds:
+                raise ValueError("Cannot resume: checkpoint has {:,} seeds but there are {:,} now.".format(progress['nb_seeds'], nb_seeds))
+
+            self.done = [tuple(seed_range) for seed_range in progress['done']]
+            self.filter_chain_state = progress['filter_chain']
+            print("Resuming: {:,} / {:,} seeds already tracked.".format(sum(e - s for s, e in self.done), nb_seeds))
+        elif os.path.isdir(self.path):
+            shutil.rmtree(self.path)  # Start from scratch.
+
+        self.writer = ShardedTractogramWriter(filename, pjoin(self.path, "kept"), seed_ranges=self.done)
+        self.rejected_writer = None
+        if rejected_filename is not None:
+            self.rejected_writer = ShardedTractogramWriter(rejected_filename, pjoin(self.path, "rejected"),
+                                                           seed_ranges=self.done)
+
+    def commit(self, start, end, filter_chain):
+        """ Saves the streamlines of seeds `start` to `end` and marks them as done. """
+        self.writer.save_shard(start, end)
+        if self.rejected_writer is not None:
+            self.rejected_writer.save_shard(start, end)
+
+        self.done.append((start, end))
+        progress = {'nb_seeds': self.nb_seeds,
+                    'done': self.done,
+                    'filter_chain': filter_chain.get_state()}
+
+        # Write to a temporary file first so progress is never partially written.
+        with open(pjoin(self.path, "progress.tmp.json"), 'w') as f:
+            json.dump(progress, f)
+        os.replace(pjoin(self.path, "progress.tmp.json"), pjoin(self.path, "progress.json"))
+
+    def remove(self):
+        """ Removes the checkpoint, e.g. once shards have been concatenated. """
+        shutil.rmtree(self.path)
+
+
+class TrackingTelemetry(object):
+    """ Writes statistics about every tracking step to a file, one JSON object per line.
+
+    Each line tells, for one step of one tracking pass: how many sprouts were growing, the time spent
+    in the model ('time_grow'), regrowing stopped sprouts ('time_regrow', including finding them),
+    checking which sprouts should stop ('time_stopping') and harvesting them ('time_harvest'),
+    how many sprouts PFT tried to and managed to regrow, and why the harvested sprouts stopped.
+    A summary of the whole run is written when closing.
+
+    Parameters
+    ----------
+    filename : str or None
+        Path of the file to write. If None, statistics are gathered but nothing is written.
+    """
+    STOPPING_FLAGS = [("mask", STOPPING_MASK), ("curvature", STOPPING_CURVATURE),
+                      ("length", STOPPING_LENGTH), ("likelihood", STOPPING_LIKELIHOOD)]
+    TIMINGS = ["time_grow", "time_regrow", "time_stopping", "time_harvest"]
+    COUNTS = ["nb_rescue_attempts", "nb_rescued", "nb_done"]
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._file = None if filename is None else open(filename, 'w', buffering=1)
+        self.start_time = time.time()
+        self.pass_name = None
+        self.nb_passes = 0
+        self.nb_steps = 0
+        self._step_id = 0
+        self._step = None
+        self._totals = dict([(key, 0.) for key in self.TIMINGS] + [(key, 0) for key in self.COUNTS])
+        self._totals['stopping_flags'] = dict((name, 0) for name, _ in self.STOPPING_FLAGS)
+
+    def start_pass(self, name):
+        """ Starts numbering steps from 0 for a new tracking pass (e.g. 'forward' or 'backward'). """
+        self.pass_name = name
+        self.nb_passes += 1
+        self._step_id = 0
+
+    def start_step(self, nb_sprouts, **extra):
+        self._step = dict([("pass", self.pass_name), ("step", self._step_id), ("nb_sprouts", int(nb_sprouts))] +
+                          [(key, 0.) for key in self.TIMINGS] + [(key, 0) for key in self.COUNTS])
+        self._step['stopping_flags'] = dict((name, 0) for name, _ in self.STOPPING_FLAGS)
+        self._step.update(extra)
+
+    @contextmanager
+    def timing(self, key):
+        """ Adds the time spent in the `with` block to `key` for the current step. """
+        start = time.time()
+        yield
+        self._step[key] += time.time() - start
+
+    def count_rescue(self, nb_attempts, nb_rescued):
+        self._step['nb_rescue_attempts'] += int(nb_attempts)
+        self._step['nb_rescued'] += int(nb_rescued)
+
+    def count_harvest(self, tractogram):
+        stopping_flags = tractogram.data_per_streamline['stopping_flags']
+        self._step['nb_done'] += len(tractogram)
+        for name, flag in self.STOPPING_FLAGS:
+            self._step['stopping_flags'][name] += int(count_flags(stopping_flags, flag))
+
+    def end_step(self):
+        for key in self.TIMINGS + self.COUNTS:
+            self._totals[key] += self._step[key]
+
+        for name, _ in self.STOPPING_FLAGS:
+            self._totals['stopping_flags'][name] += self._step['stopping_flags'][name]
+
+        if self._file is not None:
+            self._file.write(json.dumps(self._step) + "\n")
+
+        self._step_id += 1
+        self.nb_steps += 1
+        self._step = None
+
+    @property
+    def summary(self):
+        summary = dict(self._totals)
+        summary['nb_passes'] = self.nb_passes
+        summary['nb_steps'] = self.nb_steps
+        summary['time'] = time.time() - self.start_time
+        return summary
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(json.dumps({"summary": self.summary}) + "\n")
+            self._file.close()
+            self._file = None
+
+
+class MaskSeeds(object):
+    """ Seeds drawn uniformly in the voxels of a seeding mask, generated on demand.
+
+    Behaves like a 2D array of seeds of shape (n_seeds, 3) that can only be sliced:
+    seeds are generated, block of voxels by block of voxels, only when asked for.
+    For a given `rng_seed`, seeds are the same whatever the order slices are requested in.
+
+    Parameters
+    ----------
+    mask : 3D array
+        Seeding mask, seeds are drawn in its non-zero voxels.
+    affine_vox2dwivox : ndarray of shape (4, 4)
+        Matrix bringing the voxels of `mask` in the diffusion voxel space.
+    nb_seeds_per_voxel : int, optional
+        Number of seeds drawn in every voxel.
+    rng_seed : int, optional
+        Seed of the random generator placing the seeds in the voxels.
+    is_outside : function, optional
+        If provided, seeds for which it returns True are discarded (see `make_is_outside_mask`).
+    block_size : int, optional
+        Number of voxels for which seeds are generated at once.
+    """
+    def __init__(self, mask, affine_vox2dwivox, nb_seeds_per_voxel=1, rng_seed=1234, is_outside=None, block_size=10000):
+        self.voxels = np.argwhere(mask)
+        self.affine_vox2dwivox = affine_vox2dwivox
+        self.nb_seeds_per_voxel = nb_seeds_per_voxel
+        self.is_outside = is_outside
+        self.block_size = block_size
+        self._cache = (None, None)
+
+        # Go through all blocks once to know how many seeds each one keeps and where it starts
+        # in the random sequence, so any of them can be generated again later.
+        rng = np.random.RandomState(rng_seed)
+        self._rng_states = []
+        nb_seeds = [0]
+        for block in range(int(np.ceil(len(self.voxels) / block_size))):
+            self._rng_states.append(rng.get_state())
+            nb_seeds.append(len(self._generate(block, rng)))
+
+        self._offsets = np.cumsum(nb_seeds)
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def _generate(self, block, rng):
+        voxels = self.voxels[block * self.block_size:(block + 1) * self.block_size]
+        seeds = np.repeat(voxels, self.nb_seeds_per_voxel, axis=0)
+        seeds = seeds + rng.uniform(-0.5, 0.5, size=seeds.shape)
+        seeds = nib.affines.apply_affine(self.affine_vox2dwivox, seeds).astype(floatX)
+
+        if self.is_outside is not None:
+            # Those seeds would be stopped before taking their first step.
+            seeds = seeds[np.logical_not(self.is_outside(seeds[:, None, :]))]
+
+        return seeds
+
+    def _get_block(self, block):
+        if self._cache[0] != block:  # Chunks of seeds are usually requested in order.
+            rng = np.random.RandomState()
+            rng.set_state(self._rng_states[block])
+            self._cache = (block, self._generate(block, rng))
+
+        return self._cache[1]
+
+    def __getitem__(self, idx):
+        start, end, step = idx.indices(len(self))
+        if step != 1:
+            raise IndexError("Seeds can only be sliced contiguously.")
+
+        end = max(start, end)
+        first_block = np.searchsorted(self._offsets, start, side='right') - 1
+        last_block = np.searchsorted(self._offsets, end, side='left')
+        seeds = [np.zeros((0, 3), dtype=floatX)]
+        seeds += [self._get_block(block) for block in range(first_block, last_block)]
+        offset = self._offsets[first_block]
+        return np.concatenate(seeds)[start - offset:end - offset]
+
+
+class SeedSequence(object):
+    """ Concatenates seeds coming from different sources (e.g. 2D arrays or `MaskSeeds`).
+
+    Like `MaskSeeds`, it can only be sliced and only asks its sources for the seeds being sliced.
+    """
+    def __init__(self, sources):
+        self.sources = sources
+        self._offsets = np.cumsum([0] + [len(source) for source in sources])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, idx):
+        start, end, step = idx.indices(len(self))
+        if step != 1:
+            raise IndexError("Seeds can only be sliced contiguously.")
+
+        seeds = [np.zeros((0, 3), dtype=floatX)]
+        for source, offset in zip(self.sources, self._offsets):
+            if start < offset + len(source) and end > offset:
+                seeds.append(np.asarray(source[max(start - offset, 0):end - offset], dtype=floatX))
+
+        return np.concatenate(seeds)
+
+
+def iter_seed_chunks(nb_seeds, chunk_size, done=()):
+    """ Yields (start, end) ranges of at most `chunk_size` seeds, skipping ranges already `done`. """
+    start = 0
+    for done_start, done_end in sorted(done) + [(nb_seeds, nb_seeds)]:
+        for chunk_start in range(start, done_start, chunk_size):
+            yield chunk_start, min(chunk_start + chunk_size, done_start)
+
+        start = max(start, done_end)
+
+
+def grow_together(trackers, step_size):
+    """ Grows the sprouts of several trackers using a single call to their (shared) grower.
+
+    Parameters
+    ----------
+    trackers : list of `Tracker` objects
+        Trackers sharing the same grower, e.g. copies of a same tracker planted with different seeds
+        or tracking different subjects (see `Tracker.for_subject`).
+    step_size : float
+        Size of the step to take (in voxel). If None, use the model's output as-is.
+    """
+    inputs = [tracker._get_grower_inputs(tracker.sprouts) for tracker in trackers]
+    x_t = np.concatenate([x for x, _ in inputs])
+    previous_direction = np.concatenate([d for _, d in inputs])
+    states = [np.concatenate(layer_states) for layer_states in zip(*[tracker.states for tracker in trackers])]
+
+    subject_ids = np.concatenate([np.full(len(tracker.sprouts), tracker.subject_id) for tracker in trackers])
+
+    outputs, new_states, regression_output = trackers[0]._predict(x_t, states, previous_direction, subject_ids)
+
+    offsets = np.r_[0, np.cumsum([len(tracker.sprouts) for tracker in trackers])]
+    for tracker, start, end in zip(trackers, offsets[:-1], offsets[1:]):
+        if tracker.learn_to_stop:
+            tracker_outputs = [o[start:end] for o in outputs]
+        else:
+            tracker_outputs = outputs[start:end]
+
+        tracker._take_step(tracker_outputs, [s[start:end] for s in new_states],
+                           None if regression_output is None else regression_output[start:end], step_size)
+
+
+def _rescue(tracker, step_size, nb_retry, nb_backtrack_steps, verbose=False):
+    """ Attempts to regrow sprouts that have been stopped (see Particle Filtering Tractography).
+
+    Returns
+    -------
+    nb_attempts : int
+        Number of times a sprout has been regrown.
+    nb_rescued : int
+        Number of times a regrown sprout didn't have to stop anymore.
+    """
+    nb_attempts = 0
+    nb_rescued = 0
+    for _ in range(nb_retry):
+        if verbose:
+            print(".", end="")
+            sys.stdout.flush()
+
+        for backtrack_n_steps in range(1, nb_backtrack_steps+1):
+            idx = tracker.get(flag=STOPPING_MASK | STOPPING_CURVATURE | STOPPING_LIKELIHOOD)
+            if len(idx) == 0:
+                # No sprouts to be saved.
+                break
+
+            nb_saved = tracker.regrow(idx, step_size, backtrack_n_steps=backtrack_n_steps)
+            print("{}/{} saved.".format(nb_saved, len(idx)))
+            nb_attempts += len(idx)
+            nb_rescued += nb_saved
+
+        if len(idx) == 0:
+            # No sprouts to be saved.
+            break
+
+    return nb_attempts, nb_rescued
+
+
+def _finish_step(tracker, step_size, nb_retry, nb_backtrack_steps, verbose, telemetry):
+    """ Regrows the sprouts that have been stopped (if possible), then harvests the ones that are done. """
+    with telemetry.timing('time_regrow'):
+        telemetry.count_rescue(*_rescue(tracker, step_size, nb_retry, nb_backtrack_steps, verbose))
+
+    with telemetry.timing('time_stopping'):
+        tracker._check_sprouts()
+
+    with telemetry.timing('time_harvest'):
+        tractogram = tracker.harvest()
+
+    telemetry.count_harvest(tractogram)
+    return tractogram
+
+
+def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps=0, verbose=False, sink=None,
+          stats=None, telemetry=None):
+    """ Generates streamlines using the Particle Filtering Tractography algorithm.
+
+    This algorithm is inspired from Girard etal. (2014) Neuroimage.
+
+    Parameters
+    ----------
+    is_stopping : function
+        Tells whether a streamlines should stop being tracked.
+        This function expects a list of streamlines and returns a 3-tuple:
+          the indices of the streamlines that are undone,
+          the indices of the streamlines that are done,
+          the reasons why the streamlines should be stopped.
+    sink : `StreamlinesFilterChain` object, optional
+        If provided, harvested streamlines are sent to it as they are done instead
+        of being accumulated. In that case, None is returned.
+    stats : dict, optional
+        If provided, the number of steps ('nb_steps') and the total number of sprouts
+        grown over all steps ('nb_sprouts_steps') are added to it.
+    telemetry : `TrackingTelemetry` object, optional
+        If provided, statistics about every step are sent to it.
+    """
+    telemetry = telemetry or TrackingTelemetry()
+    tractogram = None
+    tracker.plant(seeds)
+
+    i = 1
+    while not tracker.is_ripe():
+        if verbose:
+            print("pts: {}/{} ({:,} remaining)".format(i+1, is_stopping.max_nb_points, len(tracker.sprouts)), end="")
+
+        if stats is not None:
+            stats['nb_steps'] = stats.get('nb_steps', 0) + 1
+            stats['nb_sprouts_steps'] = stats.get('nb_sprouts_steps', 0) + len(tracker.sprouts)
+
+        telemetry.start_step(len(tracker.sprouts))
+        with telemetry.timing('time_grow'):
+            tracker.grow(step_size)
+
+        harvested = _finish_step(tracker, step_size, nb_retry, nb_backtrack_steps, verbose, telemetry)
+        telemetry.end_step()
+
+        if sink is not None:
+            sink.add(harvested)
+        elif tractogram is None:
+            tractogram = harvested
+        else:
+            tractogram += harvested
+
+        if verbose and nb_retry == 0:
+            print("")
+
+        i += 1
+
+    return tractogram
+
+
+def track_continuously(tracker, seeds, step_size, is_stopping, batch_size, nb_retry=0, nb_backtrack_steps=0,
+                       verbose=False, sink=None, stats=None, telemetry=None, subject_ids=None, subject_trackers=None):
+    """ Same as `track` but keeps about `batch_size` sprouts growing until running out of seeds.
+
+    Instead of waiting for every sprout to be done before planting new seeds, fresh seeds are
+    planted in the slots freed by finished sprouts. Sprouts planted together form a cohort: a copy
+    of `tracker` with its own model states and number of steps. All cohorts are grown with
+    a single call to the model (see `grow_together`).
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of sprouts to keep growing at the same time.
+    subject_ids : 1D array, optional
+        Subject of every seed. If provided, seeds of subject `i` are tracked by `subject_trackers[i]`.
+        Seeds of different subjects are planted in different cohorts, still grown together.
+    subject_trackers : list of `Tracker` objects, optional
+        One tracker per subject (see `Tracker.for_subject`), required along with `subject_ids`.
+
+    See `track` for the other parameters.
+    """
+    telemetry = telemetry or TrackingTelemetry()
+    tractogram = None
+    cohorts = []
+    nb_planted = 0
+    min_refill = max(int(batch_size * REFILL_RATIO), 1)
+
+    while nb_planted < len(seeds) or len(cohorts) > 0:
+        nb_free = batch_size - sum(len(cohort.sprouts) for cohort in cohorts)
+        if nb_planted < len(seeds) and (nb_free >= min_refill or len(cohorts) == 0):
+            # Every seed will grow `nb_samples_per_seed` sprouts.
+            new_seeds = seeds[nb_planted:nb_planted + max(nb_free // tracker.nb_samples_per_seed, 1)]
+            new_subject_ids = None if subject_ids is None else subject_ids[nb_planted:nb_planted + len(new_seeds)]
+            for subject_id in ([None] if subject_ids is None else np.unique(new_subject_ids)):
+                # Cohorts share the tracker's grower, there is no need to compile it again.
+                if subject_id is None:
+                    cohort = copy.copy(tracker)
+                    rows = np.arange(len(new_seeds))
+                    cohort.plant(new_seeds)
+                else:
+                    cohort = copy.copy(subject_trackers[subject_id])
+                    rows = np.flatnonzero(new_subject_ids == subject_id)
+                    cohort.plant(new_seeds[rows] if isinstance(new_seeds, np.ndarray) else [new_seeds[i] for i in rows])
+
+                cohort.seed_ids = nb_planted + rows[cohort.seed_ids]  # Seed indices are relative to `seeds`, not to the cohort.
+                cohorts.append(cohort)
+
+            nb_planted += len(new_seeds)
+
+        nb_growing = sum(len(cohort.sprouts) for cohort in cohorts)
+        if verbose:
+            print("seeds: {:,}/{:,} ({:,} growing in {} cohorts)".format(nb_planted, len(seeds), nb_growing, len(cohorts)), end="")
+
+        if stats is not None:
+            stats['nb_steps'] = stats.get('nb_steps', 0) + 1
+            stats['nb_sprouts_steps'] = stats.get('nb_sprouts_steps', 0) + nb_growing
+
+        telemetry.start_step(nb_growing, nb_cohorts=len(cohorts))
+        with telemetry.timing('time_grow'):
+            grow_together(cohorts, step_size)
+
+        for cohort in cohorts:
+            harvested = _finish_step(cohort, step_size, nb_retry, nb_backtrack_steps, verbose, telemetry)
+
+            if sink is not None:
+                sink.add(harvested)
+            elif tractogram is None:
+                tractogram = harvested
+            else:
+                tractogram += harvested
+
+        telemetry.end_step()
+        cohorts = [cohort for cohort in cohorts if not cohort.is_ripe()]
+
+        if verbose and nb_retry == 0:
+            print("")
+
+    return tractogram
+
+
+def make_tracking_loss(model, hyperparams, args):
+    """ Makes the NumPy loss given to the trackers (see `Tracker`), if streamlines have to be filtered on their loss
+    computed while tracking them (see --track-loss).
+
+    Returns None when there is no `--filter-threshold` or no `--track-loss`: streamlines are then fed to
+    the model once more after being tracked (see `make_has_high_loss`).
+    """
+    from learn2track.numpy_inference import make_numpy_loss, get_model_name, LOSS_SUPPORTED_MODELS
+
+    if args.filter_threshold is None or not args.track_loss:
+        return None
+
+    if args.bidirectional or get_model_name(model) not in LOSS_SUPPORTED_MODELS:
+        raise ValueError("--track-loss is not supported with --bidirectional nor for {} (supported: {}).".format(
+            get_model_name(model), ", ".join(LOSS_SUPPORTED_MODELS)))
+
+    return make_numpy_loss(model, normalize=hyperparams['normalize'])
+
+
+def get_chunk_rng_seed(seeding_rng_seed, chunk_start):
+    """ Derives the seed of the random generator used to track the chunk of seeds starting at `chunk_start`.
+
+    That way, sampling only depends on how seeds are split in chunks, not on which process tracks them.
+    """
+    return np.random.RandomState([seeding_rng_seed, chunk_start]).randint(2**30)
+
+
+def get_nb_history_states(args):
+    """ Returns how many past model states each sprout needs to keep to be regrown (see `StateHistory`). """
+    if args.track_like_peter or args.pft_nb_retry == 0:
+        return 0  # Sprouts are either never regrown or, like Peter does, regrown without going back in time.
+
+    return args.pft_nb_backtrack_steps
+
+
+def track_seeds_chunk(model, seeds, step_size, is_stopping, args, rng_seed=1234, sink=None, batch_size=None, telemetry=None,
+                      subject_ids=None, loss=None):
+    """ Tracks streamlines from `seeds`: first in one direction, then backward from the seeds.
+
+    With `args.bidirectional`, both directions are tracked at once instead (see `BidirectionalTracker`).
+    With `args.sort_seeds`, seeds are tracked in Z-order (see `get_morton_order`) so sprouts tracked together
+    read neighboring parts of the volume. Either way, streamlines are returned in the order of `seeds`.
+    If `sink` is provided, streamlines are sent to it (see `StreamlinesFilterChain`)
+    and None is returned. With `args.continuous_batching`, about `batch_size` streamlines
+    are growing at any time (see `track_continuously`), otherwise all seeds are tracked at once.
+    If `telemetry` is provided (see `TrackingTelemetry`), statistics about every step are sent to it.
+    If `subject_ids` (the subject of every seed) is provided, `is_stopping` is a list containing the stopping
+    criteria of every subject and seeds of all subjects are grown together (see `track_continuously`).
+    Returned streamlines then have their subject in `data_per_streamline['subject_ids']`.
+    If `loss` is provided (see `make_tracking_loss`), the loss of every streamline is computed by the backward pass,
+    the one feeding whole streamlines to the model, and returned in `data_per_streamline['losses']`.
+    With `args.samples_per_seed`, several streamlines are tracked from every seed, sharing their first step
+    (see `Tracker._branch`). They are returned one after the other, in the order of their seed.
+    """
+    telemetry = telemetry or TrackingTelemetry()
+    subjects_is_stopping = [is_stopping] if subject_ids is None else is_stopping
+    nb_retry = 1 if args.track_like_peter else args.pft_nb_retry
+    nb_backtrack_steps = 1 if args.track_like_peter else args.pft_nb_backtrack_steps
+    nb_history_states = get_nb_history_states(args)
+    TrackerCls = PeterTracker if args.track_like_peter else Tracker
+    BackwardTrackerCls = BackwardPeterTracker if args.track_like_peter else BackwardTracker
+
+    def _track(tracker, seeds, pass_name, seeds_subject_ids=None):
+        telemetry.start_pass(pass_name)
+        stats = {}
+        start_time = time.time()
+        if args.continuous_batching or seeds_subject_ids is not None:
+            subject_trackers = [tracker.for_subject(i, f) for i, f in enumerate(subjects_is_stopping)]
+            tractogram = track_continuously(tracker=tracker, seeds=seeds, step_size=step_size, is_stopping=subjects_is_stopping[0],
+                                            batch_size=(batch_size if args.continuous_batching else None) or len(seeds),
+                                            nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose,
+                                            stats=stats, telemetry=telemetry,
+                                            subject_ids=seeds_subject_ids, subject_trackers=subject_trackers)
+        else:
+            tractogram = track(tracker=tracker, seeds=seeds, step_size=step_size, is_stopping=is_stopping,
+                               nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose,
+                               stats=stats, telemetry=telemetry)
+
+        elapsed = time.time() - start_time
+        print("{:,} streamlines in {:.2f} sec. ({:.1f} streamlines/sec), mean active batch width: {:.1f}, model evaluations per streamline: {:.1f}".format(
+            len(seeds), elapsed, len(seeds) / max(elapsed, 1e-6),
+            stats.get('nb_sprouts_steps', 0) / max(stats.get('nb_steps', 0), 1),
+            stats.get('nb_sprouts_steps', 0) / max(len(seeds), 1)))
+
+        return tractogram
+
+    def _print_stopping_flags(tractogram, pass_name):
+        stopping_flags = tractogram.data_per_streamline['stopping_flags'].astype(np.uint8)
+        print("{} stopped because of - mask: {:,}\t curv: {:,}\t length: {:,}\t likelihood: {:,}".format(
+            pass_name,
+            count_flags(stopping_flags, STOPPING_MASK),
+            count_flags(stopping_flags, STOPPING_CURVATURE),
+            count_flags(stopping_flags, STOPPING_LENGTH),
+            count_flags(stopping_flags, STOPPING_LIKELIHOOD)))
+
+    def _get_seed_ids(tractogram):
+        # Nibabel stores empty harvests as float64, which concatenating keeps.
+        return tractogram.data_per_streamline['seed_ids'].reshape(-1).astype(np.int64)
+
+    order = get_morton_order(seeds) if args.sort_seeds else np.arange(len(seeds))
+    if subject_ids is not None:
+        # Seeds of different subjects are not in the same volume.
+        order = order[np.argsort(subject_ids[order], kind='mergesort')]
+        subject_ids = subject_ids[order]
+
+    seeds = seeds[order]
+    tracker_kwargs = dict(use_max_component=args.use_max_component, flip_x=args.flip_x, flip_y=args.flip_y, flip_z=args.flip_z,
+                          max_nb_points=subjects_is_stopping[0].max_nb_points, rng_seed=rng_seed,
+                          use_numpy_inference=args.numpy_inference, sort_sprouts=args.sort_sprouts)
+
+    # Only seeds are sampled several times, the backward pass continues every forward half once.
+    nb_samples = args.samples_per_seed
+    if args.bidirectional:
+        TrackerCls = BidirectionalPeterTracker if args.track_like_peter else BidirectionalTracker
+        tracker = TrackerCls(model, subjects_is_stopping[0], nb_history_states, compress_streamlines=True,
+                             nb_samples_per_seed=nb_samples, **tracker_kwargs)
+        tractogram = _track(tracker, seeds, "bidirectional", subject_ids)
+        seed_ids = _get_seed_ids(tractogram)
+        _print_stopping_flags(tractogram, "Bidirectional tracking")
+
+    else:
+        # Forward tracking
+        tracker = TrackerCls(model, subjects_is_stopping[0], nb_history_states, compress_streamlines=False,
+                             nb_samples_per_seed=nb_samples, **tracker_kwargs)
+        tractogram = _track(tracker, seeds, "forward", subject_ids)
+        forward_seed_ids = _get_seed_ids(tractogram)
+        _print_stopping_flags(tractogram, "Forward pass")
+
+        # Backward tracking
+        tracker = BackwardTrackerCls(model, subjects_is_stopping[0], nb_history_states, compress_streamlines=True, loss=loss,
+                                     **tracker_kwargs)
+        streamlines = [s[::-1] for s in tractogram.streamlines]  # Flip streamlines (the first half).
+        tractogram = _track(tracker, streamlines, "backward", None if subject_ids is None else subject_ids[forward_seed_ids // nb_samples])
+        seed_ids = forward_seed_ids[_get_seed_ids(tractogram)]  # Backward sprouts were planted in harvest order.
+        _print_stopping_flags(tractogram, "Backward pass")
+
+    # Streamlines are harvested as they are done, put them back in the order of their seeds.
+    data_per_streamline = {'stopping_flags': tractogram.data_per_streamline['stopping_flags']}
+    if 'losses' in tractogram.data_per_streamline:
+        data_per_streamline['losses'] = tractogram.data_per_streamline['losses']
+
+    if subject_ids is not None:
+        data_per_streamline['subject_ids'] = subject_ids[seed_ids // nb_samples]
+
+    # `seed_ids` are actually ids of the samples of the seeds (see `Tracker._branch`).
+    tractogram = Tractogram(tractogram.streamlines, data_per_streamline=data_per_streamline)
+    tractogram = tractogram[np.argsort(order[seed_ids // nb_samples] * nb_samples + seed_ids % nb_samples)]
+
+    if sink is not None:
+        sink.add(tractogram)
+        return None
+
+    return tractogram
+
+
+def get_default_batch_size(nb_seeds):
+    """ Returns the batch size used when none is given, which only depends on the number of seeds (see `DEFAULT_BATCH_SIZE`). """
+    return max(min(nb_seeds, DEFAULT_BATCH_SIZE), 1)
+
+
+def get_chunk_size(batch_size, args):
+    """ Returns how many seeds are tracked (forward then backward) before moving on to the next ones. """
+    if args.continuous_batching:
+        return batch_size * CONTINUOUS_BATCHING_CHUNK_FACTOR
+
+    return batch_size
+
+
+def parse_memory_size(text):
+    """ Parses a number of bytes, optionally followed by a unit: K, M, G or T (e.g. '512M', '4G'). """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    text = text.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+
+    if len(text) > 0 and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+
+    return int(float(text))
+
+
+def estimate_sprout_nbytes(model, max_nb_points, nb_history_states, itemsize=np.dtype(floatX).itemsize):
+    """ Estimates the peak number of bytes needed to track one streamline.
+
+    Parameters
+    ----------
+    model : `GRU` or `ModelEnsemble` object
+        Model used for tracking.
+    max_nb_points : int
+        Maximum number of points a streamline can have.
+    nb_history_states : int
+        Number of past model states kept for Particle Filtering Tractography (i.e. --pft-nb-backtrack-steps).
+    itemsize : int, optional
+        Number of bytes of a single value. Default: size of `floatX`.
+    """
+    # Points of the sprout, of its harvested copy and of the forward half waiting for the backward pass.
+    nb_values = 3 * 3 * (max_nb_points + 2)
+
+    # Current and updated model states, plus the ones kept in history.
+    nb_values += (nb_history_states + 2) * sum(model.hidden_sizes)
+
+    # Values computed during a single step: the 8 corners of the trilinear interpolation,
+    # the projections and gates of every layer, and the outputs of the model(s).
+    nb_values += 8 * getattr(model, 'model_input_size', model.input_size)
+    nb_values += sum(6 * hidden_size for hidden_size in model.hidden_sizes)
+    nb_values += sum(m.layer_regression.output_size for m in getattr(model, 'models', [model]))
+
+    return nb_values * itemsize
+
+
+def plan_batch_size(model, max_nb_points, nb_history_states, memory_budget, nb_sprouts_per_seed=1):
+    """ Picks the largest number of seeds that can be tracked at the same time within `memory_budget` bytes.
+
+    The shared variables of the volume manager (the atlas of every subject, the stacked or corner-packed atlases
+    derived from it and their lookup tables) and the parameters of the model are always in memory, whatever the
+    batch size. The rest of the budget is split among sprouts (see `estimate_sprout_nbytes`).
+    """
+    from learn2track.numpy_inference import NumpyVolumeManager
+
+    if isinstance(model.volume_manager, NumpyVolumeManager):
+        # Loaded without Theano (see `load_model`), everything is already in arrays.
+        fixed_nbytes = sum(array.nbytes for array in model.volume_manager.arrays)
+        fixed_nbytes += sum(param.nbytes for param in model.parameters)
+    else:
+        fixed_nbytes = sum(v.get_value(borrow=True).nbytes for v in model.volume_manager.shared_variables)
+        fixed_nbytes += sum(param.get_value(borrow=True).nbytes for param in model.parameters)
+
+    sprout_nbytes = estimate_sprout_nbytes(model, max_nb_points, nb_history_states) * nb_sprouts_per_seed
+    if memory_budget <= fixed_nbytes + sprout_nbytes:
+        raise MemoryError("A memory budget of {:,} bytes is too small: the volumes and the model alone need {:,} bytes, "
+                          "plus {:,} bytes per seed.".format(memory_budget, fixed_nbytes, sprout_nbytes))
+
+    return int((memory_budget - fixed_nbytes) // sprout_nbytes)
+
+
+def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args, sink=None, checkpoint=None, telemetry=None,
+                subject_ids=None, loss=None):
+    """ Tracks streamlines from `seeds`, `batch_size` seeds at a time (see `get_default_batch_size` if None).
+
+    If `sink` is provided, streamlines of each batch are sent to it (see `StreamlinesFilterChain`)
+    and None is returned. Otherwise, all streamlines are returned in a single tractogram.
+    If `checkpoint` is also provided (see `TrackingCheckpoint`), seeds it marked as done are skipped
+    and progress is saved after each batch. If `telemetry` is provided (see `TrackingTelemetry`),
+    statistics about every tracking step are sent to it.
+    If `subject_ids` (the subject of every seed) is provided, seeds of several subjects are tracked
+    together and `is_stopping` is a list containing the stopping criteria of every subject.
+    If `loss` is provided (see `make_tracking_loss`), the loss of every streamline is computed while tracking it.
+    When running out of memory, the batch being tracked is split in two and tracking resumes from it.
+    """
+    if batch_size is None:
+        batch_size = get_default_batch_size(len(seeds))
+
+    tractogram = None
+    # Seeds already tracked don't need to be tracked again.
+    done = [] if checkpoint is None else list(checkpoint.done)
+    while True:
+        try:
+            print("Trying to track {:,} streamlines at the same time.".format(batch_size))
+            chunk_size = get_chunk_size(batch_size, args)
+            for start, end in iter_seed_chunks(len(seeds), chunk_size, done):
+                print("{:,} / {:,}".format(start, len(seeds)))
+
+                batch_tractogram = track_seeds_chunk(model, seeds[start:end], step_size, is_stopping, args,
+                                                     rng_seed=get_chunk_rng_seed(args.seeding_rng_seed, start),
+                                                     sink=sink, batch_size=batch_size, telemetry=telemetry,
+                                                     subject_ids=None if subject_ids is None else subject_ids[start:end],
+                                                     loss=loss)
+
+                if sink is not None:
+                    sink.flush()
+                    if checkpoint is not None:
+                        checkpoint.commit(start, end, sink)
+                elif tractogram is None:
+                    tractogram = batch_tractogram
+                else:
+                    tractogram += batch_tractogram
+
+                done.append((start, end))
+
+            return tractogram
+
+        except (MemoryError, RuntimeError) as e:
+            if isinstance(e, RuntimeError) and "out of memory" not in str(e):
                 raise e
 
+            # Only the streamlines of the unfinished chunk are lost.
+            if sink is not None:
+                sink.discard()
+
+            print("{:,} streamlines is too much!".format(batch_size))
+            batch_size //= 2
+            if batch_size < 1:
+                raise MemoryError("Might needs a bigger graphic card!")
+
+
+# Everything a worker process needs to track seeds, see `_init_tracking_worker`.
+_worker_context = {}
+
+
+def _init_tracking_worker(experiment_path, hyperparams, weights, mask, affine_maskvox2dwivox, mask_threshold,
+                          max_nb_points, theta, step_size, args):
+    """ Loads the model and builds the stopping criteria once per worker process. """
+    _worker_context['model'] = load_model(experiment_path, hyperparams, weights, volume_layout=args.volume_layout,
+                                          numpy_inference=args.numpy_inference)
+    _worker_context['is_stopping'] = make_tracking_is_stopping(mask, affine_maskvox2dwivox, mask_threshold,
+                                                               max_nb_points, theta)
+    _worker_context['step_size'] = step_size
+    _worker_context['args'] = args
+    _worker_context['loss'] = make_tracking_loss(_worker_context['model'], hyperparams, args)
+
+    telemetry = None
+    if args.telemetry is not None:
+        # Every worker writes its own telemetry file.
+        telemetry = TrackingTelemetry("{}.{}".format(args.telemetry, os.getpid()))
+        Finalize(telemetry, telemetry.close, exitpriority=10)
+
+    _worker_context['telemetry'] = telemetry
+
+
+def _track_seeds_chunk_in_worker(chunk):
+    start, seeds, batch_size = chunk
+    args = _worker_context['args']
+    tractogram = track_seeds_chunk(_worker_context['model'], seeds, _worker_context['step_size'],
+                                   _worker_context['is_stopping'], args,
+                                   rng_seed=get_chunk_rng_seed(args.seeding_rng_seed, start),
+                                   batch_size=batch_size, telemetry=_worker_context['telemetry'], loss=_worker_context['loss'])
+
+    # Send back plain arrays since tractograms don't survive pickling.
+    return list(tractogram.streamlines), dict(tractogram.data_per_streamline)
+
+
+def parallel_batch_track(seeds, batch_size, nb_workers, worker_args, args, sink=None, checkpoint=None):
+    """ Tracks streamlines from `seeds` using a pool of `nb_workers` processes.
+
+    Seeds are split in chunks (see `get_chunk_size`) that are tracked independently by the workers.
+    Streamlines are merged back in seed order and the chunks don't depend on `nb_workers`, so the output
+    is the same as `batch_track` given the same `batch_size` (or none), as long as it doesn't run out of memory.
+
+    Parameters
+    ----------
+    seeds : 2D array of shape (n_seeds, 3)
+        Seeding points (in voxel space).
+    batch_size : int
+        Number of streamlines tracked at the same time by a worker. Default: see `get_default_batch_size`.
+    nb_workers : int
+        Number of processes to use.
+    worker_args : tuple
+        Arguments given to `_init_tracking_worker` in every worker.
+    args : `argparse.Namespace` object
+        Tracking options.
+    sink : `StreamlinesFilterChain` object, optional
+        If provided, streamlines of each chunk are sent to it and None is returned.
+    checkpoint : `TrackingCheckpoint` object, optional
+        If provided along with `sink`, seeds it marked as done are skipped and progress is saved after each chunk.
+    """
+    if batch_size is None:
+        batch_size = get_default_batch_size(len(seeds))
+
+    chunk_size = get_chunk_size(batch_size, args)
+
+    done = [] if checkpoint is None else checkpoint.done
+    seed_ranges = list(iter_seed_chunks(len(seeds), chunk_size, done))
+    chunks = ((start, seeds[start:end], batch_size) for start, end in seed_ranges)
+
+    tractogram = None
+    # Theano doesn't play well with forked processes.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(nb_workers, initializer=_init_tracking_worker, initargs=worker_args) as pool:
+        results = pool.imap(_track_seeds_chunk_in_worker, chunks)
+        for (start, end), (streamlines, data_per_streamline) in zip(seed_ranges, results):
+            print("{:,} / {:,}".format(end, len(seeds)))
+            batch_tractogram = Tractogram(streamlines, data_per_streamline=data_per_streamline)
+
+            if sink is not None:
+                sink.add(batch_tractogram)
+                sink.flush()
+                if checkpoint is not None:
+                    checkpoint.commit(start, end, sink)
+            elif tractogram is None:
+                tractogram = batch_tractogram
+            else:
+                tractogram += batch_tractogram
+
+        # Let workers exit on their own: leaving the block terminates them, skipping their finalizers (e.g. telemetry summaries).
+        pool.close()
+        pool.join()
+
+    return tractogram
+
 
 def get_max_angle_from_curvature(curvature, step_size):
     """
@@ -765,137 +2615,339 @@ def get_max_angle_from_curvature(curvature, step_size):
     return theta
 
 
-def main():
-    parser = build_argparser()
-    args = parser.parse_args()
-
-    # Get experiment folder
-    experiment_path = args.name
+def get_experiment_path(name):
+    """ Returns the folder of the experiment `name` (a name or a path), or None if it cannot be found. """
+    experiment_path = name
     if not os.path.isdir(experiment_path):
         # If not a directory, it must be the name of the experiment.
-        experiment_path = pjoin(".", "experiments", args.name)
+        experiment_path = pjoin(".", "experiments", name)
 
-    if not os.path.isdir(experiment_path):
-        parser.error('Cannot find experiment: {0}!'.format(args.name))
+    return experiment_path if os.path.isdir(experiment_path) else None
 
-    # Load experiments hyperparameters
-    try:
-        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "hyperparams.json"))
-    except FileNotFoundError:
-        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "..", "hyperparams.json"))
 
-    with Timer("Loading DWIs"):
-        # Load gradients table
-        dwi_name = args.dwi
-        if dwi_name.endswith(".gz"):
-            dwi_name = dwi_name[:-3]
-        if dwi_name.endswith(".nii"):
+def load_hyperparams(experiment_path):
+    """ Loads the hyperparameters of the experiment stored in `experiment_path`. """
+    filename = pjoin(experiment_path, "hyperparams.json")
+    if not os.path.isfile(filename):
+        filename = pjoin(experiment_path, "..", "hyperparams.json")
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def load_model(experiment_path, hyperparams, weights, volume_manager=None, volume_layout="flat", numpy_inference=False):
+    """ Loads the model of an experiment so it can track in the diffusion volume `weights`.
+
+    `weights` can also be a list of volumes, one per subject (see `neurotools.VolumeManager`), stored with `volume_layout`.
+    If `volume_manager` is provided, the model reads the volumes registered in it instead of `weights`
+    (e.g. to share them with other models). With `numpy_inference`, the model is loaded from its saved
+    parameters without Theano, and can only track with NumPy (see `numpy_inference.load_numpy_model`).
+    """
+    if numpy_inference:
+        from learn2track.numpy_inference import NumpyVolumeManager, load_numpy_model
+
+        if volume_manager is None:
+            volume_manager = NumpyVolumeManager(layout=volume_layout)
+            for volume in (weights if isinstance(weights, list) else [weights]):
+                volume_manager.register(volume)
+
+        return load_numpy_model(experiment_path, hyperparams, volume_manager)
+
+    from learn2track.function_cache import make_function_cache
+
+    if hyperparams["model"] == "gru_regression":
+        from learn2track.models import GRU_Regression
+        model_class = GRU_Regression
+    elif hyperparams['model'] == 'gru_gaussian':
+        from learn2track.models import GRU_Gaussian
+        model_class = GRU_Gaussian
+    elif hyperparams['model'] == 'gru_mixture':
+        from learn2track.models import GRU_Mixture
+        model_class = GRU_Mixture
+    elif hyperparams['model'] == 'gru_multistep':
+        from learn2track.models import GRU_Multistep_Gaussian
+        model_class = GRU_Multistep_Gaussian
+    elif hyperparams['model'] == 'ffnn_regression':
+        from learn2track.models import FFNN_Regression
+        model_class = FFNN_Regression
+    else:
+        raise ValueError("Unknown model!")
+
+    kwargs = {}
+    if volume_manager is None:
+        volume_manager = neurotools.VolumeManager(layout=volume_layout)
+        for volume in (weights if isinstance(weights, list) else [weights]):
+            volume_manager.register(volume)
+    kwargs['volume_manager'] = volume_manager
+
+    # Load the actual model.
+    model = model_class.create(pjoin(experiment_path), **kwargs)  # Create new instance and restore model.
+    model.drop_prob = 0.
+    # Functions compiled for that model by a previous run are reused.
+    model.function_cache = make_function_cache(experiment_path, model, hyperparams)
+    return model
+
+
+def make_tracking_is_stopping(mask, affine_maskvox2dwivox, mask_threshold, max_nb_points, theta):
+    """ Makes the function checking which streamlines should stop being tracked (see `make_is_stopping`). """
+    is_stopping = make_fused_is_stopping(mask, affine_maskvox2dwivox, mask_threshold, max_length=max_nb_points,
+                                         max_theta=np.rad2deg(theta), likelihood_threshold=0.5)
+
+    is_stopping.max_nb_points = max_nb_points  # Small hack
+    return is_stopping
+
+
+def get_tractogram_filename(args, theta, rejected=False, subject=0):
+    """ Generates a meaningful name for the output tractogram of the `subject`-th DWI. """
+    prefix = args.prefix
+    if prefix is None:
+        dwi_name = os.path.basename(args.dwi[subject])
+        if dwi_name.endswith(".nii.gz"):
+            dwi_name = dwi_name[:-7]
+        else:  # .nii
             dwi_name = dwi_name[:-4]
 
+        prefix = os.path.basename(os.path.dirname(args.dwi[subject])) + dwi_name
+        prefix = prefix.replace(".", "_")
+
+    seeds_filename = args.seeds[subject] if len(args.dwi) > 1 else args.seeds[0]
+    seed_mask_type = seeds_filename.replace(".", "_").replace("_", "").replace("/", "-")
+    if "int" in seeds_filename:
+        seed_mask_type = "int"
+    elif "wm" in seeds_filename:
+        seed_mask_type = "wm"
+    elif "rois" in seeds_filename:
+        seed_mask_type = "rois"
+    elif "bundles" in seeds_filename:
+        seed_mask_type = "bundles"
+
+    mask_filename = "" if args.mask is None else args.mask[subject]
+    mask_type = ""
+    if "fa" in mask_filename:
+        mask_type = "fa"
+    elif "wm" in mask_filename:
+        mask_type = "wm"
+
+    if args.dilate_seeding_mask:
+        seed_mask_type += "D"
+
+    if args.dilate_mask:
+        mask_type += "D"
+
+    filename_items = ["{}",
+                      "useMaxComponent-{}",
+                      # "seed-{}",
+                      # "mask-{}",
+                      "step-{:.2f}mm",
+                      "nbSeeds-{}",
+                      "maxAngleDeg-{:.1f}"
+                      # "keepCurv-{}",
+                      # "filtered-{}",
+                      # "minLen-{}",
+                      # "pftRetry-{}",
+                      # "pftHist-{}",
+                      # "trackLikePeter-{}",
+                      ]
+    if rejected:
+        filename_items.insert(1, "rejected")
+
+    filename = ('_'.join(filename_items) + ".tck").format(
+        prefix,
+        args.use_max_component,
+        # seed_mask_type,
+        # mask_type,
+        args.step_size,
+        args.nb_seeds_per_voxel,
+        np.rad2deg(theta)
+        # not args.discard_stopped_by_curvature,
+        # args.filter_threshold,
+        # args.min_length,
+        # args.pft_nb_retry,
+        # args.pft_nb_backtrack_steps,
+        # args.track_like_peter
+        )
+    return filename
+
+
+def load_dwi(filename, use_sh_coeffs):
+    """ Loads diffusion weighted images and the volume the model tracks in (see `neurotools.resample_dwi`). """
+    # Load gradients table
+    dwi_name = filename
+    if dwi_name.endswith(".gz"):
+        dwi_name = dwi_name[:-3]
+    if dwi_name.endswith(".nii"):
+        dwi_name = dwi_name[:-4]
+
+    try:
+        bvals_filename = dwi_name + ".bvals"
+        bvecs_filename = dwi_name + ".bvecs"
+        bvals, bvecs = dipy.io.gradients.read_bvals_bvecs(bvals_filename, bvecs_filename)
+    except FileNotFoundError:
         try:
-            bvals_filename = dwi_name + ".bvals"
-            bvecs_filename = dwi_name + ".bvecs"
+            bvals_filename = dwi_name + ".bval"
+            bvecs_filename = dwi_name + ".bvec"
             bvals, bvecs = dipy.io.gradients.read_bvals_bvecs(bvals_filename, bvecs_filename)
-        except FileNotFoundError:
-            try:
-                bvals_filename = dwi_name + ".bval"
-                bvecs_filename = dwi_name + ".bvec"
-                bvals, bvecs = dipy.io.gradients.read_bvals_bvecs(bvals_filename, bvecs_filename)
-            except FileNotFoundError as e:
-                print("Could not find .bvals/.bvecs or .bval/.bvec files...")
-                raise e
+        except FileNotFoundError as e:
+            print("Could not find .bvals/.bvecs or .bval/.bvec files...")
+            raise e
+
+    dwi = nib.load(filename)
+    if use_sh_coeffs:
+        # Use 45 spherical harmonic coefficients to represent the diffusion signal.
+        weights = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs).astype(np.float32)
+    else:
+        # Resample the diffusion signal to have 100 directions.
+        weights = neurotools.resample_dwi(dwi, bvals, bvecs).astype(np.float32)
+
+    return dwi, weights
+
+
+def load_seeds(filenames, affine_rasmm2dwivox, is_outside_mask, args):
+    """ Gathers the seeds (in diffusion voxel space) of seeding masks and tractograms (see `MaskSeeds`). """
+    seeds = []
+    for filename in filenames:
+        if filename.endswith('.trk') or filename.endswith('.tck'):
+            # Use extremities of the streamlines as seeding points.
+            starts, ends = neurotools.load_streamlines_endpoints(filename)
+            # Send them to voxel since that's where we'll track.
+            endpoints = nib.affines.apply_affine(affine_rasmm2dwivox, np.concatenate([starts, ends])).astype(floatX)
+            if is_outside_mask is not None:
+                endpoints = endpoints[np.logical_not(is_outside_mask(endpoints[:, None, :]))]
+
+            seeds.append(endpoints)
 
-        dwi = nib.load(args.dwi)
-        if hyperparams["use_sh_coeffs"]:
-            # Use 45 spherical harmonic coefficients to represent the diffusion signal.
-            weights = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs).astype(np.float32)
         else:
-            # Resample the diffusion signal to have 100 directions.
-            weights = neurotools.resample_dwi(dwi, bvals, bvecs).astype(np.float32)
+            # Assume it is a binary mask.
+            nii_seeds = nib.load(filename)
 
-        affine_rasmm2dwivox = np.linalg.inv(dwi.affine)
+            # affine_seedsvox2dwivox = mask_vox => rasmm space => dwi_vox
+            affine_seedsvox2dwivox = np.dot(affine_rasmm2dwivox, nii_seeds.affine)
 
-    with Timer("Loading model"):
-        if hyperparams["model"] == "gru_regression":
-            from learn2track.models import GRU_Regression
-            model_class = GRU_Regression
-        elif hyperparams['model'] == 'gru_gaussian':
-            from learn2track.models import GRU_Gaussian
-            model_class = GRU_Gaussian
-        elif hyperparams['model'] == 'gru_mixture':
-            from learn2track.models import GRU_Mixture
-            model_class = GRU_Mixture
-        elif hyperparams['model'] == 'gru_multistep':
-            from learn2track.models import GRU_Multistep_Gaussian
-            model_class = GRU_Multistep_Gaussian
-        elif hyperparams['model'] == 'ffnn_regression':
-            from learn2track.models import FFNN_Regression
-            model_class = FFNN_Regression
-        else:
-            raise ValueError("Unknown model!")
+            nii_seeds_data = nii_seeds.get_data()
+
+            if args.dilate_seeding_mask:
+                import scipy
+                nii_seeds_data = scipy.ndimage.morphology.binary_dilation(nii_seeds_data).astype(nii_seeds_data.dtype)
 
-        kwargs = {}
-        volume_manager = neurotools.VolumeManager()
-        volume_manager.register(weights)
-        kwargs['volume_manager'] = volume_manager
+            # Seeds are only generated when a chunk of them is about to be tracked.
+            seeds.append(MaskSeeds(nii_seeds_data, affine_seedsvox2dwivox, args.nb_seeds_per_voxel,
+                                   rng_seed=args.seeding_rng_seed, is_outside=is_outside_mask))
 
-        # Load the actual model.
-        model = model_class.create(pjoin(experiment_path), **kwargs)  # Create new instance and restore model.
-        model.drop_prob = 0.
-        print(str(model))
+    return SeedSequence(seeds)
 
-    mask = None
-    if args.mask is not None:
-        with Timer("Loading mask"):
-            mask_nii = nib.load(args.mask)
-            mask = mask_nii.get_data()
-            # Compute the affine allowing to evaluate the mask at some coordinates correctly.
 
-            # affine_maskvox2dwivox = mask_vox => rasmm space => dwi_vox
-            affine_maskvox2dwivox = np.dot(affine_rasmm2dwivox, mask_nii.affine)
-            if args.dilate_mask:
-                import scipy
-                mask = scipy.ndimage.morphology.binary_dilation(mask).astype(mask.dtype)
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
 
-    with Timer("Generating seeds"):
-        seeds = []
+    nb_subjects = len(args.dwi)
+    if args.mask is not None and len(args.mask) != nb_subjects:
+        parser.error("--mask needs one tracking mask per DWI.")
+    if args.out is not None and len(args.out) != nb_subjects:
+        parser.error("--out needs one output tractogram per DWI.")
 
-        for filename in args.seeds:
-            if filename.endswith('.trk') or filename.endswith('.tck'):
-                tfile = nib.streamlines.load(filename)
-                # Send the streamlines to voxel since that's where we'll track.
-                tfile.tractogram.apply_affine(affine_rasmm2dwivox)
+    # Seeds of every subject.
+    subjects_seeds_filenames = [args.seeds]
+    if nb_subjects > 1:
+        if len(args.seeds) != nb_subjects:
+            parser.error("--seeds needs one seeding file per DWI when tracking several subjects.")
+        if args.nb_workers > 1 or args.checkpoint or args.resume:
+            parser.error("Tracking several subjects does not support --nb-workers, --checkpoint nor --resume.")
 
-                # Use extremities of the streamlines as seeding points.
-                seeds += [s[0] for s in tfile.streamlines]
-                seeds += [s[-1] for s in tfile.streamlines]
+        subjects_seeds_filenames = [[filename] for filename in args.seeds]
 
-            else:
-                # Assume it is a binary mask.
-                rng = np.random.RandomState(args.seeding_rng_seed)
-                nii_seeds = nib.load(filename)
+    # Get experiment folder
+    experiment_path = get_experiment_path(args.name)
+    if experiment_path is None:
+        parser.error('Cannot find experiment: {0}!'.format(args.name))
+
+    # Load experiments hyperparameters
+    hyperparams = load_hyperparams(experiment_path)
+
+    # Experiments of the other models of the ensemble, if any.
+    ensemble = []
+    for name in (args.ensemble or []):
+        ensemble_path = get_experiment_path(name)
+        if ensemble_path is None:
+            parser.error('Cannot find experiment: {0}!'.format(name))
+
+        ensemble_hyperparams = load_hyperparams(ensemble_path)
+        if ensemble_hyperparams["use_sh_coeffs"] != hyperparams["use_sh_coeffs"]:
+            parser.error("Models of an --ensemble must be trained on the same inputs (see `use_sh_coeffs` of {}).".format(name))
+
+        ensemble.append((ensemble_path, ensemble_hyperparams))
+
+    if ensemble and (args.nb_workers > 1 or args.filter_threshold is not None):
+        parser.error("--ensemble does not support --nb-workers nor --filter-threshold.")
+    if args.track_loss and (args.filter_threshold is None or args.bidirectional):
+        parser.error("--track-loss needs --filter-threshold and does not support --bidirectional.")
+
+    if args.samples_per_seed < 1:
+        parser.error("--samples-per-seed must be at least 1.")
+    if ensemble and args.samples_per_seed > 1:
+        parser.error("--ensemble does not support --samples-per-seed.")
 
-                # affine_seedsvox2dwivox = mask_vox => rasmm space => dwi_vox
-                affine_seedsvox2dwivox = np.dot(affine_rasmm2dwivox, nii_seeds.affine)
+    with Timer("Loading DWIs"):
+        dwis, weights = zip(*[load_dwi(dwi_filename, hyperparams["use_sh_coeffs"]) for dwi_filename in args.dwi])
+        affines_rasmm2dwivox = [np.linalg.inv(dwi.affine) for dwi in dwis]
 
-                nii_seeds_data = nii_seeds.get_data()
+    with Timer("Loading model"):
+        # Without Theano for --numpy-inference, unless the loss of the streamlines is computed by Theano (see `make_has_high_loss`).
+        numpy_inference = args.numpy_inference and (args.filter_threshold is None or args.track_loss)
+        # The model is compiled once for all subjects, each one having its own volume.
+        model = load_model(experiment_path, hyperparams, list(weights), volume_layout=args.volume_layout, numpy_inference=numpy_inference)
+        if ensemble:
+            from learn2track.numpy_inference import ModelEnsemble
+            # Models of the ensemble share the volumes, so the diffusion data is gathered once per step for all of them.
+            models = [model] + [load_model(ensemble_path, ensemble_hyperparams, None, volume_manager=model.volume_manager,
+                                           numpy_inference=numpy_inference)
+                                for ensemble_path, ensemble_hyperparams in ensemble]
+            model = ModelEnsemble(models, combine=args.ensemble_mode)
 
-                if args.dilate_seeding_mask:
+        print(str(model))
+        # Checked before tracking starts since not every model supports it.
+        tracking_loss = make_tracking_loss(model, hyperparams, args)
+
+    masks = [None] * nb_subjects
+    affines_maskvox2dwivox = [None] * nb_subjects
+    if args.mask is not None:
+        with Timer("Loading mask"):
+            for i, mask_filename in enumerate(args.mask):
+                mask_nii = nib.load(mask_filename)
+                masks[i] = mask_nii.get_data()
+                # Compute the affine allowing to evaluate the mask at some coordinates correctly.
+
+                # affine_maskvox2dwivox = mask_vox => rasmm space => dwi_vox
+                affines_maskvox2dwivox[i] = np.dot(affines_rasmm2dwivox[i], mask_nii.affine)
+                if args.dilate_mask:
                     import scipy
-                    nii_seeds_data = scipy.ndimage.morphology.binary_dilation(nii_seeds_data).astype(nii_seeds_data.dtype)
-                    
-                indices = np.array(np.where(nii_seeds_data)).T
-                for idx in indices:
-                    seeds_in_voxel = idx + rng.uniform(-0.5, 0.5, size=(args.nb_seeds_per_voxel, 3))
-                    seeds_in_voxel = nib.affines.apply_affine(affine_seedsvox2dwivox, seeds_in_voxel)
-                    seeds.extend(seeds_in_voxel)
-
-        seeds = np.array(seeds, dtype=theano.config.floatX)
-
-    with Timer("Tracking in the diffusion voxel space"):
-        voxel_sizes = np.asarray(dwi.header.get_zooms()[:3])
-        if not np.all(voxel_sizes == dwi.header.get_zooms()[0]):
+                    masks[i] = scipy.ndimage.morphology.binary_dilation(masks[i]).astype(masks[i].dtype)
+
+    with Timer("Generating seeds"):
+        subjects_seeds = []
+        for i, seeds_filenames in enumerate(subjects_seeds_filenames):
+            is_outside_mask = None
+            if masks[i] is not None:
+                # Seeds outside the tracking mask would be stopped before taking their first step.
+                is_outside_mask = make_is_outside_mask(masks[i], affines_maskvox2dwivox[i], threshold=args.mask_threshold)
+
+            subjects_seeds.append(load_seeds(seeds_filenames, affines_rasmm2dwivox[i], is_outside_mask, args))
+
+        seeds = subjects_seeds[0]
+        subject_ids = None
+        if nb_subjects > 1:
+            # Subjects are tracked one after the other, batches mixing the end of a subject with the start of the next.
+            seeds = SeedSequence(subjects_seeds)
+            subject_ids = np.repeat(np.arange(nb_subjects), [len(subject_seeds) for subject_seeds in subjects_seeds])
+
+        print("{:,} seeds".format(len(seeds)))
+
+    with Timer("Setting up tracking"):
+        voxel_sizes = np.asarray(dwis[0].header.get_zooms()[:3])
+        if not np.all(voxel_sizes == dwis[0].header.get_zooms()[0]):
             print("* Careful voxel are anisotropic {}!".format(tuple(voxel_sizes)))
+        if any(np.max(dwi.header.get_zooms()[:3]) != voxel_sizes.max() for dwi in dwis):
+            parser.error("All DWIs must have the same voxel size since the step size and the maximum length are in voxel.")
         # Since we are tracking in diffusion voxel space, convert step_size (in mm) to voxel.
 
         if args.step_size is not None:
@@ -917,184 +2969,109 @@ def main():
         print("Step size (vox): {}".format(step_size))
         print("Max nb. points: {}".format(max_nb_points))
 
-        is_outside_mask = make_is_outside_mask(mask, affine_maskvox2dwivox, threshold=args.mask_threshold)
-        is_too_long = make_is_too_long(max_nb_points)
-        is_too_curvy = make_is_too_curvy(np.rad2deg(theta))
-        is_unlikely = make_is_unlikely(0.5)
-        is_stopping = make_is_stopping({STOPPING_MASK: is_outside_mask,
-                                        STOPPING_LENGTH: is_too_long,
-                                        STOPPING_CURVATURE: is_too_curvy,
-                                        STOPPING_LIKELIHOOD: is_unlikely})
-
-        is_stopping.max_nb_points = max_nb_points  # Small hack
-
-        tractogram = batch_track(model, weights, seeds,
-                                 step_size=step_size,
-                                 is_stopping=is_stopping,
-                                 batch_size=args.batch_size,
-                                 args=args)
+        subjects_is_stopping = [make_tracking_is_stopping(mask, affine_maskvox2dwivox, args.mask_threshold, max_nb_points, theta)
+                                for mask, affine_maskvox2dwivox in zip(masks, affines_maskvox2dwivox)]
 
-        # Streamlines have been generated in voxel space.
-        # Transform them them back to RAS+mm space using the dwi's affine.
-        tractogram.affine_to_rasmm = dwi.affine
-        tractogram.to_world()  # Performed in-place.
-
-    nb_streamlines = len(tractogram)
+    checkpoint = None
+    filter_chains = []
+    for i in range(nb_subjects):
+        filename = get_tractogram_filename(args, theta, subject=i) if args.out is None else args.out[i]
+        save_path = pjoin(experiment_path, filename)
+        try:  # Create dirs, if needed.
+            os.makedirs(os.path.dirname(save_path))
+        except:
+            pass
 
-    if args.save_rejected:
-        rejected_tractogram = Tractogram()
-        rejected_tractogram.affine_to_rasmm = tractogram._affine_to_rasmm
+        print("Saving to {}".format(save_path))
 
-    print("Generated {:,} (compressed) streamlines".format(nb_streamlines))
-    with Timer("Cleaning streamlines", newline=True):
-        # Flush streamlines that have no points.
+        rejected_save_path = None
         if args.save_rejected:
-            rejected_tractogram += tractogram[np.array(list(map(len, tractogram))) <= 0]
-
-        tractogram = tractogram[np.array(list(map(len, tractogram))) > 0]
-        print("Removed {:,} empty streamlines".format(nb_streamlines - len(tractogram)))
+            if args.out is None:
+                rejected_filename = get_tractogram_filename(args, theta, rejected=True, subject=i)
+            else:
+                root, ext = os.path.splitext(args.out[i])
+                rejected_filename = root + "_rejected" + ext
+
+            rejected_save_path = pjoin(experiment_path, rejected_filename)
+            try:  # Create dirs, if needed.
+                os.makedirs(os.path.dirname(rejected_save_path))
+            except:
+                pass
+
+            print("Saving rejected streamlines to {}".format(rejected_save_path))
+
+        if args.checkpoint or args.resume:
+            checkpoint = TrackingCheckpoint(save_path + ".checkpoint", len(seeds), save_path, rejected_save_path,
+                                            resume=args.resume)
+            writer = checkpoint.writer
+            rejected_writer = checkpoint.rejected_writer
+        else:
+            writer = TractogramWriter(save_path)
+            rejected_writer = None if rejected_save_path is None else TractogramWriter(rejected_save_path)
 
-        # Remove small streamlines
-        nb_streamlines = len(tractogram)
-        lengths = dipy.tracking.streamline.length(tractogram.streamlines)
+        # Streamlines are cleaned as soon as a batch of seeds has been tracked.
+        rejection_criteria = [("empty streamlines", make_is_empty()),
+                              ("streamlines smaller than {:.2f} mm".format(args.min_length), make_is_too_short(args.min_length))]
 
-        if args.save_rejected:
-            rejected_tractogram += tractogram[lengths < args.min_length]
-
-        tractogram = tractogram[lengths >= args.min_length]
-        lengths = lengths[lengths >= args.min_length]
-        if len(lengths) > 0:
-            print("Average length: {:.2f} mm.".format(lengths.mean()))
-            print("Minimum length: {:.2f} mm. Maximum length: {:.2f}".format(lengths.min(), lengths.max()))
-        print("Removed {:,} streamlines smaller than {:.2f} mm".format(nb_streamlines - len(tractogram),
-                                                                       args.min_length))
         if args.discard_stopped_by_curvature:
-            nb_streamlines = len(tractogram)
-            stopping_curvature_flag_is_set = is_flag_set(tractogram.data_per_streamline['stopping_flags'][:, 0], STOPPING_CURVATURE)
-
-            if args.save_rejected:
-                rejected_tractogram += tractogram[stopping_curvature_flag_is_set]
-
-            tractogram = tractogram[np.logical_not(stopping_curvature_flag_is_set)]
-            print("Removed {:,} streamlines stopped for having a curvature higher than {:.2f} degree".format(nb_streamlines - len(tractogram),
-                                                                                                             np.rad2deg(theta)))
+            rejection_criteria.append(("streamlines stopped for having a curvature higher than {:.2f} degree".format(np.rad2deg(theta)),
+                                       make_is_stopped_by(STOPPING_CURVATURE)))
 
         if args.filter_threshold is not None:
             # Remove streamlines that produces a reconstruction error higher than a certain threshold.
-            nb_streamlines = len(tractogram)
-            losses = compute_loss_errors(tractogram.streamlines, model, hyperparams)
-            print("Mean loss: {:.4f} ± {:.4f}".format(np.mean(losses), np.std(losses, ddof=1) / np.sqrt(len(losses))))
-
-            if args.save_rejected:
-                rejected_tractogram += tractogram[losses > args.filter_threshold]
-
-            tractogram = tractogram[losses <= args.filter_threshold]
-            print("Removed {:,} streamlines producing a loss lower than {:.2f} mm".format(nb_streamlines - len(tractogram),
-                                                                                          args.filter_threshold))
-
-    with Timer("Saving {:,} (compressed) streamlines".format(len(tractogram))):
-        filename = args.out
-        if args.out is None:
-            prefix = args.prefix
-            if prefix is None:
-                dwi_name = os.path.basename(args.dwi)
-                if dwi_name.endswith(".nii.gz"):
-                    dwi_name = dwi_name[:-7]
-                else:  # .nii
-                    dwi_name = dwi_name[:-4]
-
-                prefix = os.path.basename(os.path.dirname(args.dwi)) + dwi_name
-                prefix = prefix.replace(".", "_")
-
-            seed_mask_type = args.seeds[0].replace(".", "_").replace("_", "").replace("/", "-")
-            if "int" in args.seeds[0]:
-                seed_mask_type = "int"
-            elif "wm" in args.seeds[0]:
-                seed_mask_type = "wm"
-            elif "rois" in args.seeds[0]:
-                seed_mask_type = "rois"
-            elif "bundles" in args.seeds[0]:
-                seed_mask_type = "bundles"
-
-            mask_type = ""
-            if "fa" in args.mask:
-                mask_type = "fa"
-            elif "wm" in args.mask:
-                mask_type = "wm"
-
-            if args.dilate_seeding_mask:
-                seed_mask_type += "D"
-
-            if args.dilate_mask:
-                mask_type += "D"
-
-            filename_items = ["{}",
-                              "useMaxComponent-{}",
-                              # "seed-{}",
-                              # "mask-{}",
-                              "step-{:.2f}mm",
-                              "nbSeeds-{}",
-                              "maxAngleDeg-{:.1f}"
-                              # "keepCurv-{}",
-                              # "filtered-{}",
-                              # "minLen-{}",
-                              # "pftRetry-{}",
-                              # "pftHist-{}",
-                              # "trackLikePeter-{}",
-                              ]
-            filename = ('_'.join(filename_items) + ".tck").format(
-                prefix,
-                args.use_max_component,
-                # seed_mask_type,
-                # mask_type,
-                args.step_size,
-                args.nb_seeds_per_voxel,
-                np.rad2deg(theta)
-                # not args.discard_stopped_by_curvature,
-                # args.filter_threshold,
-                # args.min_length,
-                # args.pft_nb_retry,
-                # args.pft_nb_backtrack_steps,
-                # args.track_like_peter
-                )
-
-        save_path = pjoin(experiment_path, filename)
-        try:  # Create dirs, if needed.
-            os.makedirs(os.path.dirname(save_path))
-        except:
-            pass
-
-        print("Saving to {}".format(save_path))
-        nib.streamlines.save(tractogram, save_path)
-
-    if args.save_rejected:
-        with Timer("Saving {:,} (compressed) rejected streamlines".format(len(rejected_tractogram))):
-            rejected_filename_items = filename_items.copy()
-            rejected_filename_items.insert(1, "rejected")
-            rejected_filename = ('_'.join(rejected_filename_items) + ".tck").format(
-                prefix,
-                args.use_max_component,
-                # seed_mask_type,
-                # mask_type,
-                args.step_size,
-                args.nb_seeds_per_voxel,
-                np.rad2deg(theta)
-                # not args.discard_stopped_by_curvature,
-                # args.filter_threshold,
-                # args.min_length,
-                # args.pft_nb_retry,
-                # args.pft_nb_backtrack_steps,
-                # args.track_like_peter
-            )
-
-        rejected_save_path = pjoin(experiment_path, rejected_filename)
-        try:  # Create dirs, if needed.
-            os.makedirs(os.path.dirname(rejected_save_path))
-        except:
-            pass
-
-        print("Saving rejected streamlines to {}".format(rejected_save_path))
-        nib.streamlines.save(rejected_tractogram, rejected_save_path)
+            rejection_criteria.append(("streamlines producing a loss higher than {:.2f}".format(args.filter_threshold),
+                                       make_has_high_loss(model, hyperparams, args.filter_threshold, subject_id=i)))
+
+        # Streamlines have been generated in voxel space, the filter chain brings them back
+        # to RAS+mm space using the dwi's affine.
+        filter_chain = StreamlinesFilterChain(rejection_criteria, affine_to_rasmm=dwis[i].affine,
+                                              writer=writer, rejected_writer=rejected_writer)
+        if checkpoint is not None and checkpoint.filter_chain_state is not None:
+            filter_chain.set_state(checkpoint.filter_chain_state)
+
+        filter_chains.append(filter_chain)
+
+    filter_chain = filter_chains[0] if nb_subjects == 1 else SubjectsFilterChain(filter_chains)
+
+    batch_size = args.batch_size
+    if args.memory_budget is not None:
+        planned_batch_size = plan_batch_size(model, max_nb_points, get_nb_history_states(args),
+                                             args.memory_budget // args.nb_workers,
+                                             nb_sprouts_per_seed=(2 if args.bidirectional else 1) * args.samples_per_seed)
+        batch_size = min(planned_batch_size, batch_size or planned_batch_size, len(seeds))
+        print("Batch size planned for a memory budget of {:,} bytes: {:,}".format(args.memory_budget, batch_size))
+
+    telemetry = None
+    if args.telemetry is not None and args.nb_workers <= 1:
+        telemetry = TrackingTelemetry(args.telemetry)
+
+    with Timer("Tracking in the diffusion voxel space", newline=True):
+        if args.nb_workers > 1:
+            worker_args = (experiment_path, hyperparams, weights[0], masks[0], affines_maskvox2dwivox[0], args.mask_threshold,
+                           max_nb_points, theta, step_size, args)
+            parallel_batch_track(seeds, batch_size, args.nb_workers, worker_args, args,
+                                 sink=filter_chain, checkpoint=checkpoint)
+        else:
+            batch_track(model, weights, seeds,
+                        step_size=step_size,
+                        is_stopping=subjects_is_stopping[0] if nb_subjects == 1 else subjects_is_stopping,
+                        batch_size=batch_size,
+                        args=args,
+                        sink=filter_chain,
+                        checkpoint=checkpoint,
+                        telemetry=telemetry,
+                        subject_ids=subject_ids,
+                        loss=tracking_loss)
+
+    with Timer("Finishing saving streamlines"):
+        filter_chain.close()
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        if telemetry is not None:
+            telemetry.close()
+
+    filter_chain.print_summary()
 
 if __name__ == "__main__":
     main()
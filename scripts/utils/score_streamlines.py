@@ -14,12 +14,13 @@ import nibabel as nib
 from nibabel.streamlines import Field
 from nibabel.orientations import aff2axcodes
 
-from smartlearner import views
 from smartlearner.status import Status
 from smartlearner import utils as smartutils
 
 from learn2track.utils import Timer
 from learn2track.factories import loss_factory, batch_scheduler_factory
+from learn2track.function_cache import make_function_cache
+from learn2track.views import CachedLossView
 
 from learn2track import datasets
 from learn2track.neurotools import VolumeManager
@@ -137,6 +138,8 @@ def main():
         else:
             raise NameError("Unknown model: {}".format(hyperparams['model']))
 
+        model.function_cache = make_function_cache(experiment_path, model, hyperparams)
+
     with Timer("Building evaluation function"):
         # Override K for gru_multistep
         if 'k' in hyperparams:
@@ -147,7 +150,7 @@ def main():
                                                   train_mode=False,
                                                   batch_size_override=args.batch_size)
         loss = loss_factory(hyperparams, model, dataset, loss_type=loss_type)
-        l2_error = views.LossView(loss=loss, batch_scheduler=batch_scheduler)
+        l2_error = CachedLossView(loss=loss, batch_scheduler=batch_scheduler, function_cache=model.function_cache)
 
     with Timer("Scoring...", newline=True):
         dummy_status = Status()  # Forces recomputing results
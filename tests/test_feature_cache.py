@@ -0,0 +1,100 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import numpy as np
+import theano
+
+from learn2track import batch_schedulers, neurotools, factories
+from learn2track.feature_cache import compute_features
+from learn2track.utils import Timer
+from tests.utils import make_dummy_dataset
+
+
+def _make_model(volume_manager, model, **kwargs):
+    hyperparams = {'model': model,
+                   'SGD': "1e-2",
+                   'hidden_sizes': [50, 30],
+                   'learn_to_stop': False,
+                   'normalize': False,
+                   'activation': 'tanh',
+                   'feed_previous_direction': False,
+                   'predict_offset': False,
+                   'use_layer_normalization': False,
+                   'drop_prob': 0.,
+                   'dropout_prob': 0.,
+                   'use_zoneout': False,
+                   'skip_connections': False,
+                   'neighborhood_radius': None,
+                   'seed': 1234}
+    hyperparams.update(kwargs)
+    input_size = volume_manager.data_dimension
+    if hyperparams['feed_previous_direction']:
+        input_size += 3  # The previous direction is appended to the diffusion data (see `learn.py`).
+
+    model = factories.model_factory(hyperparams,
+                                    input_size=input_size,
+                                    output_size=3,
+                                    volume_manager=volume_manager)
+    model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+    return model
+
+
+def _compare_outputs(model, trainset, batch_scheduler_class, features):
+    # Batches made of coordinates or of cached features must lead to the same outputs.
+    feed_previous_direction = model.use_previous_direction
+    batch_scheduler = batch_scheduler_class(trainset, batch_size=16, resample_streamlines=False, feed_previous_direction=feed_previous_direction)
+    batch = batch_scheduler._next_batch(1)
+    batch_inputs = batch[0]
+    model.use_cached_features = False
+    expected = theano.function([trainset.symb_inputs], model.get_output(trainset.symb_inputs))(batch_inputs)
+
+    # Padding timesteps are fed coordinates (0,0,0) on one side and zero features on the other, only compare actual points.
+    mask = batch[2] > 0 if len(batch) > 2 else np.ones(len(batch_inputs), dtype=bool)
+
+    batch_scheduler = batch_scheduler_class(trainset, batch_size=16, resample_streamlines=False, feed_previous_direction=feed_previous_direction,
+                                            features=features)
+    batch_inputs = batch_scheduler._next_batch(1)[0]
+    assert batch_inputs.shape[-1] == features.shape[1] + 3 * feed_previous_direction
+    model.use_cached_features = True
+    values = theano.function([trainset.symb_inputs], model.get_output(trainset.symb_inputs))(batch_inputs)
+
+    assert np.allclose(values[mask], expected[mask], atol=1e-5)
+
+
+def test_feature_cache():
+    with Timer("Creating dataset", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        trainset = make_dummy_dataset(volume_manager)
+        features = compute_features(trainset, volume_manager)
+        assert features.shape == (len(trainset.streamlines._data), volume_manager.data_dimension)
+        neighborhood_features = compute_features(trainset, volume_manager, neighborhood_radius=0.5)
+        assert neighborhood_features.shape == (len(trainset.streamlines._data), 7 * volume_manager.data_dimension)
+
+    with Timer("Comparing GRU_Regression"):
+        _compare_outputs(_make_model(volume_manager, 'gru_regression', neighborhood_radius=0.5), trainset,
+                         batch_schedulers.TractographyBatchScheduler, neighborhood_features)
+        _compare_outputs(_make_model(volume_manager, 'gru_regression', feed_previous_direction=True, predict_offset=True), trainset,
+                         batch_schedulers.TractographyBatchScheduler, features)
+        stacked_features = compute_features(trainset, volume_manager, neighborhood_radius=0.5, stack_neighborhood=True)
+        _compare_outputs(_make_model(volume_manager, 'gru_regression', neighborhood_radius=0.5, stack_neighborhood=True), trainset,
+                         batch_schedulers.TractographyBatchScheduler, stacked_features)
+
+    with Timer("Comparing FFNN_Regression"):
+        _compare_outputs(_make_model(volume_manager, 'ffnn_regression', hidden_sizes=[50], neighborhood_radius=0.5), trainset,
+                         batch_schedulers.SingleInputTractographyBatchScheduler, neighborhood_features)
+        _compare_outputs(_make_model(volume_manager, 'ffnn_regression', hidden_sizes=[50], feed_previous_direction=True, predict_offset=True), trainset,
+                         batch_schedulers.SingleInputTractographyBatchScheduler, features)
+
+    # Cached features are only valid for the points of the dataset.
+    try:
+        batch_schedulers.TractographyBatchScheduler(trainset, batch_size=16, resample_streamlines=True, features=features)
+        assert False, "Resampled streamlines should not be allowed with cached features."
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    test_feature_cache()
@@ -0,0 +1,51 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+import theano
+import theano.tensor as T
+
+from learn2track.function_cache import FunctionCache
+
+floatX = theano.config.floatX
+
+
+def test_function_cache():
+    x = T.vector("x")
+
+    with tempfile.TemporaryDirectory() as path:
+        W = theano.shared(np.eye(3, dtype=floatX), name="W")
+        cache = FunctionCache(path, model="test")
+        f = cache.function([x], T.dot(W, x), name="f")
+        assert cache.nb_misses == 1
+        assert len(os.listdir(path)) == 1
+
+        # Saving the function must not change the values of its shared variables.
+        assert_array_almost_equal(W.get_value(), np.eye(3))
+        assert_array_almost_equal(f(np.ones(3, dtype=floatX)), np.ones(3))
+
+        # Same graph, new shared variable: the cached function must use it.
+        W2 = theano.shared(2 * np.eye(3, dtype=floatX), name="W")
+        cache = FunctionCache(path, model="test")
+        f2 = cache.function([x], T.dot(W2, x), name="f")
+        assert cache.nb_hits == 1
+        assert_array_almost_equal(f2(np.ones(3, dtype=floatX)), 2 * np.ones(3))
+
+        W2.set_value(3 * np.eye(3, dtype=floatX))
+        assert_array_almost_equal(f2(np.ones(3, dtype=floatX)), 3 * np.ones(3))
+
+        # A different graph or key must not hit.
+        cache.function([x], T.dot(W2, x) + 1, name="f")
+        FunctionCache(path, model="other").function([x], T.dot(W2, x), name="f")
+        assert len(os.listdir(path)) == 3
+
+
+if __name__ == "__main__":
+    test_function_cache()
@@ -7,11 +7,13 @@ from types import SimpleNamespace
 sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
 
 from scripts.track import make_is_outside_mask, make_is_too_long, make_is_too_curvy, make_is_stopping, STOPPING_MASK, STOPPING_LENGTH, STOPPING_CURVATURE, \
-    batch_track, make_is_unlikely, STOPPING_LIKELIHOOD
+    batch_track, make_is_unlikely, STOPPING_LIKELIHOOD, Tracker, track, compute_loss_errors, make_tracking_loss, make_has_high_loss, \
+    StreamlinesFilterChain
 
 import theano
 
 from learn2track import neurotools, factories
+from learn2track.numpy_inference import make_numpy_loss
 from learn2track.utils import Timer
 from tests.utils import make_dummy_dwi
 
@@ -82,6 +84,13 @@ def test_gru_mixture_track():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -156,6 +165,13 @@ def test_gru_mixture_track_neighborhood():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -230,6 +246,13 @@ def test_gru_mixture_track_stopping():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -240,7 +263,261 @@ def test_gru_mixture_track_stopping():
     return True
 
 
+def test_gru_mixture_track_losses():
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+
+        volume_manager.register(volume)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_mixture',
+                       'SGD': "1e-2",
+                       'hidden_sizes': 50,
+                       'learn_to_stop': True,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': True,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'noisy_streamlines_sigma': None,
+                       'keep_step_size': True,
+                       'sort_streamlines': False,
+                       'step_size': 0.5,
+                       'n_gaussians': 2,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension + 3,  # + previous direction
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    seeds = rng.uniform(2, 8, size=(100, 3)).astype(theano.config.floatX)
+
+    mask = np.ones(volume.shape[:3])
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(50)})
+    is_stopping.max_nb_points = 50
+
+    # Losses accumulated while tracking must match the ones obtained by feeding the streamlines to the model again.
+    with Timer("Tracking"):
+        tracker = Tracker(model, is_stopping, keep_last_n_states=0, max_nb_points=is_stopping.max_nb_points,
+                          loss=make_numpy_loss(model, normalize=hyperparams['normalize']))
+        tractogram = track(tracker, seeds, hyperparams['step_size'], is_stopping)
+        tractogram = tractogram[np.array(list(map(len, tractogram.streamlines))) >= 2]
+
+    with Timer("Computing losses"):
+        expected = compute_loss_errors(tractogram.streamlines, model, hyperparams)
+
+    assert len(tractogram) > 0
+    assert np.allclose(tractogram.data_per_streamline['losses'].reshape(-1), expected, atol=1e-4)
+
+
+class RecordingWriter(object):
+    """ Keeps the tractograms a `StreamlinesFilterChain` writes. """
+    def __init__(self):
+        self.filename = "<memory>"
+        self.nb_streamlines = 0
+        self.tractograms = []
+
+    def write(self, tractogram):
+        self.tractograms.append(tractogram)
+        self.nb_streamlines += len(tractogram)
+
+    def close(self):
+        pass
+
+
+def test_gru_mixture_track_losses_filter_chain():
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+
+        volume_manager.register(volume)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_mixture',
+                       'SGD': "1e-2",
+                       'hidden_sizes': 50,
+                       'learn_to_stop': False,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'noisy_streamlines_sigma': None,
+                       'keep_step_size': True,
+                       'sort_streamlines': False,
+                       'step_size': 0.5,
+                       'n_gaussians': 2,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    seeds = rng.uniform(2, 8, size=(100, 3)).astype(theano.config.floatX)
+
+    mask = np.ones(volume.shape[:3])
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(50)})
+    is_stopping.max_nb_points = 50
+
+    args = SimpleNamespace()
+    args.track_like_peter = False
+    args.pft_nb_retry = 0
+    args.pft_nb_backtrack_steps = 0
+    args.use_max_component = False
+    args.flip_x = False
+    args.flip_y = False
+    args.flip_z = False
+    args.verbose = False
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
+    args.filter_threshold = np.inf
+    args.track_loss = False
+
+    # Streamlines are saved with 2mm voxels, like the DWI they come from.
+    affine_to_rasmm = np.diag([2., 2., 2., 1.])
+
+    def _filter(tractogram, threshold):
+        writer, rejected_writer = RecordingWriter(), RecordingWriter()
+        filter_chain = StreamlinesFilterChain([("high loss", make_has_high_loss(model, hyperparams, threshold))],
+                                              affine_to_rasmm=affine_to_rasmm, writer=writer, rejected_writer=rejected_writer)
+        filter_chain.add(tractogram)
+        filter_chain.close()
+        return writer.tractograms[0], rejected_writer.tractograms[0]
+
+    def _track():
+        return batch_track(model, volume, seeds, step_size=hyperparams['step_size'], is_stopping=is_stopping, batch_size=None,
+                           args=args, loss=make_tracking_loss(model, hyperparams, args))
+
+    # By default, the loss is the one of the saved streamlines, computed once they leave the tracker.
+    assert make_tracking_loss(model, hyperparams, args) is None
+    tractogram = _track()
+    assert 'losses' not in tractogram.data_per_streamline
+    tractogram = tractogram[np.array(list(map(len, tractogram.streamlines))) >= 2]
+
+    saved_tractogram, _ = _filter(tractogram, threshold=np.inf)
+    saved_losses = compute_loss_errors(saved_tractogram.streamlines, model, hyperparams)
+    threshold = np.median(saved_losses)
+    kept, rejected = _filter(tractogram, threshold)
+    assert len(kept) + len(rejected) == len(tractogram)
+    assert np.all(compute_loss_errors(kept.streamlines, model, hyperparams) <= threshold)
+    assert np.all(compute_loss_errors(rejected.streamlines, model, hyperparams) > threshold)
+
+    # With --track-loss, the loss computed while tracking is the one used to filter streamlines.
+    args.track_loss = True
+    tractogram = _track()
+    tractogram = tractogram[np.array(list(map(len, tractogram.streamlines))) >= 2]
+    losses = tractogram.data_per_streamline['losses'].reshape(-1)
+    threshold = np.median(losses)
+    kept, rejected = _filter(tractogram, threshold)
+    assert len(kept) == np.sum(losses <= threshold) and len(rejected) == np.sum(losses > threshold)
+    assert np.all(kept.data_per_streamline['losses'] <= threshold)
+    assert np.all(rejected.data_per_streamline['losses'] > threshold)
+
+
+def test_gru_mixture_track_samples_per_seed():
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+
+        volume_manager.register(volume)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_mixture',
+                       'SGD': "1e-2",
+                       'hidden_sizes': 50,
+                       'learn_to_stop': True,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'step_size': 0.5,
+                       'batch_size': 200,
+                       'n_gaussians': 2,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    seeds = rng.uniform(2, 8, size=(100, 3)).astype(theano.config.floatX)
+
+    mask = np.ones(volume.shape[:3])
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(50)})
+    is_stopping.max_nb_points = 50
+
+    # Samples of a seed start from it, then branch in different directions.
+    with Timer("Tracking"):
+        tracker = Tracker(model, is_stopping, keep_last_n_states=0, max_nb_points=is_stopping.max_nb_points, nb_samples_per_seed=3)
+        tractogram = track(tracker, seeds, hyperparams['step_size'], is_stopping)
+
+    sample_ids = tractogram.data_per_streamline['seed_ids'].reshape(-1)
+    assert np.all(np.sort(sample_ids) == np.arange(3 * len(seeds)))
+    streamlines = [tractogram.streamlines[i] for i in np.argsort(sample_ids)]
+    for i, seed in enumerate(seeds):
+        samples = streamlines[3*i:3*i+3]
+        assert all(np.allclose(s[0], seed) for s in samples)
+        assert len(set(tuple(s[1]) for s in samples if len(s) > 1)) > 1 or min(map(len, samples)) <= 1
+
+    args = SimpleNamespace()
+    args.track_like_peter = False
+    args.pft_nb_retry = 0
+    args.pft_nb_backtrack_steps = 0
+    args.use_max_component = False
+    args.flip_x = False
+    args.flip_y = False
+    args.flip_z = False
+    args.verbose = False
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = True
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = True
+    args.sort_sprouts = False
+    args.samples_per_seed = 3
+
+    tractogram = batch_track(model, volume, seeds,
+                             step_size=hyperparams['step_size'],
+                             is_stopping=is_stopping,
+                             batch_size=hyperparams['batch_size'],
+                             args=args)
+    assert len(tractogram) == 3 * len(seeds)
+
+
 if __name__ == "__main__":
     test_gru_mixture_track()
     test_gru_mixture_track_neighborhood()
     test_gru_mixture_track_stopping()
+    test_gru_mixture_track_losses()
+    test_gru_mixture_track_losses_filter_chain()
+    test_gru_mixture_track_samples_per_seed()
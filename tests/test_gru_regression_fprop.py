@@ -4,7 +4,9 @@ import sys
 # Hack so you don't have to put the library containing this script in the PYTHONPATH.
 sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
 
+import numpy as np
 import theano
+import theano.tensor as T
 
 from learn2track import batch_schedulers, neurotools, factories
 from learn2track.utils import Timer
@@ -207,7 +209,56 @@ def test_gru_regression_fprop_stopping():
 
     return True
 
+
+def test_gru_regression_get_output_matches_steps():
+    with Timer("Creating dataset", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        trainset = make_dummy_dataset(volume_manager)
+        batch_scheduler = batch_schedulers.TractographyBatchScheduler(trainset,
+                                                                      batch_size=16,
+                                                                      noisy_streamlines_sigma=None,
+                                                                      seed=1234,
+                                                                      learn_to_stop=True)
+
+    hyperparams = {'model': 'gru_regression',
+                   'SGD': "1e-2",
+                   'hidden_sizes': [50, 30],
+                   'learn_to_stop': True,
+                   'normalize': False,
+                   'activation': 'tanh',
+                   'feed_previous_direction': False,
+                   'predict_offset': False,
+                   'use_layer_normalization': True,
+                   'drop_prob': 0.,
+                   'use_zoneout': False,
+                   'skip_connections': True,
+                   'neighborhood_radius': 0.5,
+                   'seed': 1234}
+    model = factories.model_factory(hyperparams,
+                                    input_size=volume_manager.data_dimension,
+                                    output_size=batch_scheduler.target_size,
+                                    volume_manager=volume_manager)
+    model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    # Training gathers and projects the inputs of all timesteps at once, tracking does it one step at a time.
+    X = trainset.symb_inputs
+    stopping, regression = model.get_output(X)
+    results, _ = theano.scan(fn=model._fprop_step,
+                             sequences=[T.transpose(X, axes=(1, 0, 2))],
+                             outputs_info=[T.zeros((X.shape[0], size)) for size in model.hidden_sizes] + [None, None],
+                             non_sequences=model.parameters + volume_manager.shared_variables,
+                             strict=True)
+    fct = theano.function([X], [stopping, regression,
+                                T.transpose(results[-2], axes=(1, 0, 2)),
+                                T.transpose(results[-1], axes=(1, 0, 2))])
+
+    batch_inputs, batch_targets, batch_mask = batch_scheduler._next_batch(2)
+    stopping, regression, expected_stopping, expected_regression = fct(batch_inputs)
+    assert np.allclose(stopping, expected_stopping, atol=1e-5)
+    assert np.allclose(regression, expected_regression, atol=1e-5)
+
 if __name__ == "__main__":
     test_gru_regression_fprop()
     test_gru_regression_fprop_neighborhood()
     test_gru_regression_fprop_stopping()
+    test_gru_regression_get_output_matches_steps()
@@ -81,6 +81,13 @@ def test_gru_regression_track():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -88,6 +95,50 @@ def test_gru_regression_track():
                              batch_size=hyperparams['batch_size'],
                              args=args)
 
+    # Refilling freed slots with fresh seeds must produce the same streamlines (in a different order).
+    args.continuous_batching = True
+    continuous_tractogram = batch_track(model, volume, seeds,
+                                        step_size=hyperparams['step_size'],
+                                        is_stopping=is_stopping,
+                                        batch_size=hyperparams['batch_size'],
+                                        args=args)
+
+    def _sort(streamlines):
+        return sorted(streamlines, key=lambda s: tuple(s[0]) + tuple(s[-1]))
+
+    # Batches are made of different streamlines, so float32 computations can drift a little along the way.
+    assert len(continuous_tractogram) == len(tractogram)
+    for s1, s2 in zip(_sort(tractogram.streamlines), _sort(continuous_tractogram.streamlines)):
+        assert np.allclose(s1[[0, -1]], s2[[0, -1]], atol=1e-3)
+
+    # Tracking seeds and sprouts in Z-order must produce the same streamlines, still in seed order.
+    args.continuous_batching = False
+    args.sort_seeds = True
+    args.sort_sprouts = True
+    sorted_tractogram = batch_track(model, volume, seeds,
+                                    step_size=hyperparams['step_size'],
+                                    is_stopping=is_stopping,
+                                    batch_size=hyperparams['batch_size'],
+                                    args=args)
+
+    assert len(sorted_tractogram) == len(tractogram)
+    for s1, s2 in zip(tractogram.streamlines, sorted_tractogram.streamlines):
+        assert np.allclose(s1[[0, -1]], s2[[0, -1]], atol=1e-3)  # Sprouts are batched differently (see above).
+
+    # Growing both directions at once must also produce one streamline per seed.
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
+    args.bidirectional = True
+    bidirectional_tractogram = batch_track(model, volume, seeds,
+                                           step_size=hyperparams['step_size'],
+                                           is_stopping=is_stopping,
+                                           batch_size=hyperparams['batch_size'],
+                                           args=args)
+
+    assert len(bidirectional_tractogram) == len(seeds)
+    assert max(map(len, bidirectional_tractogram.streamlines)) <= is_stopping.max_nb_points
+
     return True
 
 
@@ -154,6 +205,13 @@ def test_gru_regression_track_neighborhood():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -227,6 +285,13 @@ def test_gru_regression_track_stopping():
     args.flip_y = False
     args.flip_z = False
     args.verbose = True
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
 
     tractogram = batch_track(model, volume, seeds,
                              step_size=hyperparams['step_size'],
@@ -237,7 +302,92 @@ def test_gru_regression_track_stopping():
     return True
 
 
+def test_gru_regression_track_subjects():
+    hidden_sizes = 50
+
+    with Timer("Creating dummy volumes", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        volumes = []
+        for seed in [1234, 42]:
+            dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=seed)
+            volumes.append(neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32))
+            volume_manager.register(volumes[-1])
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_regression',
+                       'SGD': "1e-2",
+                       'hidden_sizes': hidden_sizes,
+                       'learn_to_stop': False,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'step_size': 0.5,
+                       'batch_size': 200,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    seeds = [rng.uniform(0, 9, size=(150, 3)).astype(theano.config.floatX) for _ in volumes]
+
+    mask = np.ones(volumes[0].shape[:3])
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(150),
+                                    STOPPING_CURVATURE: make_is_too_curvy(np.rad2deg(30))})
+    is_stopping.max_nb_points = 150
+
+    args = SimpleNamespace()
+    args.track_like_peter = False
+    args.pft_nb_retry = 0
+    args.pft_nb_backtrack_steps = 0
+    args.use_max_component = False
+    args.flip_x = False
+    args.flip_y = False
+    args.flip_z = False
+    args.verbose = False
+    args.seeding_rng_seed = 1234
+    args.continuous_batching = False
+    args.numpy_inference = False
+    args.bidirectional = False
+    args.sort_seeds = False
+    args.sort_sprouts = False
+    args.samples_per_seed = 1
+
+    # Track each subject on its own, then both of them at once.
+    expected = []
+    for subject_id, subject_seeds in enumerate(seeds):
+        tractogram = batch_track(model, volumes, subject_seeds, step_size=hyperparams['step_size'],
+                                 is_stopping=[is_stopping] * len(volumes), batch_size=hyperparams['batch_size'],
+                                 args=args, subject_ids=np.full(len(subject_seeds), subject_id))
+        expected.append(tractogram.streamlines)
+
+    subject_ids = np.repeat(np.arange(len(seeds)), list(map(len, seeds)))
+    tractogram = batch_track(model, volumes, np.concatenate(seeds), step_size=hyperparams['step_size'],
+                             is_stopping=[is_stopping] * len(volumes), batch_size=hyperparams['batch_size'],
+                             args=args, subject_ids=subject_ids)
+
+    # Batches mixing subjects must give the same streamlines, still in seed order.
+    assert len(tractogram) == len(subject_ids)
+    for subject_id, subject_streamlines in enumerate(expected):
+        streamlines = tractogram[tractogram.data_per_streamline['subject_ids'].reshape(-1) == subject_id].streamlines
+        assert len(streamlines) == len(subject_streamlines)
+        for s1, s2 in zip(streamlines, subject_streamlines):
+            assert np.allclose(s1, s2, atol=1e-5)
+
+    return True
+
+
 if __name__ == "__main__":
     test_gru_regression_track()
     test_gru_regression_track_neighborhood()
     test_gru_regression_track_stopping()
+    test_gru_regression_track_subjects()
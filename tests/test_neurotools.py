@@ -0,0 +1,39 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import tempfile
+
+import numpy as np
+import nibabel as nib
+from nibabel.streamlines import Tractogram, Field
+from numpy.testing import assert_array_almost_equal
+
+from learn2track.neurotools import load_streamlines_endpoints
+
+
+def test_load_streamlines_endpoints():
+    rng = np.random.RandomState(1234)
+    streamlines = [10 * rng.randn(rng.randint(1, 20), 3).astype(np.float32) for _ in range(100)]
+    tractogram = Tractogram(streamlines, affine_to_rasmm=np.eye(4))
+    header = {Field.VOXEL_TO_RASMM: np.diag([2., 3., 1.5, 1.]),
+              Field.VOXEL_SIZES: np.array([2., 3., 1.5]),
+              Field.DIMENSIONS: np.array([50, 50, 50])}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for ext in [".tck", ".trk"]:
+            filename = os.path.join(tmp_dir, "streamlines" + ext)
+            nib.streamlines.save(tractogram, filename, header=header if ext == ".trk" else None)
+            expected = nib.streamlines.load(filename).streamlines
+
+            # Streamlines spanning several chunks must be handled.
+            for chunk_size in [3, 10, 2**20]:
+                starts, ends = load_streamlines_endpoints(filename, chunk_size=chunk_size)
+                assert_array_almost_equal(starts, [s[0] for s in expected], decimal=4)
+                assert_array_almost_equal(ends, [s[-1] for s in expected], decimal=4)
+
+
+if __name__ == "__main__":
+    test_load_streamlines_endpoints()
@@ -0,0 +1,331 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import subprocess
+import tempfile
+
+import numpy as np
+import theano
+
+from learn2track import neurotools, factories
+from learn2track.numpy_inference import make_numpy_sequence_generator, eval_volume_at_3d_coordinates_in_numpy, ModelEnsemble
+from learn2track.numpy_inference import NumpyVolumeManager, load_numpy_model
+from learn2track.numpy_inference import eval_atlas_at_3d_coordinates_in_numpy, eval_corners_atlas_at_3d_coordinates_in_numpy
+from learn2track.utils import Timer
+from tests.utils import make_dummy_dwi
+
+floatX = theano.config.floatX
+
+
+def _make_model(volume_manager, **kwargs):
+    hyperparams = {'model': 'gru_regression',
+                   'SGD': "1e-2",
+                   'hidden_sizes': [50, 30],
+                   'learn_to_stop': False,
+                   'normalize': False,
+                   'activation': 'tanh',
+                   'feed_previous_direction': False,
+                   'predict_offset': False,
+                   'use_layer_normalization': False,
+                   'drop_prob': 0.,
+                   'use_zoneout': False,
+                   'skip_connections': False,
+                   'neighborhood_radius': None,
+                   'n_gaussians': 2,
+                   'seed': 1234}
+    hyperparams.update(kwargs)
+    input_size = volume_manager.data_dimension
+    if hyperparams['feed_previous_direction']:
+        input_size += 3  # The previous direction is appended to the diffusion data (see `learn.py`).
+
+    model = factories.model_factory(hyperparams,
+                                    input_size=input_size,
+                                    output_size=3,
+                                    volume_manager=volume_manager)
+    model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+    return model
+
+
+def _compare_generators(model, nb_steps=5, batch_size=20, numpy_model=None):
+    """ Compares the Theano generator of `model` to the NumPy one of `numpy_model` (default: `model`). """
+    numpy_model = model if numpy_model is None else numpy_model
+    rng = np.random.RandomState(42)
+    x_t = rng.uniform(-1, 11, size=(batch_size, 3)).astype(floatX)  # Some points fall outside the volume.
+    previous_direction = rng.randn(batch_size, 3).astype(floatX)
+
+    theano_gen = model.make_sequence_generator(use_max_component=True)
+    numpy_gen = make_numpy_sequence_generator(numpy_model, use_max_component=True)
+
+    theano_states = model.get_init_states(batch_size)
+    numpy_states = numpy_model.get_init_states(batch_size)
+    for _ in range(nb_steps):
+        theano_out, theano_states = theano_gen(x_t, theano_states, previous_direction)
+        numpy_out, numpy_states = numpy_gen(x_t, numpy_states, previous_direction)
+
+        if model.learn_to_stop:
+            assert np.allclose(numpy_out[1], theano_out[1], atol=1e-5)
+            theano_out, numpy_out = theano_out[0], numpy_out[0]
+
+        assert np.allclose(numpy_out, theano_out, atol=1e-5)
+        for numpy_h, theano_h in zip(numpy_states, theano_states):
+            assert np.allclose(numpy_h, theano_h, atol=1e-5)
+
+        previous_direction = numpy_out
+        x_t = (x_t + 0.5 * numpy_out).astype(floatX)
+
+
+def test_eval_volume_at_3d_coordinates_in_numpy():
+    dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+    volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+    volume_manager = neurotools.VolumeManager()
+    volume_manager.register(volume)
+
+    coords = np.random.RandomState(1234).uniform(-1, 11, size=(100, 3)).astype(floatX)
+    symb_coords = theano.tensor.matrix()
+    f = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords))
+    expected = f(np.c_[coords, np.zeros(len(coords), dtype=floatX)])
+
+    values = eval_volume_at_3d_coordinates_in_numpy(volume.reshape((-1, volume.shape[-1])),
+                                                    np.array(volume.shape[:3], dtype=floatX),
+                                                    volume_manager.volumes_strides[0].astype(floatX),
+                                                    coords)
+    assert np.allclose(values, expected, atol=1e-5)
+
+
+def test_volume_manager_multiple_subjects():
+    volume_manager = neurotools.VolumeManager()
+    volumes = []
+    for i, volume_shape in enumerate([(10, 10, 10), (6, 12, 8), (9, 7, 5)]):
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=volume_shape, seed=1234 + i)
+        volumes.append(neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32))
+        assert volume_manager.register(volumes[-1]) == i
+
+    rng = np.random.RandomState(1234)
+    coords = rng.uniform(-1, 13, size=(300, 3)).astype(floatX)
+    subject_ids = rng.randint(len(volumes), size=len(coords))
+
+    symb_coords = theano.tensor.matrix()
+    f = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords))
+    values = f(np.c_[coords, subject_ids].astype(floatX))
+
+    # Mixing subjects in a batch must give what each subject's volume gives alone.
+    for i, volume in enumerate(volumes):
+        rows = subject_ids == i
+        expected = eval_volume_at_3d_coordinates_in_numpy(volume.reshape((-1, volume.shape[-1])),
+                                                          np.array(volume.shape[:3], dtype=floatX),
+                                                          volume_manager.volumes_strides[i].astype(floatX),
+                                                          coords[rows])
+        assert np.allclose(values[rows], expected, atol=1e-5)
+
+    atlas = volume_manager.atlas.get_value()
+    numpy_values = eval_atlas_at_3d_coordinates_in_numpy(atlas,
+                                                         np.array(volume_manager.volumes_offsets),
+                                                         np.array(volume_manager.volumes_shapes, dtype=floatX),
+                                                         np.array(volume_manager.volumes_strides, dtype=floatX),
+                                                         coords, subject_ids)
+    assert np.allclose(numpy_values, values, atol=1e-5)
+
+
+def test_neighborhood_atlas():
+    volume_manager = neurotools.VolumeManager()
+    for i, volume_shape in enumerate([(10, 10, 10), (6, 12, 8)]):
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=volume_shape, seed=1234 + i)
+        volume_manager.register(neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32))
+
+    symb_coords = theano.tensor.matrix()
+    eval_at_coords = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords))
+
+    rng = np.random.RandomState(1234)
+    for radius in [1., 0.5]:
+        eval_neighborhood_at_coords = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords, neighborhood_radius=radius))
+        directions = neurotools.get_neighborhood_directions(radius).astype(floatX)
+
+        # Stacked neighbors are exact at the center of voxels, and anywhere inside the volumes for whole radii.
+        coords = rng.randint(0, 6, size=(100, 3)).astype(floatX)
+        if radius == 1.:
+            coords = rng.uniform(1, 4, size=(100, 3)).astype(floatX)
+
+        subject_ids = rng.randint(volume_manager.nb_volumes, size=len(coords)).astype(floatX)
+        neighbors = np.repeat(np.c_[coords, subject_ids], len(directions), axis=0)
+        neighbors[:, :3] += np.tile(directions, (len(coords), 1))
+        expected = eval_at_coords(neighbors).reshape((len(coords), -1))
+
+        values = eval_neighborhood_at_coords(np.c_[coords, subject_ids])
+        assert values.shape == (len(coords), len(directions) * volume_manager.data_dimension)
+        assert np.allclose(values, expected, atol=1e-5)
+
+    # Registering a volume afterwards also updates the neighborhood atlases.
+    dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(9, 7, 5), seed=42)
+    volume_manager.register(neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32))
+    for neighborhood_atlas in volume_manager.neighborhood_atlases.values():
+        assert len(neighborhood_atlas.get_value()) == len(volume_manager.atlas.get_value())
+
+    # Models gathering their neighborhood from the neighborhood atlas.
+    _compare_generators(_make_model(volume_manager, neighborhood_radius=0.5, stack_neighborhood=True))
+
+
+def test_corners_layout():
+    volume_managers = {layout: neurotools.VolumeManager(layout=layout) for layout in neurotools.VOLUME_LAYOUTS}
+    for i, volume_shape in enumerate([(10, 10, 10), (6, 12, 8), (9, 7, 5)]):
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=volume_shape, seed=1234 + i)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+        for volume_manager in volume_managers.values():
+            volume_manager.register(volume)
+
+    rng = np.random.RandomState(1234)
+    coords = rng.uniform(-2, 14, size=(300, 3)).astype(floatX)  # Some points fall outside the volumes.
+    subject_ids = rng.randint(3, size=len(coords))
+
+    # Both layouts give the same values, with or without a stacked neighborhood.
+    symb_coords = theano.tensor.matrix()
+    for neighborhood_radius in [None, 0.5]:
+        values = {}
+        for layout, volume_manager in volume_managers.items():
+            f = theano.function([symb_coords], volume_manager.eval_at_coords(symb_coords, neighborhood_radius=neighborhood_radius))
+            values[layout] = f(np.c_[coords, subject_ids].astype(floatX))
+
+        assert np.allclose(values["corners"], values["flat"], atol=1e-5)
+
+    volume_manager = volume_managers["corners"]
+    numpy_values = eval_corners_atlas_at_3d_coordinates_in_numpy(volume_manager.get_corners_atlas(0.5).get_value(),
+                                                                 np.array(volume_manager.corners_offsets),
+                                                                 np.array(volume_manager.volumes_shapes, dtype=floatX),
+                                                                 np.array(volume_manager.corners_strides, dtype=floatX),
+                                                                 coords, subject_ids)
+    assert np.allclose(numpy_values, values["corners"], atol=1e-5)
+
+    _compare_generators(_make_model(volume_manager))
+    _compare_generators(_make_model(volume_manager, neighborhood_radius=0.5))
+    _compare_generators(_make_model(volume_manager, neighborhood_radius=0.5, stack_neighborhood=True))
+
+
+def test_numpy_inference():
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+        volume_manager.register(volume)
+
+    with Timer("Comparing GRU_Regression"):
+        _compare_generators(_make_model(volume_manager))
+        _compare_generators(_make_model(volume_manager, learn_to_stop=True, feed_previous_direction=True, predict_offset=True))
+        _compare_generators(_make_model(volume_manager, skip_connections=True, neighborhood_radius=0.5))
+
+    with Timer("Comparing GRU_Regression with layer normalization"):
+        _compare_generators(_make_model(volume_manager, use_layer_normalization=True, skip_connections=True))
+
+    with Timer("Comparing GRU_Gaussian"):
+        _compare_generators(_make_model(volume_manager, model='gru_gaussian', learn_to_stop=True))
+
+    with Timer("Comparing GRU_Mixture"):
+        _compare_generators(_make_model(volume_manager, model='gru_mixture', feed_previous_direction=True))
+
+
+def test_numpy_ensemble():
+    volume_manager = neurotools.VolumeManager()
+    dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+    volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+    volume_manager.register(volume)
+
+    models = [_make_model(volume_manager, learn_to_stop=True, feed_previous_direction=True),
+              _make_model(volume_manager, learn_to_stop=True, feed_previous_direction=True, hidden_sizes=[20])]
+    ensemble = ModelEnsemble(models, combine="mean")
+    assert ensemble.hidden_sizes == [50, 30, 20]
+
+    rng = np.random.RandomState(42)
+    batch_size = 20
+    x_t = rng.uniform(-1, 11, size=(batch_size, 3)).astype(floatX)
+    previous_direction = rng.randn(batch_size, 3).astype(floatX)
+
+    # Models of the ensemble take the same steps they would take alone, their predictions being averaged.
+    ensemble_gen = ensemble.make_sequence_generator(use_max_component=True)
+    gens = [make_numpy_sequence_generator(model, use_max_component=True) for model in models]
+    ensemble_states = ensemble.get_init_states(batch_size)
+    states = [model.get_init_states(batch_size) for model in models]
+    for _ in range(5):
+        (directions, stopping), ensemble_states = ensemble_gen(x_t, ensemble_states, previous_direction)
+        outputs, states = zip(*[gen(x_t, model_states, previous_direction) for gen, model_states in zip(gens, states)])
+
+        assert np.allclose(directions, np.mean([output[0] for output in outputs], axis=0), atol=1e-5)
+        assert np.allclose(stopping, np.mean([output[1] for output in outputs], axis=0), atol=1e-5)
+        for ensemble_h, h in zip(ensemble_states, states[0] + states[1]):
+            assert np.allclose(ensemble_h, h, atol=1e-5)
+
+        previous_direction = directions
+        x_t = (x_t + 0.5 * directions).astype(floatX)
+
+    # With --use-max-component, the mixture of models follows one of them.
+    ensemble = ModelEnsemble(models, combine="mixture")
+    directions, stopping = ensemble.make_sequence_generator(use_max_component=True)(x_t, ensemble.get_init_states(batch_size), previous_direction)[0]
+    outputs = [gen(x_t, model.get_init_states(batch_size), previous_direction)[0] for gen, model in zip(gens, models)]
+    assert all(np.allclose(directions[i], outputs[0][0][i]) or np.allclose(directions[i], outputs[1][0][i]) for i in range(batch_size))
+
+
+def test_load_numpy_model():
+    volumes = []
+    for i, volume_shape in enumerate([(10, 10, 10), (6, 12, 8)]):
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=volume_shape, seed=1234 + i)
+        volumes.append(neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32))
+
+    for layout in neurotools.VOLUME_LAYOUTS:
+        volume_manager = neurotools.VolumeManager(layout=layout)
+        numpy_volume_manager = NumpyVolumeManager(layout=layout, dtype=floatX)
+        for volume in volumes:
+            volume_manager.register(volume)
+            numpy_volume_manager.register(volume)
+
+        # Atlases built from the volumes are the same with or without Theano.
+        assert np.allclose(numpy_volume_manager.atlas, volume_manager.atlas.get_value())
+        assert np.allclose(numpy_volume_manager.get_neighborhood_atlas(0.5), volume_manager.get_neighborhood_atlas(0.5).get_value())
+        assert np.allclose(numpy_volume_manager.get_corners_atlas(0.5), volume_manager.get_corners_atlas(0.5).get_value())
+
+        # Models loaded from their saved parameters predict like the models they were saved from.
+        for kwargs in [dict(learn_to_stop=True, feed_previous_direction=True, predict_offset=True),
+                       dict(use_layer_normalization=True, skip_connections=True, neighborhood_radius=0.5, stack_neighborhood=True),
+                       dict(model='gru_gaussian', learn_to_stop=True),
+                       dict(model='gru_mixture', neighborhood_radius=0.5)]:
+            model = _make_model(volume_manager, **kwargs)
+            with tempfile.TemporaryDirectory() as experiment_path:
+                model.save(experiment_path)
+                numpy_model = load_numpy_model(experiment_path, {'model': kwargs.get('model', 'gru_regression')}, numpy_volume_manager)
+
+            assert numpy_model.hidden_sizes == model.hidden_sizes
+            _compare_generators(model, numpy_model=numpy_model)
+
+
+def test_track_with_numpy_inference_without_theano():
+    dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+    volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+    volume_manager = neurotools.VolumeManager()
+    volume_manager.register(volume)
+    model = _make_model(volume_manager, learn_to_stop=True)
+
+    with tempfile.TemporaryDirectory() as experiment_path:
+        model.save(experiment_path)
+        np.save(os.path.join(experiment_path, "volume.npy"), volume)
+
+        # Loading the model and running it with NumPy, like track.py --numpy-inference does, in a fresh interpreter.
+        code = ("import sys\n"
+                "import numpy as np\n"
+                "from scripts.track import load_model\n"
+                "from learn2track.numpy_inference import make_numpy_sequence_generator\n"
+                "path = sys.argv[1]\n"
+                "model = load_model(path, {'model': 'gru_regression'}, np.load(path + '/volume.npy'), numpy_inference=True)\n"
+                "gen = make_numpy_sequence_generator(model)\n"
+                "gen(np.full((10, 3), 5, dtype=np.float32), model.get_init_states(10), np.zeros((10, 3), dtype=np.float32))\n"
+                "assert 'theano' not in sys.modules\n")
+        subprocess.check_call([sys.executable, "-c", code, experiment_path], cwd=os.path.abspath(os.path.join(__file__, '..', '..')))
+
+
+if __name__ == "__main__":
+    test_eval_volume_at_3d_coordinates_in_numpy()
+    test_volume_manager_multiple_subjects()
+    test_neighborhood_atlas()
+    test_corners_layout()
+    test_numpy_inference()
+    test_numpy_ensemble()
+    test_load_numpy_model()
+    test_track_with_numpy_inference_without_theano()
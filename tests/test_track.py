@@ -0,0 +1,390 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import io
+import json
+import tempfile
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+import numpy as np
+import nibabel as nib
+from nibabel.streamlines import Tractogram
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from scripts.track import SproutBuffer, TractogramWriter, StreamlinesFilterChain, TrackingCheckpoint, iter_seed_chunks
+from scripts.track import parse_memory_size, estimate_sprout_nbytes, plan_batch_size, StateHistory, TrackingTelemetry
+from scripts.track import get_morton_order, MaskSeeds, SeedSequence
+from scripts.track import get_default_batch_size, get_chunk_size, DEFAULT_BATCH_SIZE
+from scripts.track import make_is_empty, make_is_too_short, make_is_stopped_by, make_has_high_loss, STOPPING_CURVATURE, STOPPING_MASK
+from scripts.track import make_is_stopping, make_fused_is_stopping, make_is_outside_mask, make_is_too_long, \
+    make_is_too_curvy, make_is_unlikely, STOPPING_LENGTH, STOPPING_LIKELIHOOD
+
+
+def test_sprout_buffer():
+    rng = np.random.RandomState(1234)
+    seeds = rng.rand(5, 3).astype(np.float32)
+
+    # Start with a capacity too small so the buffer has to grow.
+    buffer = SproutBuffer(seeds[:, None, :], capacity=2)
+    expected = seeds[:, None, :]
+    for _ in range(10):
+        points = rng.rand(5, 3).astype(np.float32)
+        buffer.append(points)
+        expected = np.concatenate([expected, points[:, None, :]], axis=1)
+        assert_array_equal(buffer.view(), expected)
+
+    assert buffer.data.shape[1] >= 11
+    assert_array_equal(buffer.lengths, 11)
+
+    # Harvested sprouts are copies.
+    harvested = buffer.get([1, 3], trim=1)
+    assert_array_equal(harvested[0], expected[1, :-1])
+    assert_array_equal(harvested[1], expected[3, :-1])
+    harvested[0][:] = 0
+    assert_array_equal(buffer.view(), expected)
+
+    # Compaction keeps the requested sprouts, in order.
+    buffer.keep(np.array([4, 0, 2]))
+    assert len(buffer) == 3
+    assert_array_equal(buffer.view(), expected[[4, 0, 2]])
+
+    # Writing through the view modifies the buffer in place.
+    buffer.view()[1, -1] = 42
+    assert_array_equal(buffer.data[1, 10], 42)
+
+
+def test_streamlines_filter_chain():
+    rng = np.random.RandomState(1234)
+    affine = np.diag([2., 2., 2., 1.]).astype(np.float32)
+
+    def _harvest(lengths, flags):
+        streamlines = [np.cumsum(rng.rand(n, 3), axis=0).astype(np.float32) for n in lengths]
+        return Tractogram(streamlines, data_per_streamline={'stopping_flags': np.array(flags, dtype=np.uint8)})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = TractogramWriter(os.path.join(tmpdir, "kept.tck"))
+        rejected_writer = TractogramWriter(os.path.join(tmpdir, "rejected.tck"))
+        rejection_criteria = [("empty streamlines", make_is_empty()),
+                              ("short streamlines", make_is_too_short(5)),
+                              ("curvy streamlines", make_is_stopped_by(STOPPING_CURVATURE))]
+        chain = StreamlinesFilterChain(rejection_criteria, affine, writer, rejected_writer)
+
+        batch1 = [_harvest([0, 20], [STOPPING_MASK, STOPPING_MASK]), _harvest([1, 20], [STOPPING_MASK, STOPPING_CURVATURE])]
+        batch2 = _harvest([30, 30], [STOPPING_MASK, STOPPING_MASK])
+        for harvest in batch1:
+            chain.add(harvest)
+        chain.flush()
+
+        # Streamlines of a batch that has to be tracked again are dropped.
+        chain.add(_harvest([30], [STOPPING_MASK]))
+        chain.discard()
+
+        chain.add(batch2)
+        chain.close()
+
+        assert chain.nb_generated == 6
+        assert chain.nb_rejected == [1, 1, 1]
+
+        kept = nib.streamlines.load(writer.filename).streamlines
+        assert len(kept) == 3
+        expected = [batch1[0].streamlines[1], batch2.streamlines[0], batch2.streamlines[1]]
+        for s, s_expected in zip(kept, expected):
+            assert_array_almost_equal(s, nib.affines.apply_affine(affine, s_expected), decimal=4)
+
+
+def test_streamlines_filter_chain_mean_loss():
+    rng = np.random.RandomState(1234)
+    losses = rng.rand(3, 10).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writer = TractogramWriter(os.path.join(tmpdir, "kept.tck"))
+        # Losses computed while tracking are used as is, the model is never needed.
+        chain = StreamlinesFilterChain([("high loss", make_has_high_loss(None, None, threshold=0.5))], np.eye(4), writer)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            for batch_losses in losses:
+                streamlines = [rng.rand(5, 3).astype(np.float32) for _ in batch_losses]
+                chain.add(Tractogram(streamlines, data_per_streamline={'stopping_flags': np.zeros(len(streamlines), dtype=np.uint8),
+                                                                       'losses': batch_losses[:, None]}))
+                chain.flush()
+
+            # The mean loss is reported once, over all batches.
+            assert "Mean loss" not in output.getvalue()
+            chain.close()
+
+        assert chain.nb_rejected == [np.sum(losses > 0.5)]
+        lines = [line for line in output.getvalue().splitlines() if line.startswith("Mean loss")]
+        assert len(lines) == 1
+        losses = losses.astype(np.float64)
+        expected = "Mean loss: {:.4f} ± {:.4f}".format(losses.mean(), losses.std(ddof=1) / np.sqrt(losses.size))
+        assert lines[0] == expected
+
+
+def test_fused_is_stopping():
+    rng = np.random.RandomState(1234)
+    mask = (rng.rand(10, 10, 10) > 0.2).astype(np.float32)
+    affine = np.array([[1.1, 0.1, 0, -1], [0, 0.9, 0, 0.5], [0, 0, 1, 0], [0, 0, 0, 1]])
+
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, affine, threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(5),
+                                    STOPPING_CURVATURE: make_is_too_curvy(45),
+                                    STOPPING_LIKELIHOOD: make_is_unlikely(0.5)})
+    fused_is_stopping = make_fused_is_stopping(mask, affine, mask_threshold=0.5, max_length=5,
+                                               max_theta=45, likelihood_threshold=0.5)
+
+    for nb_points in range(1, 8):
+        streamlines = (rng.rand(100, nb_points, 3) * 10).astype(np.float32)
+        likelihood = rng.rand(100, 1)
+        for to_check in [None, np.arange(0, 100, 3), rng.rand(100) > 0.5]:
+            expected = is_stopping(streamlines, likelihood, to_check=to_check)
+            results = fused_is_stopping(streamlines, likelihood, to_check=to_check)
+            for result, expected_result in zip(results, expected):
+                assert_array_equal(result, expected_result)
+
+
+def test_iter_seed_chunks():
+    assert list(iter_seed_chunks(10, 4)) == [(0, 4), (4, 8), (8, 10)]
+    assert list(iter_seed_chunks(10, 4, done=[(4, 8)])) == [(0, 4), (8, 10)]
+    assert list(iter_seed_chunks(10, 3, done=[(0, 4), (8, 10)])) == [(4, 7), (7, 8)]
+    assert list(iter_seed_chunks(10, 4, done=[(0, 10)])) == []
+
+    # Without a batch size, seeds are split the same way whatever the number of workers.
+    args = SimpleNamespace(continuous_batching=False)
+    nb_seeds = 3 * DEFAULT_BATCH_SIZE + 1
+    chunks = list(iter_seed_chunks(nb_seeds, get_chunk_size(get_default_batch_size(nb_seeds), args)))
+    assert chunks == [(0, DEFAULT_BATCH_SIZE), (DEFAULT_BATCH_SIZE, 2 * DEFAULT_BATCH_SIZE),
+                      (2 * DEFAULT_BATCH_SIZE, 3 * DEFAULT_BATCH_SIZE), (3 * DEFAULT_BATCH_SIZE, nb_seeds)]
+    assert get_default_batch_size(10) == 10
+
+
+def test_tracking_checkpoint():
+    rng = np.random.RandomState(1234)
+    nb_seeds = 10
+    streamlines = [np.cumsum(rng.rand(10, 3), axis=0).astype(np.float32) for _ in range(nb_seeds)]
+
+    def _track(checkpoint, chunk_size, nb_chunks=None):
+        chain = StreamlinesFilterChain([("empty streamlines", make_is_empty())], np.eye(4),
+                                       checkpoint.writer, checkpoint.rejected_writer)
+        if checkpoint.filter_chain_state is not None:
+            chain.set_state(checkpoint.filter_chain_state)
+
+        for i, (start, end) in enumerate(iter_seed_chunks(nb_seeds, chunk_size, checkpoint.done)):
+            if i == nb_chunks:
+                break  # Simulate a crash.
+
+            flags = np.zeros(end - start, dtype=np.uint8)
+            chain.add(Tractogram(streamlines[start:end], data_per_streamline={'stopping_flags': flags}))
+            chain.flush()
+            checkpoint.commit(start, end, chain)
+
+        return chain
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "tractogram.tck")
+        checkpoint = TrackingCheckpoint(filename + ".checkpoint", nb_seeds, filename, resume=True)
+        _track(checkpoint, chunk_size=4, nb_chunks=1)
+
+        # Resume with a different chunk size.
+        checkpoint = TrackingCheckpoint(filename + ".checkpoint", nb_seeds, filename, resume=True)
+        assert checkpoint.done == [(0, 4)]
+        chain = _track(checkpoint, chunk_size=3)
+        chain.close()
+        checkpoint.remove()
+
+        assert chain.nb_generated == nb_seeds
+        assert not os.path.isdir(filename + ".checkpoint")
+        saved = nib.streamlines.load(filename).streamlines
+        assert len(saved) == nb_seeds
+        for s, s_expected in zip(saved, streamlines):
+            assert_array_almost_equal(s, s_expected, decimal=4)
+
+
+def test_state_history():
+    rng = np.random.RandomState(1234)
+    nb_sprouts, hidden_sizes, depth = 6, (4, 3), 3
+
+    def _random_states():
+        return [rng.rand(nb_sprouts, h).astype(np.float32) for h in hidden_sizes]
+
+    # Compare with a naive history made of the last `depth` lists of states.
+    history = StateHistory(depth, _random_states())
+    expected = []
+    for _ in range(5):  # More steps than `depth` so the ring buffer wraps around.
+        states = _random_states()
+        history.push(states)
+        expected = (expected + [states])[-depth:]
+
+    assert len(history) == depth
+    idx = np.arange(nb_sprouts)
+    for step in range(-depth, 0):
+        for state, expected_state in zip(history.get(step, idx), expected[step]):
+            assert_array_equal(state, expected_state)
+
+    # Forget some sprouts then overwrite the states of one of the remaining ones.
+    kept = np.array([0, 2, 5])
+    history.keep(kept)
+    expected = [[s[kept] for s in states] for states in expected]
+    new_states = [np.ones((1, h), dtype=np.float32) for h in hidden_sizes]
+    history.set(-2, np.array([1]), new_states)
+    for s, new_s in zip(expected[-2], new_states):
+        s[1] = new_s
+
+    history.push([s[kept] for s in _random_states()])
+    duplicated = history.duplicate()
+    for step in range(-depth + 1, 0):
+        for state, expected_state in zip(history.get(step - 1, np.arange(len(kept))), expected[step]):
+            assert_array_equal(state, expected_state)
+
+        for state, expected_state in zip(duplicated.get(step - 1, np.arange(2 * len(kept))), expected[step]):
+            assert_array_equal(state, np.concatenate([expected_state, expected_state]))
+
+    # Nothing is stored when history is disabled.
+    history = StateHistory(0, _random_states())
+    history.push(_random_states())
+    assert len(history) == 0
+
+
+def test_tracking_telemetry():
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "telemetry.jsonl")
+        telemetry = TrackingTelemetry(filename)
+        telemetry.start_pass("forward")
+        for i in range(3):
+            telemetry.start_step(nb_sprouts=10 - i)
+            with telemetry.timing('time_grow'):
+                pass
+
+            telemetry.count_rescue(nb_attempts=2, nb_rescued=1)
+            flags = np.array([STOPPING_MASK, STOPPING_MASK | STOPPING_CURVATURE], dtype=np.uint8)
+            telemetry.count_harvest(Tractogram([np.zeros((2, 3))] * 2, data_per_streamline={'stopping_flags': flags}))
+            telemetry.end_step()
+
+        telemetry.close()
+
+        with open(filename) as f:
+            lines = [json.loads(line) for line in f]
+
+    assert len(lines) == 4
+    assert [line['step'] for line in lines[:3]] == [0, 1, 2]
+    assert [line['nb_sprouts'] for line in lines[:3]] == [10, 9, 8]
+    assert lines[0]['pass'] == "forward"
+    assert lines[0]['nb_done'] == 2
+    assert lines[0]['stopping_flags'] == {"mask": 2, "curvature": 1, "length": 0, "likelihood": 0}
+
+    summary = lines[-1]['summary']
+    assert summary['nb_steps'] == 3
+    assert summary['nb_rescue_attempts'] == 6
+    assert summary['nb_rescued'] == 3
+    assert summary['stopping_flags']['mask'] == 6
+
+
+def test_plan_batch_size():
+    assert parse_memory_size("1024") == 1024
+    assert parse_memory_size("512M") == 512 * 1024**2
+    assert parse_memory_size("1.5gb") == int(1.5 * 1024**3)
+
+    class Param(object):
+        def __init__(self, value):
+            self.value = value
+
+        def get_value(self, borrow=False):
+            return self.value
+
+    # A stacked atlas is kept alongside the flat one, both count in the fixed memory.
+    volume_manager = SimpleNamespace(shared_variables=[Param(np.zeros((10, 10, 10, 100), dtype=np.float32)),
+                                                       Param(np.zeros((10, 10, 10, 700), dtype=np.float32)),
+                                                       Param(np.zeros((1, 3), dtype=np.int32))])
+    model = SimpleNamespace(input_size=100, hidden_sizes=[500, 500],
+                            layer_regression=SimpleNamespace(output_size=3),
+                            parameters=[Param(np.zeros((100, 1500), dtype=np.float32))],
+                            volume_manager=volume_manager)
+
+    sprout_nbytes = estimate_sprout_nbytes(model, max_nb_points=400, nb_history_states=1)
+    # Longer streamlines and deeper history need more memory.
+    assert estimate_sprout_nbytes(model, max_nb_points=800, nb_history_states=1) > sprout_nbytes
+    assert estimate_sprout_nbytes(model, max_nb_points=400, nb_history_states=5) > sprout_nbytes
+
+    fixed_nbytes = sum(v.value.nbytes for v in volume_manager.shared_variables) + model.parameters[0].value.nbytes
+    batch_size = plan_batch_size(model, 400, 1, memory_budget=fixed_nbytes + 1000 * sprout_nbytes)
+    assert batch_size == 1000
+    assert plan_batch_size(model, 400, 1, memory_budget=fixed_nbytes + 1000 * sprout_nbytes, nb_sprouts_per_seed=2) == 500
+
+    try:
+        plan_batch_size(model, 400, 1, memory_budget=fixed_nbytes)
+        assert False, "A budget too small should raise a MemoryError."
+    except MemoryError:
+        pass
+
+
+def test_get_morton_order():
+    # Corners of a 2x2x2 cube, x varying the fastest along the curve.
+    voxels = np.array([[x, y, z] for x in range(2) for y in range(2) for z in range(2)], dtype=np.float32)
+    assert_array_equal(voxels[get_morton_order(voxels + 0.25)],
+                       [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0], [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1]])
+
+    # A whole octant is visited before moving on to the next one.
+    rng = np.random.RandomState(1234)
+    points = rng.randint(0, 16, size=(1000, 3)) + 0.5
+    octants = (points >= 8).astype(int).dot([1, 2, 4])
+    assert np.all(np.diff(octants[get_morton_order(points)]) >= 0)
+
+    # Ties keep their original order.
+    assert_array_equal(get_morton_order(np.zeros((5, 3))), np.arange(5))
+    assert len(get_morton_order(np.zeros((0, 3)))) == 0
+
+
+def test_mask_seeds():
+    rng = np.random.RandomState(42)
+    mask = rng.randint(2, size=(10, 10, 10))
+    affine = np.diag([2., 2., 2., 1.])
+
+    # Same seeds as drawing them voxel by voxel.
+    expected = []
+    rng = np.random.RandomState(1234)
+    for idx in np.array(np.where(mask)).T:
+        expected.extend(nib.affines.apply_affine(affine, idx + rng.uniform(-0.5, 0.5, size=(3, 3))))
+
+    seeds = MaskSeeds(mask, affine, nb_seeds_per_voxel=3, rng_seed=1234, block_size=7)
+    assert len(seeds) == len(expected)
+    assert_array_almost_equal(seeds[:], expected, decimal=5)
+
+    # Slices don't depend on the order they are requested in.
+    assert_array_almost_equal(seeds[50:100], expected[50:100], decimal=5)
+    assert_array_almost_equal(seeds[10:20], expected[10:20], decimal=5)
+    assert_array_almost_equal(seeds[len(seeds) - 5:len(seeds) + 5], expected[-5:], decimal=5)
+    assert len(seeds[20:20]) == 0
+
+    # Seeds outside the tracking mask are discarded.
+    def _is_outside(streamlines):
+        return streamlines[:, -1, 0] > 10
+
+    filtered_seeds = MaskSeeds(mask, affine, nb_seeds_per_voxel=3, rng_seed=1234, is_outside=_is_outside, block_size=7)
+    expected = np.array(expected)
+    assert_array_almost_equal(filtered_seeds[:], expected[expected[:, 0] <= 10], decimal=5)
+    assert_array_almost_equal(filtered_seeds[30:60], expected[expected[:, 0] <= 10][30:60], decimal=5)
+
+    # Sources are sliced as if they were a single array.
+    endpoints = np.arange(30, dtype=np.float32).reshape((10, 3))
+    sequence = SeedSequence([endpoints, seeds])
+    assert len(sequence) == len(endpoints) + len(seeds)
+    assert_array_almost_equal(sequence[5:15], np.r_[endpoints[5:], seeds[:5]], decimal=5)
+    assert_array_almost_equal(sequence[12:20], seeds[2:10], decimal=5)
+
+
+if __name__ == "__main__":
+    test_sprout_buffer()
+    test_streamlines_filter_chain()
+    test_streamlines_filter_chain_mean_loss()
+    test_fused_is_stopping()
+    test_iter_seed_chunks()
+    test_tracking_checkpoint()
+    test_state_history()
+    test_tracking_telemetry()
+    test_plan_batch_size()
+    test_get_morton_order()
+    test_mask_seeds()